@@ -0,0 +1,417 @@
+"""
+Benchmarks of conda_api, which run against locally generated data (and do
+not need a conda installation or network access).
+
+usage: python bench.py [options] [BENCHMARK ...]
+
+The api benchmark measures the latency and throughput of the API functions
+against a fake conda, which replays JSON fixtures of configurable size and
+delay.  Its results can be saved as a baseline (--save-baseline), and later
+runs compared against it (--baseline), which fails when the median latency
+of any call regressed by more than the tolerance.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import conda_api
+
+
+# The fake conda, which writes the fixture file named after the conda
+# subcommand (e.g. fixtures/search.json) to stdout, in chunks.
+FAKE_CONDA = """\
+import os
+import sys
+import shutil
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0])))
+subcommand = sys.argv[1] if len(sys.argv) > 1 else 'help'
+path = os.path.join(root, 'fixtures', subcommand + '.json')
+if not os.path.isfile(path):
+    sys.exit('fake conda: no fixture for %r' % subcommand)
+time.sleep(float(os.getenv('FAKE_CONDA_DELAY', 0)))
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+with open(path, 'rb') as fi:
+    shutil.copyfileobj(fi, out, 65536)
+"""
+
+
+def make_fake_root(root):
+    """
+    Create a fake root prefix in the directory `root`, whose bin/python is
+    the current interpreter and bin/conda is FAKE_CONDA.  Returns the
+    fixtures directory.
+    """
+    bin_dir = join_mkdir(root, 'bin')
+    if not os.path.exists(os.path.join(bin_dir, 'python')):
+        os.symlink(sys.executable, os.path.join(bin_dir, 'python'))
+    with open(os.path.join(bin_dir, 'conda'), 'w') as fo:
+        fo.write(FAKE_CONDA)
+    return join_mkdir(root, 'fixtures')
+
+
+def make_search_fixture(path, n_names=5000, n_versions=20):
+    """
+    Write a `conda search --json` result with n_names packages of
+    n_versions records each, and return the number of records.
+    """
+    with open(path, 'w') as fo:
+        fo.write('{\n')
+        for i in range(n_names):
+            name = 'pkg%05d' % i
+            records = [{'name': name, 'version': '1.%d' % j, 'build': 'py27_0',
+                        'build_number': 0, 'channel': 'defaults',
+                        'depends': ['python 2.7*', 'zlib'],
+                        'fn': '%s-1.%d-py27_0.tar.bz2' % (name, j),
+                        'size': 123456, 'md5': '0' * 32}
+                       for j in range(n_versions)]
+            fo.write('%s  %s: %s' % (',\n' if i else '', json.dumps(name),
+                                     json.dumps(records, indent=2)))
+        fo.write('\n}\n')
+    return n_names * n_versions
+
+
+def peak_memory(func):
+    """
+    Call func, and return (seconds, peak traced memory in bytes, result).
+    """
+    tracemalloc.start()
+    try:
+        t0 = time.time()
+        res = func()
+        dt = time.time() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return dt, peak, res
+
+
+def make_repodata(path, n_names=2000, n_versions=20, subdir='linux-64',
+                  seed=42):
+    """
+    Write a synthetic cached repodata file with n_names packages of
+    n_versions versions each, and return the number of records.
+    """
+    rnd = random.Random(seed)
+    packages = {}
+    for i in range(n_names):
+        name = 'pkg%05d' % i
+        for j in range(n_versions):
+            version = '%d.%d.%d' % (j // 10, j % 10, rnd.randint(0, 9))
+            build = 'py27_%d' % rnd.randint(0, 3)
+            fn = '%s-%s-%s.tar.bz2' % (name, version, build)
+            packages[fn] = {
+                'name': name, 'version': version, 'build': build,
+                'build_number': int(build[5:]),
+                'depends': ['python 2.7*', 'pkg%05d' % rnd.randint(0, n_names)],
+                'features': 'mkl' if rnd.random() < 0.05 else '',
+                'size': rnd.randint(10000, 10000000),
+                'md5': '%032x' % rnd.getrandbits(128)}
+    with open(path, 'w') as fo:
+        json.dump({'_url': 'http://repo.example.com/pkgs/free/' + subdir,
+                   'info': {'subdir': subdir}, 'packages': packages}, fo)
+    return len(packages)
+
+
+def timed(func, repeat=5):
+    """
+    Call func repeat times, and return (best time in seconds, result).
+    """
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        res = func()
+        dt = time.time() - t0
+        best = dt if best is None else min(best, dt)
+    return best, res
+
+
+def report(name, seconds, extra=''):
+    print('%-40s %10.3f ms  %s' % (name, 1000 * seconds, extra))
+
+
+def make_fixtures(root, size=100):
+    """
+    Create a fake root prefix in `root` with `size` environments, and the
+    fixtures for the subcommands info, search, config and install (whose
+    size grows with `size`).  The root's .condarc has the same content as
+    the config fixture.
+    """
+    fixtures = make_fake_root(root)
+    envs_dir = join_mkdir(root, 'envs')
+    envs = []
+    for i in range(size):
+        prefix = join_mkdir(envs_dir, 'env%04d' % i)
+        join_mkdir(prefix, 'conda-meta')
+        envs.append(prefix)
+    with open(os.path.join(fixtures, 'info.json'), 'w') as fo:
+        json.dump({'root_prefix': root, 'conda_version': '3.7.0',
+                   'envs': envs, 'envs_dirs': [envs_dir],
+                   'pkgs_dirs': [os.path.join(root, 'pkgs')],
+                   'channels': ['http://repo.example.com/pkgs/free/linux-64/'],
+                   'platform': 'linux-64'}, fo, indent=2)
+    make_search_fixture(os.path.join(fixtures, 'search.json'), size, 10)
+    channels = ['ch%d' % i for i in range(size)]
+    with open(os.path.join(fixtures, 'config.json'), 'w') as fo:
+        json.dump({'get': {'channels': channels, 'use_pip': True},
+                   'rc_path': os.path.join(root, '.condarc'),
+                   'warnings': []}, fo, indent=2)
+    with open(os.path.join(root, '.condarc'), 'w') as fo:
+        fo.write('channels:\n%suse_pip: true\n'
+                 % ''.join('  - %s\n' % c for c in channels))
+    with open(os.path.join(fixtures, 'install.json'), 'w') as fo:
+        for i in range(size):
+            fo.write('linking pkg%05d-1.0-py27_0\n' % i)
+    # a prefix with `size` linked packages
+    prefix = os.path.join(envs_dir, 'env0000')
+    for i in range(size):
+        name = 'pkg%05d' % i
+        with open(os.path.join(prefix, 'conda-meta',
+                               '%s-1.0-py27_0.json' % name), 'w') as fo:
+            json.dump({'name': name, 'version': '1.0', 'build': 'py27_0',
+                       'files': ['lib/%s/%d.py' % (name, j)
+                                 for j in range(20)]}, fo)
+    return envs
+
+
+def measure(func, calls, threads=1):
+    """
+    Call func `calls` times, using `threads` threads, and return a
+    dictionary with the throughput (calls per second) and the latency
+    percentiles (in seconds).
+    """
+    latencies = []
+
+    def one(i):
+        t0 = time.time()
+        func()
+        latencies.append(time.time() - t0)
+
+    t0 = time.time()
+    if threads == 1:
+        for i in range(calls):
+            one(i)
+    else:
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(one, range(calls)))
+    wall = time.time() - t0
+    percentile = conda_api.MetricsAggregator.percentile
+    return {'calls': calls, 'threads': threads, 'throughput': calls / wall,
+            'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90),
+            'max': max(latencies)}
+
+
+def bench_api(tmp_dir, opts):
+    size = int(100 * opts.scale)
+    envs = make_fixtures(tmp_dir, size)
+    rc = os.path.join(tmp_dir, '.condarc')
+    os.environ['FAKE_CONDA_DELAY'] = str(opts.delay)
+    old_root_prefix = getattr(conda_api, 'ROOT_PREFIX', None)
+    conda_api.set_root_prefix(tmp_dir)
+    # measure the calls into conda, not the cache
+    old_ttl = conda_api.info_cache_stats()['ttl']
+    conda_api.set_info_ttl(0)
+
+    def process():
+        p = conda_api.process(name='env0001', cmd=sys.executable,
+                              args=['-c', 'pass'])
+        p.wait()
+
+    calls = [
+        ('info', conda_api.info),
+        ('search', lambda: conda_api.search(regex='pkg')),
+        ('linked', lambda: conda_api.linked(envs[0])),
+        ('linked_records', lambda: conda_api.linked_records(envs[0])),
+        ('install', lambda: conda_api.install(prefix=envs[1], pkgs=['pkg'])),
+        # read in-process when PyYAML is available, otherwise by the fake
+        # conda, but never from the user's ~/.condarc
+        ('config_get', lambda: conda_api.config_get('channels', file=rc)),
+        ('process', process),
+    ]
+    results = {}
+    try:
+        for threads in 1, opts.threads:
+            for name, func in calls:
+                key = '%s/%d' % (name, threads)
+                results[key] = res = measure(func, opts.calls, threads)
+                report(key, res['p50'], 'p90 %8.3f ms  %8.1f calls/s'
+                       % (1000 * res['p90'], res['throughput']))
+    finally:
+        conda_api.set_info_ttl(old_ttl)
+        conda_api.ROOT_PREFIX = old_root_prefix
+        del os.environ['FAKE_CONDA_DELAY']
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the median latencies of results against the baseline, print
+    the differences, and return the list of regressed benchmark keys.
+    """
+    regressed = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        old, new = baseline[key]['p50'], results[key]['p50']
+        change = (new - old) / old if old else 0.0
+        flag = ''
+        if change > tolerance:
+            regressed.append(key)
+            flag = 'REGRESSION'
+        print('%-40s %10.3f ms -> %10.3f ms  %+7.1f%%  %s'
+              % (key, 1000 * old, 1000 * new, 100 * change, flag))
+    return regressed
+
+
+def bench_repodata_index(tmp_dir, opts):
+    n_names, n_versions = int(2000 * opts.scale), 20
+    cache_dir = join_mkdir(tmp_dir, 'cache')
+    n = make_repodata(os.path.join(cache_dir, 'linux-64.json'),
+                      n_names, n_versions)
+    mb = os.path.getsize(os.path.join(cache_dir, 'linux-64.json')) / 1e6
+    print('repodata: %d records (%.1f MB)' % (n, mb))
+
+    def build():
+        index = conda_api.RepodataIndex([cache_dir])
+        index.reload()
+        return index
+
+    dt, index = timed(build, repeat=3)
+    report('index build', dt)
+    dt, res = timed(index.reload, repeat=100)
+    report('reload (unchanged)', dt)
+    dt, res = timed(lambda: index.search(spec='pkg00042'))
+    report('search spec=name', dt, '%d records' % len(res['pkg00042']))
+    dt, res = timed(lambda: index.search(spec='pkg00042 >=1.0,<1.5'))
+    report('search spec=name with version', dt)
+    dt, res = timed(lambda: index.search(regex='pkg001'))
+    report('search regex', dt, '%d names' % len(res))
+    dt, res = timed(lambda: index.features('mkl'))
+    report('features', dt, '%d records' % len(res))
+
+
+def bench_outdated_report(tmp_dir, opts):
+    n_names, n_linked = int(2000 * opts.scale), 40
+    n_envs = int(300 * opts.scale)
+    cache_dir = join_mkdir(tmp_dir, 'cache')
+    make_repodata(os.path.join(cache_dir, 'linux-64.json'), n_names)
+    index = conda_api.RepodataIndex([cache_dir])
+    index.reload()
+    rnd = random.Random(42)
+    prefixes = []
+    for i in range(n_envs):
+        meta_dir = join_mkdir(tmp_dir, 'envs', 'env%04d' % i, 'conda-meta')
+        for j in rnd.sample(range(n_names), n_linked):
+            record = rnd.choice(index.by_name['pkg%05d' % j])
+            fn = '%s-%s-%s.json' % (record['name'], record['version'],
+                                    record['build'])
+            with open(os.path.join(meta_dir, fn), 'w') as fo:
+                json.dump(dict(record, files=[]), fo)
+        prefixes.append(os.path.dirname(meta_dir))
+    print('%d environments of %d packages' % (n_envs, n_linked))
+
+    dt, res = timed(lambda: conda_api.outdated_report(prefixes, index),
+                    repeat=1)
+    report('outdated_report (cold)', dt, '%d outdated' % len(res))
+    dt, res = timed(lambda: conda_api.outdated_report(prefixes, index))
+    report('outdated_report', dt, '%d outdated' % len(res))
+    dt, res = timed(lambda: [index.search(outdated=True, prefix=prefix)
+                             for prefix in prefixes], repeat=1)
+    report('search(outdated=True) per env', dt)
+
+
+def bench_search_memory(tmp_dir, opts):
+    n_names, n_versions = int(5000 * opts.scale), 20
+    fixtures = make_fake_root(tmp_dir)
+    path = os.path.join(fixtures, 'search.json')
+    n = make_search_fixture(path, n_names, n_versions)
+    print('search result: %d records (%.1f MB)'
+          % (n, os.path.getsize(path) / 1e6))
+
+    old_root_prefix = getattr(conda_api, 'ROOT_PREFIX', None)
+    conda_api.set_root_prefix(tmp_dir)
+    try:
+        dt, peak, res = peak_memory(conda_api.search)
+        report('search()', dt, 'peak %6.1f MB, %d names'
+               % (peak / 1e6, len(res)))
+        del res
+        dt, peak, res = peak_memory(
+            lambda: sum(1 for item in conda_api.search_iter()))
+        report('search_iter()', dt, 'peak %6.1f MB, %d records'
+               % (peak / 1e6, res))
+    finally:
+        conda_api.ROOT_PREFIX = old_root_prefix
+
+
+def join_mkdir(*args):
+    path = os.path.join(*args)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+BENCHMARKS = {
+    'api': bench_api,
+    'outdated_report': bench_outdated_report,
+    'repodata_index': bench_repodata_index,
+    'search_memory': bench_search_memory,
+}
+
+
+def main():
+    from optparse import OptionParser
+
+    p = OptionParser(usage="usage: %prog [options] [BENCHMARK ...]",
+                     description="run conda-api benchmarks (available: %s)"
+                     % ', '.join(sorted(BENCHMARKS)))
+    p.add_option('--scale', type='float', default=1.0,
+                 help="scale the size of the generated data (default 1.0)")
+    p.add_option('--delay', type='float', default=0.0,
+                 help="seconds the fake conda sleeps per call (default 0)")
+    p.add_option('--calls', type='int', default=20,
+                 help="number of calls per API benchmark (default 20)")
+    p.add_option('--threads', type='int', default=8,
+                 help="number of threads for concurrent calls (default 8)")
+    p.add_option('--baseline', metavar='FILE',
+                 help="compare the results against the baseline in FILE")
+    p.add_option('--save-baseline', metavar='FILE',
+                 help="save the results as baseline to FILE")
+    p.add_option('--tolerance', type='float', default=0.25,
+                 help="allowed relative slowdown of the median latency, "
+                      "when comparing to the baseline (default 0.25)")
+    opts, args = p.parse_args()
+    for name in args:
+        if name not in BENCHMARKS:
+            p.error('no such benchmark: %r' % name)
+
+    results = {}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name in args or sorted(BENCHMARKS):
+            print('--- %s' % name)
+            res = BENCHMARKS[name](join_mkdir(tmp_dir, name), opts)
+            if res:
+                results.update(res)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if opts.save_baseline:
+        with open(opts.save_baseline, 'w') as fo:
+            json.dump(results, fo, indent=2, sort_keys=True)
+    if opts.baseline:
+        with open(opts.baseline) as fi:
+            baseline = json.load(fi)
+        print('--- compared to %s' % opts.baseline)
+        if compare(results, baseline, opts.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
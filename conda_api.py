@@ -1,9 +1,27 @@
 import re
 import os
 import sys
+import hashlib
+import shutil
+import copy
 import json
-from subprocess import Popen, PIPE
-from os.path import basename, isdir, join
+import codecs
+import time
+import fnmatch
+import warnings
+import signal
+import threading
+import types
+import contextvars
+from collections import namedtuple, deque, OrderedDict
+from contextlib import contextmanager
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+import queue
+try:
+    import yaml
+except ImportError: # the .condarc files are then read by conda
+    yaml = None
+from os.path import basename, expanduser, isdir, join, normcase, normpath
 
 
 __version__ = '1.2.1'
@@ -18,37 +36,981 @@ class CondaEnvExistsError(CondaError):
     pass
 
 
-def _call_conda(extra_args, abspath=True):
-    # call conda with the list of extra arguments, and return the tuple
-    # stdout, stderr
+class CondaWorkerError(CondaError):
+    "The persistent conda worker failed or died"
+    def __init__(self, msg, sent=False):
+        CondaError.__init__(self, msg)
+        # whether the request reached the worker, i.e. conda may have (at
+        # least partly) run it
+        self.sent = sent
+
+
+class CondaTimeoutError(CondaError):
+    "A conda call did not finish before its deadline"
+    def __init__(self, msg, stdout=b'', stderr=b''):
+        CondaError.__init__(self, msg)
+        # the (partial) output of conda until it was killed
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class CondaCancelledError(CondaError):
+    "A conda call was cancelled"
+    def __init__(self, msg, stdout=b'', stderr=b''):
+        CondaError.__init__(self, msg)
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+# Source of the persistent worker.  It is run by the Python of the root
+# environment (which, unlike conda_api itself, may be Python 2), imports
+# conda once, and then reads one JSON request per line on stdin, and writes
+# one JSON response per line.  The original stdout is kept as the response
+# channel, and file descriptor 1 is redirected to stderr, such that output
+# of sub-processes spawned by conda cannot corrupt the channel.
+_WORKER_SCRIPT = r"""
+import os
+import sys
+import json
+import traceback
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from conda.cli.main import main
+
+channel = os.fdopen(os.dup(1), 'w')
+os.dup2(2, 1)
+
+for line in iter(sys.stdin.readline, ''):
+    request = json.loads(line)
+    sys.argv = ['conda'] + request['args']
+    out, err = StringIO(), StringIO()
+    sys.stdout, sys.stderr = out, err
+    returncode = 0
+    try:
+        main()
+    except SystemExit as e:
+        if e.code is None:
+            returncode = 0
+        elif isinstance(e.code, int):
+            returncode = e.code
+        else:
+            err.write('%s\n' % e.code)
+            returncode = 1
+    except Exception:
+        traceback.print_exc(file=err)
+        returncode = 1
+    finally:
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    channel.write(json.dumps({'id': request['id'],
+                              'stdout': out.getvalue(),
+                              'stderr': err.getvalue(),
+                              'returncode': returncode}) + '\n')
+    channel.flush()
+"""
+
+
+def _root_python():
+    if sys.platform == 'win32':
+        return join(_client().root_prefix, 'python.exe')
+    return join(_client().root_prefix, 'bin/python')
+
+
+def _conda_cmd_list(extra_args, abspath=True):
+    # return the full command list used to invoke conda with extra_args
     if abspath:
         if sys.platform == 'win32':
-            python = join(ROOT_PREFIX, 'python.exe')
-            conda  = join(ROOT_PREFIX, 'Scripts', 'conda-script.py')
+            conda = join(_client().root_prefix, 'Scripts', 'conda-script.py')
         else:
-            python = join(ROOT_PREFIX, 'bin/python')
-            conda  = join(ROOT_PREFIX, 'bin/conda')
-        cmd_list = [python, conda]
+            conda = join(_client().root_prefix, 'bin/conda')
+        cmd_list = [_root_python(), conda]
     else: # just use whatever conda is on the path
         cmd_list = ['conda']
 
     cmd_list.extend(extra_args)
+    return cmd_list
+
+
+class CancelToken(object):
+    """
+    Cooperative cancellation of conda calls.  Calls made within a
+    `deadline(cancel=token)` block are killed (with their whole process
+    group) when token.cancel() is called, e.g. from another thread, and
+    raise CondaCancelledError.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._procs = set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            procs = list(self._procs)
+        for p in procs:
+            _kill_group(p)
+
+    def _register(self, p):
+        with self._lock:
+            self._procs.add(p)
+            cancelled = self._cancelled
+        if cancelled:
+            _kill_group(p)
+
+    def _unregister(self, p):
+        with self._lock:
+            self._procs.discard(p)
+
+
+_local = threading.local()
+# the (expires, tokens) of the innermost deadline() block, which is local
+# to the thread and to the asyncio task
+_scope = contextvars.ContextVar('conda_api_scope', default=None)
+_default_timeout = None
+
 
+def _client():
+    # return the CondaClient used by the current thread, see CondaClient.use
+    return getattr(_local, 'client', None) or _default_client
+
+
+def set_default_timeout(timeout):
+    """
+    Set the default number of seconds after which a conda call is killed
+    and raises CondaTimeoutError (default is None, i.e. no timeout).
+    """
+    global _default_timeout
+
+    _default_timeout = timeout
+
+
+@contextmanager
+def deadline(timeout=None, cancel=None):
+    """
+    Context manager which limits all conda calls made in the block (by the
+    current thread or asyncio task) to finish within `timeout` seconds
+    from now, and makes them cancellable through the CancelToken `cancel`.
+    Nested blocks can only shorten the deadline.  When the deadline
+    expires, the process group of conda is killed, and CondaTimeoutError
+    is raised.
+    """
+    prev = _scope.get()
+    expires = None if timeout is None else time.time() + timeout
+    tokens = ()
+    if prev is not None:
+        if prev[0] is not None:
+            expires = prev[0] if expires is None else min(expires, prev[0])
+        tokens = prev[1]
+    if cancel is not None:
+        tokens = tokens + (cancel,)
+    token = _scope.set((expires, tokens))
     try:
-        p = Popen(cmd_list, stdout=PIPE, stderr=PIPE)
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def _current_scope():
+    # return (expires, tokens) for a conda call made now
+    scope = _scope.get()
+    if scope is None:
+        scope = (None, ())
+    expires, tokens = scope
+    if _default_timeout is not None:
+        default = time.time() + _default_timeout
+        expires = default if expires is None else min(expires, default)
+    return expires, tokens
+
+
+def _group_kwargs():
+    # Popen arguments starting the process in a new process group, such
+    # that it can be killed together with its children
+    if sys.platform == 'win32':
+        import subprocess
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {'start_new_session': True}
+
+
+def _kill_group(p):
+    # kill the process group of p (started with _group_kwargs)
+    try:
+        if sys.platform == 'win32':
+            p.kill()
+        else:
+            os.killpg(p.pid, signal.SIGKILL)
     except OSError:
-        raise Exception("could not invoke %r\n" % args)
-    return p.communicate()
+        pass
 
 
-def _call_and_parse(extra_args, abspath=True):
-    stdout, stderr = _call_conda(extra_args, abspath=abspath)
+class _Invocation(object):
+    """
+    A conda process, started under the deadline and cancel tokens of the
+    current scope (see deadline()).
+    """
+    def __init__(self, cmd_list, stdin=None, stdout=PIPE, stderr=PIPE,
+                 env=None):
+        self.cmd_list = cmd_list
+        self.expires, self.tokens = _current_scope()
+        self.timed_out = False
+        self._timer = None
+        self._check_scope()
+        t0 = time.time()
+        try:
+            self.p = Popen(cmd_list, stdin=stdin, stdout=stdout, stderr=stderr,
+                           env=env, **_group_kwargs())
+        except OSError:
+            raise Exception("could not invoke %r\n" % cmd_list)
+        self.spawn_time = time.time() - t0
+        for token in self.tokens:
+            token._register(self.p)
+
+    def _check_scope(self):
+        if any(token.cancelled for token in self.tokens):
+            raise CondaCancelledError('%r: cancelled' % self.cmd_list)
+        if self.expires is not None and time.time() >= self.expires:
+            raise CondaTimeoutError('%r: deadline expired' % self.cmd_list)
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.time())
+
+    def communicate(self):
+        """
+        Wait for the process to finish, and return (stdout, stderr).
+        Raises CondaTimeoutError or CondaCancelledError.
+        """
+        try:
+            try:
+                stdout, stderr = self.p.communicate(timeout=self.remaining())
+            except TimeoutExpired:
+                self.timed_out = True
+                _kill_group(self.p)
+                stdout, stderr = self.p.communicate()
+            self.check(stdout, stderr)
+            return stdout, stderr
+        finally:
+            self.close()
+
+    def start_watchdog(self):
+        """
+        Kill the process when the deadline expires, for processes which are
+        not waited for by communicate().
+        """
+        if self.expires is not None:
+            self._timer = threading.Timer(self.remaining(), self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _expire(self):
+        if self.p.poll() is None:
+            self.timed_out = True
+            _kill_group(self.p)
+
+    def check(self, stdout=b'', stderr=b''):
+        """
+        Raise CondaTimeoutError or CondaCancelledError when the process was
+        killed because of its deadline or a cancel token.
+        """
+        if self.timed_out:
+            raise CondaTimeoutError(
+                'conda %r: timed out\nSTDERR:\n%s\nEND' % (
+                    self.cmd_list, (stderr or b'').decode('utf-8', 'replace')),
+                stdout, stderr)
+        if any(token.cancelled for token in self.tokens):
+            raise CondaCancelledError('conda %r: cancelled' % self.cmd_list,
+                                      stdout, stderr)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        for token in self.tokens:
+            token._unregister(self.p)
+        if self.p.poll() is None:
+            _kill_group(self.p)
+            self.p.wait()
+
+
+class CondaWorker(object):
+    """
+    A long-lived conda process, which imports conda once and serves many
+    requests over a JSON-lines pipe (on its stdin/stdout).
+
+    `cmd_list` is the command starting the worker, by default the Python of
+    the root environment running the built-in worker script.  Any program
+    speaking the same protocol may be used instead (e.g. for testing).
+    """
+    def __init__(self, cmd_list=None):
+        if cmd_list is None:
+            cmd_list = [_root_python(), '-u', '-c', _WORKER_SCRIPT]
+        self.cmd_list = cmd_list
+        self._lock = threading.Lock()
+        self._counter = 0
+        self._devnull = open(os.devnull, 'wb')
+        try:
+            self._proc = Popen(cmd_list, stdin=PIPE, stdout=PIPE,
+                               stderr=self._devnull, **_group_kwargs())
+        except OSError:
+            self._devnull.close()
+            raise CondaWorkerError("could not invoke %r" % cmd_list)
+        # responses are read by a thread, such that waiting for them can
+        # time out
+        self._responses = queue.Queue()
+        self._reader = threading.Thread(target=self._read_responses)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read_responses(self):
+        try:
+            for line in iter(self._proc.stdout.readline, b''):
+                self._responses.put(line)
+        except (IOError, OSError, ValueError):
+            pass
+        self._responses.put(b'')
+
+    def _wait_response(self, extra_args, expires, tokens):
+        # wait for the next response line, while checking the deadline and
+        # cancel tokens, which kill the worker
+        while True:
+            timeout = 0.1
+            if expires is not None:
+                timeout = min(timeout, max(0.0, expires - time.time()))
+            try:
+                return self._responses.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            if any(token.cancelled for token in tokens):
+                _kill_group(self._proc)
+                raise CondaCancelledError('conda %r: cancelled' % extra_args)
+            if expires is not None and time.time() >= expires:
+                _kill_group(self._proc)
+                raise CondaTimeoutError('conda %r: timed out (in worker)'
+                                        % extra_args)
+
+    def _acquire(self, extra_args, expires, tokens):
+        # acquire the lock of the worker, while checking the deadline and
+        # cancel tokens; a call which never got the worker leaves it alive
+        while True:
+            timeout = 0.1
+            if expires is not None:
+                timeout = min(timeout, max(0.0, expires - time.time()))
+            if self._lock.acquire(timeout=timeout):
+                return
+            self._check_scope(extra_args, expires, tokens)
+
+    def _check_scope(self, extra_args, expires, tokens):
+        # raise if the call was cancelled or its deadline has expired
+        if any(token.cancelled for token in tokens):
+            raise CondaCancelledError('conda %r: cancelled' % extra_args)
+        if expires is not None and time.time() >= expires:
+            raise CondaTimeoutError('conda %r: timed out (waiting for the '
+                                    'worker)' % extra_args)
+
+    @property
+    def alive(self):
+        return self._proc.poll() is None
+
+    def call(self, extra_args):
+        """
+        Run conda with the list of extra arguments inside the worker, and
+        return the tuple stdout, stderr (as bytes, like `_call_conda`).
+        Calls are subject to the current deadline(), and a call which times
+        out or is cancelled while conda runs kills the worker (one which
+        is still waiting for an earlier call to finish does not).
+        """
+        return self._call(extra_args)[:2]
+
+    def _call(self, extra_args):
+        # like call, but return the tuple stdout, stderr, returncode
+        expires, tokens = _current_scope()
+        self._acquire(extra_args, expires, tokens)
+        try:
+            # the scope may have ended while waiting for the lock
+            self._check_scope(extra_args, expires, tokens)
+            self._counter += 1
+            request = json.dumps({'id': self._counter,
+                                  'args': list(extra_args)})
+            try:
+                self._proc.stdin.write(request.encode('utf-8') + b'\n')
+                self._proc.stdin.flush()
+            except (IOError, OSError, ValueError) as e:
+                raise CondaWorkerError('conda worker failed: %s' % e)
+            line = self._wait_response(extra_args, expires, tokens)
+            if not line:
+                raise CondaWorkerError('conda worker died (exit status %r)'
+                                       % self._proc.poll(), sent=True)
+            try:
+                response = json.loads(line.decode('utf-8'))
+            except ValueError:
+                raise CondaWorkerError('invalid worker response: %r' % line,
+                                       sent=True)
+            if response.get('id') != self._counter:
+                raise CondaWorkerError('out of sequence worker response',
+                                       sent=True)
+        finally:
+            self._lock.release()
+        return (response['stdout'].encode('utf-8'),
+                response['stderr'].encode('utf-8'),
+                response.get('returncode'))
+
+    def close(self):
+        """
+        Stop the worker process.
+        """
+        try:
+            self._proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        try:
+            self._proc.wait()
+        except OSError:
+            pass
+        self._reader.join()
+        self._proc.stdout.close()
+        self._devnull.close()
+
+
+def start_worker(cmd_list=None):
+    """
+    Start a persistent conda worker.  From now on, all calls into conda
+    (using the root environment, i.e. abspath=True) are routed through the
+    worker, instead of starting a new conda process for each call.
+    If the worker dies, later calls fall back to starting a new process.
+    A call which was sent to the worker when it died is not run again, but
+    raises CondaWorkerError.  Returns the `CondaWorker` instance.
+    """
+    client = _client()
+    with client._lock:
+        stop_worker()
+        client.worker = CondaWorker(cmd_list)
+        return client.worker
+
+
+def stop_worker():
+    """
+    Stop the persistent conda worker (if any is running).
+    """
+    client = _client()
+    with client._lock:
+        worker, client.worker = client.worker, None
+    if worker is not None:
+        worker.close()
+
+
+class CallRecord(object):
+    """
+    Measurements of one conda call, which are passed to the instrumentation
+    hooks (see add_hook):
+
+      argv          the list of arguments passed to conda
+      subcommand    the conda subcommand, e.g. 'info' or 'config'
+      worker        whether the call was served by the persistent worker
+      spawn_time    seconds it took to start the process
+      wall_time     seconds from the start until the output was read
+      stdout_bytes  number of bytes conda wrote to stdout
+      stderr_bytes  number of bytes conda wrote to stderr
+      decode_time   seconds it took to decode the JSON output (or None)
+      returncode    the exit status of conda (or None if unknown)
+      error         the name of the exception raised by the call, or None
+      coalesced     whether the call shared the result of an identical
+                    call which was already in flight (see _SingleFlight),
+                    in which case wall_time is the time spent waiting
+    """
+    __slots__ = ('argv', 'subcommand', 'worker', 'spawn_time', 'wall_time',
+                 'stdout_bytes', 'stderr_bytes', 'decode_time', 'returncode',
+                 'error', 'coalesced')
+
+    def __init__(self, argv):
+        self.argv = list(argv)
+        self.subcommand = next((arg for arg in argv
+                                if not arg.startswith('-')),
+                               argv[0] if argv else None)
+        self.worker = False
+        self.spawn_time = 0.0
+        self.wall_time = 0.0
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+        self.decode_time = None
+        self.returncode = None
+        self.error = None
+        self.coalesced = False
+
+    def __repr__(self):
+        return '<CallRecord %s %.3fs>' % (' '.join(self.argv), self.wall_time)
+
+
+def add_hook(hook):
+    """
+    Register hook, a callable which is called with a CallRecord after each
+    conda call.  Hooks are called in the thread which made the call, and
+    exceptions raised by hooks are turned into warnings.
+    """
+    _client().hooks.append(hook)
+
+
+def remove_hook(hook):
+    """
+    Unregister a hook registered with add_hook.
+    """
+    _client().hooks.remove(hook)
+
+
+def _emit(record):
+    # pass record to all registered hooks
+    for hook in list(_client().hooks):
+        try:
+            hook(record)
+        except Exception as e:
+            warnings.warn('conda_api hook %r failed: %s' % (hook, e))
+
+
+def _execute(extra_args, abspath=True):
+    # call conda with the list of extra arguments, and return the tuple
+    # stdout, stderr, record
+    record = CallRecord(extra_args)
+    t0 = time.time()
+    try:
+        client = _client()
+        worker = client.worker
+        if abspath and worker is not None:
+            try:
+                stdout, stderr, record.returncode = worker._call(extra_args)
+            except CondaWorkerError as e:
+                # the worker is gone, fall back to starting conda processes,
+                # unless the request reached it, as running (e.g. an install)
+                # again is not safe
+                with client._lock:
+                    if client.worker is worker:
+                        stop_worker()
+                if e.sent:
+                    _invalidate_after(extra_args)
+                    raise
+            else:
+                record.worker = True
+                record.wall_time = time.time() - t0
+                record.stdout_bytes = len(stdout)
+                record.stderr_bytes = len(stderr)
+                _invalidate_after(extra_args)
+                return stdout, stderr, record
+
+        invocation = _Invocation(_conda_cmd_list(extra_args, abspath=abspath))
+        record.spawn_time = invocation.spawn_time
+        try:
+            stdout, stderr = invocation.communicate()
+        except (CondaTimeoutError, CondaCancelledError) as e:
+            record.stdout_bytes = len(e.stdout or b'')
+            record.stderr_bytes = len(e.stderr or b'')
+            raise
+        finally:
+            record.returncode = invocation.p.returncode
+            _invalidate_after(extra_args)
+    except Exception as e:
+        record.wall_time = time.time() - t0
+        record.error = type(e).__name__
+        _emit(record)
+        raise
+    record.wall_time = time.time() - t0
+    record.stdout_bytes = len(stdout)
+    record.stderr_bytes = len(stderr)
+    return stdout, stderr, record
+
+
+def _call_conda(extra_args, abspath=True):
+    # call conda with the list of extra arguments, and return the tuple
+    # stdout, stderr
+    stdout, stderr, record = _execute(extra_args, abspath=abspath)
+    _emit(record)
+    return stdout, stderr
+
+
+def _parse_output(extra_args, stdout, stderr):
+    # parse the json output of a conda call, the stderr must be empty
     if stderr.decode().strip():
         raise Exception('conda %r:\nSTDERR:\n%s\nEND' % (extra_args,
                                                          stderr.decode()))
     return json.loads(stdout.decode())
 
 
+# subcommands whose output only depends on the state of the installation,
+# such that concurrent identical calls may share one conda process
+_READ_ONLY_COMMANDS = set(['info', 'list', 'search'])
+
+
+def _is_read_only(extra_args):
+    if not extra_args:
+        return False
+    if extra_args[0] in _READ_ONLY_COMMANDS:
+        return True
+    if extra_args[0] == 'config':
+        return '--get' in extra_args or '--show' in extra_args
+    return '--dry-run' in extra_args
+
+
+class _Flight(object):
+    # a call in flight, see _SingleFlight
+    __slots__ = ('event', 'record', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.record = None
+        # the pristine result, which is never returned itself once other
+        # threads wait for it
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class _SingleFlight(object):
+    """
+    De-duplication of concurrent identical read-only calls: while a call
+    is in flight, threads making the same call wait for it, and share its
+    (parsed) result instead of starting another conda process.  Calls are
+    only shared within a generation of the info cache, such that a call
+    made after a mutation never gets a result from before it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def call(self, key, func):
+        """
+        Return func(), which returns (result, record), or the result of
+        the call with the same key which is in flight.
+        """
+        while True:
+            with self._lock:
+                self.calls += 1
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+                else:
+                    self.coalesced += 1
+                    flight.waiters += 1
+            if leader:
+                try:
+                    flight.result, flight.record = func()
+                except BaseException as e:
+                    flight.error = e
+                    raise
+                finally:
+                    with self._lock:
+                        del self._flights[key]
+                        shared = flight.waiters > 0
+                    # copy the result before any waiter (or the caller) can
+                    # modify it
+                    result = (copy.deepcopy(flight.result) if shared
+                              else flight.result)
+                    flight.event.set()
+                return result
+
+            record = CallRecord(key[0])
+            record.coalesced = True
+            t0 = time.time()
+            try:
+                self._wait(flight, record.argv)
+            except CondaError as e:
+                record.error = type(e).__name__
+                raise
+            else:
+                if flight.error is not None:
+                    record.error = type(flight.error).__name__
+                else:
+                    record.returncode = flight.record.returncode
+            finally:
+                record.wall_time = time.time() - t0
+                _emit(record)
+            if isinstance(flight.error, (CondaTimeoutError,
+                                         CondaCancelledError)):
+                # the deadline or cancellation of the leader does not apply
+                # to this call, so make it again
+                continue
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.result)
+
+    @staticmethod
+    def _wait(flight, extra_args):
+        # wait for flight to land, under the deadline and cancel tokens of
+        # the current scope
+        expires, tokens = _current_scope()
+        while True:
+            timeout = 0.05 if tokens else None
+            if expires is not None:
+                remaining = expires - time.time()
+                if remaining <= 0:
+                    raise CondaTimeoutError('%r: deadline expired' %
+                                            extra_args)
+                timeout = remaining if timeout is None else min(timeout,
+                                                                remaining)
+            if flight.event.wait(timeout):
+                return
+            if any(token.cancelled for token in tokens):
+                raise CondaCancelledError('%r: cancelled' % extra_args)
+
+
+def _call_and_parse(extra_args, abspath=True):
+    if _is_read_only(extra_args):
+        client = _client()
+        key = (tuple(extra_args), abspath, client.info_cache.generation())
+        return client.single_flight.call(
+            key, lambda: _call_and_parse_record(extra_args, abspath))
+    return _call_and_parse_record(extra_args, abspath)[0]
+
+
+def _call_and_parse_record(extra_args, abspath=True):
+    # call conda with the list of extra arguments, and return the tuple
+    # (parsed output, CallRecord)
+    stdout, stderr, record = _execute(extra_args, abspath=abspath)
+    t0 = time.time()
+    try:
+        return _parse_output(extra_args, stdout, stderr), record
+    except Exception as e:
+        record.error = type(e).__name__
+        raise
+    finally:
+        record.decode_time = time.time() - t0
+        _emit(record)
+
+
+class MetricsAggregator(object):
+    """
+    Instrumentation hook (see add_hook and collect_metrics), which collects
+    the CallRecords of conda calls, and summarizes them per subcommand.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records = []
+
+    def __call__(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def by_subcommand(self):
+        """
+        Return a dictionary mapping subcommands to lists of CallRecords.
+        """
+        res = {}
+        with self._lock:
+            for record in self.records:
+                res.setdefault(record.subcommand, []).append(record)
+        return res
+
+    @staticmethod
+    def percentile(values, q):
+        """
+        Return the q-th percentile (0 <= q <= 100) of the list of values,
+        using the nearest-rank method.
+        """
+        if not values:
+            return None
+        values = sorted(values)
+        rank = max(1, int(-(-q * len(values) // 100)))
+        return values[min(rank, len(values)) - 1]
+
+    def summary(self, field='wall_time'):
+        """
+        Return a dictionary mapping each subcommand to a dictionary with
+        the count, total, mean, p50, p90, p99 and max of `field` (e.g.
+        'wall_time', 'spawn_time' or 'decode_time'), the total number of
+        stdout and stderr bytes, the number of errors, and the number of
+        calls which were coalesced with an identical call in flight.
+        """
+        res = {}
+        for subcommand, records in self.by_subcommand().items():
+            values = [getattr(r, field) for r in records
+                      if getattr(r, field) is not None]
+            total = sum(values)
+            res[subcommand] = {
+                'count': len(records),
+                'total': total,
+                'mean': total / len(values) if values else None,
+                'p50': self.percentile(values, 50),
+                'p90': self.percentile(values, 90),
+                'p99': self.percentile(values, 99),
+                'max': max(values) if values else None,
+                'stdout_bytes': sum(r.stdout_bytes for r in records),
+                'stderr_bytes': sum(r.stderr_bytes for r in records),
+                'errors': sum(1 for r in records if r.error),
+                'coalesced': sum(1 for r in records if r.coalesced),
+            }
+        return res
+
+
+@contextmanager
+def collect_metrics(aggregator=None):
+    """
+    Context manager which collects the CallRecords of all conda calls made
+    while the block runs into a MetricsAggregator, which is returned.  The
+    aggregator is registered as a hook of the current client (see
+    add_hook), so calls made by other threads using the same client
+    (including the worker threads of e.g. install_many) are collected too.
+    """
+    if aggregator is None:
+        aggregator = MetricsAggregator()
+    add_hook(aggregator)
+    try:
+        yield aggregator
+    finally:
+        remove_hook(aggregator)
+
+
+def _check_result(cmd_list, result):
+    # raise CondaError when the json result of conda reports an error
+    if 'error' in result:
+        raise CondaError('conda %s: %s' % (" ".join(cmd_list), result['error']))
+    return result
+
+
+def _check_output(cmd_list, out, err):
+    # raise CondaError when conda wrote to stderr, otherwise return stdout
+    if err.decode().strip():
+        raise CondaError('conda %s: %s' % (" ".join(cmd_list), err.decode()))
+    return out
+
+
+class _JSONStreamReader(object):
+    """
+    Incremental reader of JSON text from a binary file object (e.g. the
+    stdout pipe of conda), which only keeps the part of the stream in
+    memory which has not been parsed yet.
+    """
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, fileobj, chunk_size=65536):
+        self._fileobj = fileobj
+        self._chunk_size = chunk_size
+        self._text = codecs.getincrementaldecoder('utf-8')('replace')
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self.bytes_read = 0
+
+    def _fill(self):
+        # read the next chunk into the buffer, return False at EOF
+        if self._eof:
+            return False
+        chunk = self._fileobj.read1(self._chunk_size) if hasattr(
+            self._fileobj, 'read1') else self._fileobj.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            self._buf = self._buf[self._pos:] + self._text.decode(b'', True)
+            self._pos = 0
+            return bool(self._buf)
+        self.bytes_read += len(chunk)
+        self._buf = self._buf[self._pos:] + self._text.decode(chunk)
+        self._pos = 0
+        return True
+
+    def peek(self, skip=' \t\r\n'):
+        """
+        Return the next character which is not in `skip` (without
+        consuming it), or '' at the end of the stream.
+        """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in skip:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        """
+        Consume the next character, which must be one of `chars`, and
+        return it.
+        """
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('expected one of %r, got %r' % (chars, c))
+        self._pos += 1
+        return c
+
+    def value(self):
+        """
+        Parse and return the next complete JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            if end == len(self._buf) and not self._eof:
+                # a number (or literal) might continue in the next chunk
+                if self._buf[end - 1] not in '}]"' and self._fill():
+                    continue
+            self._pos = end
+            return obj
+
+
+class _Stream(object):
+    """
+    A conda process (started like _Invocation), whose stdout is parsed
+    incrementally by `reader`, while stderr is drained in the background
+    (such that conda cannot block on it).  close() must always be called.
+    """
+    def __init__(self, cmd_list, abspath=True):
+        self.cmd_list = cmd_list
+        self.record = CallRecord(cmd_list)
+        self._t0 = time.time()
+        self.invocation = _Invocation(_conda_cmd_list(cmd_list,
+                                                      abspath=abspath))
+        self.invocation.start_watchdog()
+        self.record.spawn_time = self.invocation.spawn_time
+        self.p = self.invocation.p
+        self.reader = _JSONStreamReader(self.p.stdout)
+        self._stderr = []
+        self._thread = threading.Thread(
+            target=lambda: self._stderr.append(self.p.stderr.read()))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stderr(self):
+        return b''.join(self._stderr)
+
+    def _wait(self):
+        self.p.wait()
+        self._thread.join()
+
+    def invalid(self, e):
+        # raise the appropriate error for invalid output of conda
+        self._wait()
+        self.invocation.check(b'', self.stderr())
+        raise Exception('conda %r: invalid output (%s)\nSTDERR:\n%s\nEND'
+                        % (self.cmd_list, e, self.stderr().decode()))
+
+    def finish(self):
+        # wait for conda to exit, after all output was read
+        self._wait()
+        self.invocation.check(b'', self.stderr())
+        if self.stderr().decode().strip():
+            raise Exception('conda %r:\nSTDERR:\n%s\nEND' % (
+                self.cmd_list, self.stderr().decode()))
+
+    def close(self):
+        self.invocation.close()
+        self.p.stdout.close()
+        self._thread.join()
+        self.p.stderr.close()
+        record = self.record
+        record.wall_time = time.time() - self._t0
+        record.stdout_bytes = self.reader.bytes_read
+        record.stderr_bytes = len(self.stderr())
+        record.returncode = self.p.returncode
+        _emit(record)
+
+
 def _setup_install_commands_from_kwargs(kwargs, keys=tuple()):
     cmd_list = []
     if kwargs.get('override_channels', False) and 'channel' not in kwargs:
@@ -78,22 +1040,29 @@ def set_root_prefix(prefix=None):
     Set the prefix to the root environment (default is /opt/anaconda).
     This function should only be called once (right after importing conda_api).
     """
-    global ROOT_PREFIX
-
+    client = _client()
+    with client._lock:
+        client.info_cache.invalidate()
+        client.repodata_index = None
+        client.file_index = None
     if prefix:
-        ROOT_PREFIX = prefix
+        client.root_prefix = prefix
     else:
         # find some conda instance, and then use info to get 'root_prefix'
         info = _call_and_parse(['info', '--json'], abspath=False)
-        ROOT_PREFIX = info['root_prefix']
+        client.root_prefix = info['root_prefix']
 
 
 def get_conda_version():
     """
     return the version of conda being used (invoked) as a string
     """
-    pat = re.compile(r'conda:?\s+(\d+\.\d\S+|unknown)')
     stdout, stderr = _call_conda(['--version'])
+    return _parse_conda_version(stdout, stderr)
+
+
+def _parse_conda_version(stdout, stderr):
+    pat = re.compile(r'conda:?\s+(\d+\.\d\S+|unknown)')
     # argparse outputs version to stderr in Python < 3.4.
     # http://bugs.python.org/issue18920
     m = pat.match(stderr.decode().strip())
@@ -105,13 +1074,84 @@ def get_conda_version():
     return m.group(1)
 
 
-def get_envs():
+def _envs_dirs():
+    # return the list of directories in which conda looks for named
+    # environments, taken from a cached `conda info` when available
+    info = _client().info_cache.peek(True)
+    if info is not None and 'envs_dirs' in info:
+        return list(info['envs_dirs'])
+    res = []
+    for var in 'CONDA_ENVS_PATH', 'CONDA_ENVS_DIRS':
+        if os.getenv(var):
+            res.extend(p for p in os.environ[var].split(os.pathsep) if p)
+    res.append(join(_client().root_prefix, 'envs'))
+    res.append(join(expanduser('~'), '.conda', 'envs'))
+    return res
+
+
+def _same_prefix(a, b):
+    return normcase(normpath(a)) == normcase(normpath(b))
+
+
+def _discover_envs():
+    # find the environments on the filesystem (without invoking conda), by
+    # scanning the envs directories and the ~/.conda/environments.txt
+    # registry for directories containing conda-meta
+    res = []
+    seen = set([normcase(normpath(_client().root_prefix))])
+
+    def add(prefix):
+        key = normcase(normpath(prefix))
+        if key not in seen:
+            seen.add(key)
+            res.append(prefix)
+
+    for envs_dir in _envs_dirs():
+        try:
+            entries = list(os.scandir(envs_dir))
+        except OSError:
+            continue
+        for entry in sorted(entries, key=lambda e: e.name):
+            try:
+                if entry.is_dir() and isdir(join(entry.path, 'conda-meta')):
+                    add(entry.path)
+            except OSError:
+                pass
+
+    registry = join(expanduser('~'), '.conda', 'environments.txt')
+    try:
+        with open(registry) as fi:
+            lines = fi.read().splitlines()
+    except (IOError, OSError):
+        lines = []
+    for line in lines:
+        line = line.strip()
+        if line and isdir(join(line, 'conda-meta')):
+            add(line)
+
+    return res
+
+
+def get_envs(verify=False):
     """
     Return all of the (named) environment (this does not include the root
     environment), as a list of absolute path to their prefixes.
+
+    The environments are found on the filesystem, without invoking conda.
+    When `verify` is True, the result is cross-checked with `conda info`,
+    and the list reported by conda is returned (with a warning) when they
+    differ.
     """
-    info = _call_and_parse(['info', '--json'])
-    return info['envs']
+    envs = _discover_envs()
+    if verify:
+        expected = [prefix for prefix in _cached_info()['envs']
+                    if not _same_prefix(prefix, _client().root_prefix)]
+        if (set(normcase(normpath(p)) for p in envs) !=
+                set(normcase(normpath(p)) for p in expected)):
+            warnings.warn('environments found on filesystem %r differ from '
+                          'conda info %r' % (envs, expected))
+            return expected
+    return envs
 
 
 def get_prefix_envname(name):
@@ -120,7 +1160,7 @@ def get_prefix_envname(name):
     if it cannot be found.
     """
     if name == 'root':
-        return ROOT_PREFIX
+        return _client().root_prefix
     for prefix in get_envs():
         if basename(prefix) == name:
             return prefix
@@ -140,6 +1180,90 @@ def linked(prefix):
     return set(fn[:-5] for fn in os.listdir(meta_dir) if fn.endswith('.json'))
 
 
+class _MetaCache(object):
+    """
+    Parsed conda-meta records of prefixes.  Each record is cached together
+    with the (inode, mtime, size) of its file, and only files whose key
+    changed are read again.  When the conda-meta directory itself did not
+    change, a single stat is all it takes to return the cached records.
+    """
+    # directories modified less than this many seconds ago are always
+    # rescanned, as a file could have changed within the mtime resolution
+    racy_seconds = 2.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirs = {}
+        self.reads = 0
+
+    def scan(self, prefix):
+        # return the dictionary mapping the filenames in the conda-meta
+        # directory of `prefix` to tuples (file_key, record)
+        meta_dir = join(prefix, 'conda-meta')
+        try:
+            st = os.stat(meta_dir)
+        except OSError:
+            return {}
+        dir_key = (st.st_ino, st.st_mtime, st.st_size)
+        with self._lock:
+            entry = self._dirs.get(meta_dir)
+        if (entry is not None and entry[0] == dir_key and
+                time.time() - st.st_mtime > self.racy_seconds):
+            return entry[1]
+
+        old = entry[1] if entry is not None else {}
+        new = {}
+        for e in os.scandir(meta_dir):
+            if not e.name.endswith('.json'):
+                continue
+            try:
+                fst = e.stat()
+            except OSError:
+                continue
+            key = (fst.st_ino, fst.st_mtime, fst.st_size)
+            cached = old.get(e.name)
+            if cached is not None and cached[0] == key:
+                new[e.name] = cached
+                continue
+            try:
+                with open(e.path) as fi:
+                    record = json.load(fi)
+            except (IOError, OSError, ValueError):
+                continue
+            with self._lock:
+                self.reads += 1
+            new[e.name] = (key, record)
+
+        with self._lock:
+            self._dirs[meta_dir] = (dir_key, new)
+        return new
+
+    def invalidate(self, prefix=None):
+        with self._lock:
+            if prefix is None:
+                self._dirs.clear()
+            else:
+                self._dirs.pop(join(prefix, 'conda-meta'), None)
+
+
+_meta_cache = _MetaCache()
+
+
+def linked_records(prefix):
+    """
+    Return a dictionary mapping the canonical names of the linked packages
+    in `prefix` to their records (the parsed conda-meta JSON files, with
+    keys such as version, build, channel, depends and files).
+
+    Records are cached, and only re-read when their file changes.  The
+    returned records are shared, and must not be modified.
+    """
+    if not isdir(prefix):
+        raise Exception('no such directory: %r' % prefix)
+    return dict((fn[:-5], record) for fn, (key, record)
+                in _meta_cache.scan(prefix).items())
+
+
 def split_canonical_name(cname):
     """
     Split a canonical package name into (name, version, build) strings.
@@ -147,26 +1271,1503 @@ def split_canonical_name(cname):
     return tuple(cname.rsplit('-', 2))
 
 
+class _InfoCache(object):
+    """
+    Memoized results of `conda info --json`, one per value of abspath,
+    which expire after `ttl` seconds (None means never).
+    """
+    def __init__(self, ttl=60.0):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data = {}
+        # incremented on each invalidation, such that a result fetched
+        # while an invalidation happened is not stored
+        self._generation = 0
+
+    def get(self, abspath):
+        with self._lock:
+            entry = self._data.get(abspath)
+            if entry is not None and (self.ttl is None or
+                                      time.time() - entry[0] < self.ttl):
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def peek(self, abspath):
+        # like get, but not counted, and ignoring the ttl
+        entry = self._data.get(abspath)
+        return None if entry is None else entry[1]
+
+    def generation(self):
+        return self._generation
+
+    def put(self, abspath, info, generation):
+        with self._lock:
+            if generation == self._generation:
+                self._data[abspath] = (time.time(), info)
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'ttl': self.ttl, 'entries': len(self._data)}
+
+
+# subcommands which (may) change the output of `conda info`
+_MUTATING_COMMANDS = set(['create', 'install', 'update', 'remove',
+                          'uninstall', 'config'])
+
+
+def _is_mutating(extra_args):
+    if not extra_args or extra_args[0] not in _MUTATING_COMMANDS:
+        return False
+    if extra_args[0] == 'config' and '--get' in extra_args:
+        return False
+    return '--dry-run' not in extra_args
+
+
+def _invalidate_after(extra_args):
+    # called after conda was invoked with extra_args
+    if _is_mutating(extra_args):
+        _client().info_cache.invalidate()
+        if extra_args[0] == 'config':
+            _rc_cache.invalidate()
+
+
+def _cached_info(abspath=True):
+    # return the (shared) cached info dictionary, which must not be modified
+    cache = _client().info_cache
+    info = cache.get(abspath)
+    if info is None:
+        generation = cache.generation()
+        info = _call_and_parse(['info', '--json'], abspath=abspath)
+        cache.put(abspath, info, generation)
+    return info
+
+
+def set_info_ttl(ttl):
+    """
+    Set the number of seconds the result of `conda info` is cached
+    (default is 60).  None caches forever, and 0 disables the cache.
+    Calls made through this module which change the configuration or
+    environments always invalidate the cache.
+    """
+    cache = _client().info_cache
+    cache.ttl = ttl
+    cache.invalidate()
+
+
+def refresh():
+    """
+    Invalidate the cached result of `conda info`, e.g. after environments
+    were created or removed outside of this module.
+    """
+    _client().info_cache.invalidate()
+
+
+def info_cache_stats():
+    """
+    Return a dictionary with the number of cache hits and misses of
+    `conda info` results, the ttl and the number of cached entries.
+    """
+    return _client().info_cache.stats()
+
+
 def info(abspath=True):
     """
     Return a dictionary with configuration information.
     No guarantee is made about which keys exist.  Therefore this function
     should only be used for testing and debugging.
+    The result is cached, see set_info_ttl().
     """
-    return _call_and_parse(['info', '--json'], abspath=abspath)
+    return copy.deepcopy(_cached_info(abspath))
 
 
-def package_info(package, abspath=True):
+def _pkgs_dirs():
+    # return the list of package cache directories
+    info = _client().info_cache.peek(True)
+    if info is not None and 'pkgs_dirs' in info:
+        return list(info['pkgs_dirs'])
+    return [join(_client().root_prefix, 'pkgs'),
+            join(expanduser('~'), '.conda', 'pkgs')]
+
+
+_pkgs_lock = threading.Lock()
+_pkgs_cache = {}
+
+
+def _scan_pkgs_dir(pkgs_dir):
+    # return a dictionary mapping the canonical names of the extracted
+    # packages in the package cache `pkgs_dir` to their info/index.json
+    # records.  Extracted packages do not change, so the result is cached
+    # until the directory itself changes.
+    try:
+        st = os.stat(pkgs_dir)
+    except OSError:
+        return {}
+    dir_key = (st.st_ino, st.st_mtime)
+    with _pkgs_lock:
+        entry = _pkgs_cache.get(pkgs_dir)
+    if entry is not None and entry[0] == dir_key:
+        return entry[1]
+
+    old = entry[1] if entry is not None else {}
+    res = {}
+    for e in os.scandir(pkgs_dir):
+        if e.name in old:
+            res[e.name] = old[e.name]
+            continue
+        try:
+            with open(join(e.path, 'info', 'index.json')) as fi:
+                res[e.name] = json.load(fi)
+        except (IOError, OSError, ValueError):
+            pass
+    with _pkgs_lock:
+        _pkgs_cache[pkgs_dir] = (dir_key, res)
+    return res
+
+
+def _local_package_index():
+    # return a dictionary mapping canonical names to package records, of
+    # all packages which are linked into the root or any named environment,
+    # or extracted in a package cache
+    index = {}
+    for pkgs_dir in _pkgs_dirs():
+        index.update(_scan_pkgs_dir(pkgs_dir))
+    for prefix in [_client().root_prefix] + get_envs():
+        for fn, (key, record) in _meta_cache.scan(prefix).items():
+            index.setdefault(fn[:-5], record)
+    return index
+
+
+# keys of conda-meta records which are not part of the package index
+_META_ONLY_KEYS = ('files', 'paths_data', 'link', 'extracted_package_dir',
+                   'package_tarball_full_path')
+
+
+def _local_package_info(index, package):
+    # return the list of records for `package` (a canonical name, or a
+    # package filename) from the local index, or None when not found
+    for ext in '.tar.bz2', '.conda':
+        if package.endswith(ext):
+            dist = package[:-len(ext)]
+            break
+    else:
+        dist = package
+    record = index.get(dist)
+    if record is None:
+        return None
+    # the record is shared with the cache, which callers must not modify
+    res = dict((k, copy.deepcopy(v)) for k, v in record.items()
+               if k not in _META_ONLY_KEYS)
+    res.setdefault('fn', dist + '.tar.bz2')
+    return [res]
+
+
+def package_info(package, abspath=True, local=True):
     """
     Return a dictionary with package information.
+
+    When `package` is the canonical name (or filename) of a package which
+    is linked into an environment or extracted in the package cache, the
+    information is read from the local metadata, unless local=False.
+    Otherwise, conda is invoked.
+    """
+    return package_info_many([package], abspath=abspath, local=local)
+
+
+def package_info_many(pkgs, abspath=True, local=True):
+    """
+    Return a dictionary with the package information of all `pkgs`,
+    see package_info().  Packages which are not found locally are looked up
+    using a single conda invocation.
+    """
+    res = {}
+    missing = []
+    index = _local_package_index() if local else {}
+    for package in pkgs:
+        records = _local_package_info(index, package)
+        if records is None:
+            missing.append(package)
+        else:
+            res[package] = records
+    if missing:
+        res.update(_call_and_parse(['info'] + missing + ['--json'],
+                                   abspath=abspath))
+    return res
+
+
+class VersionOrder(object):
+    """
+    Sort key implementing conda's version ordering, e.g.
+
+        1.0dev < 1.0a1 < 1.0b < 1.0rc1 < 1.0 == 1.0.0 < 1.0post1 < 1.1
+
+    A version is split into an optional epoch ('N!'), the version proper
+    and an optional local version ('+...').  Both are split at '.' (and
+    '_') into components, and each component into runs of digits and
+    letters.  Integers compare numerically, and above strings, which
+    compare lexicographically, except that 'dev' is below and 'post' above
+    all others.  Components starting with a letter are preceded by a 0,
+    such that 1.0.post1 < 1.0.1.  Missing components compare as 0.
+    """
+    __slots__ = ('version', '_key')
+
+    _component_pat = re.compile(r'\d+|[^\d]+')
+
+    def __init__(self, version):
+        self.version = version
+        vstr = str(version).strip().lower()
+        epoch = 0
+        if '!' in vstr:
+            epoch_str, vstr = vstr.split('!', 1)
+            epoch = int(epoch_str) if epoch_str.isdigit() else 0
+        local = ''
+        if '+' in vstr:
+            vstr, local = vstr.split('+', 1)
+        self._key = ([[epoch]] + self._split(vstr), self._split(local))
+
+    @classmethod
+    def _split(cls, vstr):
+        if not vstr:
+            return []
+        if '-' in vstr and '_' not in vstr:
+            vstr = vstr.replace('-', '_')
+        res = []
+        for part in vstr.replace('_', '.').split('.'):
+            comps = cls._component_pat.findall(part)
+            # components starting with a string (including 'post') get a
+            # leading 0, like in conda
+            if not comps or not comps[0].isdigit():
+                comps.insert(0, '0')
+            for i, c in enumerate(comps):
+                if c.isdigit():
+                    comps[i] = int(c)
+                elif c == 'post':
+                    comps[i] = float('inf')
+                elif c == 'dev':
+                    # upper case sorts below all other (lower case) strings
+                    comps[i] = 'DEV'
+            res.append(comps)
+        return res
+
+    @staticmethod
+    def _cmp_lists(v1, v2):
+        for i in range(max(len(v1), len(v2))):
+            t1 = v1[i] if i < len(v1) else []
+            t2 = v2[i] if i < len(v2) else []
+            for j in range(max(len(t1), len(t2))):
+                c1 = t1[j] if j < len(t1) else 0
+                c2 = t2[j] if j < len(t2) else 0
+                if c1 == c2:
+                    continue
+                s1, s2 = isinstance(c1, str), isinstance(c2, str)
+                if s1 != s2:
+                    # strings sort below numbers
+                    return -1 if s1 else 1
+                return -1 if c1 < c2 else 1
+        return 0
+
+    @classmethod
+    def sort_keys(cls, versions):
+        """
+        Return a dictionary mapping each of the version strings to a tuple,
+        such that the tuples sort like the versions.  Sorting by these keys
+        is much faster than sorting VersionOrder objects.
+        """
+        orders = dict((v, cls(v)) for v in set(versions))
+        # pad all versions to the same shape, such that the comparison of
+        # plain tuples does what _cmp_lists does
+        shapes = ([], [])
+        for vo in orders.values():
+            for shape, parts in zip(shapes, vo._key):
+                for i, part in enumerate(parts):
+                    if i == len(shape):
+                        shape.append(0)
+                    shape[i] = max(shape[i], len(part))
+        res = {}
+        for v, vo in orders.items():
+            key = []
+            for shape, parts in zip(shapes, vo._key):
+                for i, n in enumerate(shape):
+                    part = parts[i] if i < len(parts) else []
+                    for j in range(n):
+                        c = part[j] if j < len(part) else 0
+                        key.append((0, c) if isinstance(c, str) else (1, c))
+            res[v] = tuple(key)
+        return res
+
+    def _cmp(self, other):
+        return (self._cmp_lists(self._key[0], other._key[0]) or
+                self._cmp_lists(self._key[1], other._key[1]))
+
+    def __eq__(self, other):
+        return self._cmp(other) == 0
+
+    def __ne__(self, other):
+        return self._cmp(other) != 0
+
+    def __lt__(self, other):
+        return self._cmp(other) < 0
+
+    def __le__(self, other):
+        return self._cmp(other) <= 0
+
+    def __gt__(self, other):
+        return self._cmp(other) > 0
+
+    def __ge__(self, other):
+        return self._cmp(other) >= 0
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'VersionOrder(%r)' % self.version
+
+
+def _record_key(record):
+    # sort key of package records: by version, then build number
+    return (VersionOrder(record.get('version', '')),
+            record.get('build_number', 0))
+
+
+class _VersionSpec(object):
+    # a conda version specification, e.g. '>=1.7,<2|1.6.*'
+
+    _op_pat = re.compile(r'^(==|!=|>=|<=|~=|>|<|=)?\s*(.*)$')
+
+    def __init__(self, spec):
+        self.spec = spec
+        self._alternatives = [[self._term(t.strip()) for t in alt.split(',')]
+                              for alt in spec.split('|')]
+
+    def _term(self, term):
+        op, version = self._op_pat.match(term).groups()
+        if op == '=':
+            # fuzzy match, '=1.7' means '1.7*'
+            op, version = None, version.rstrip('*') + '*'
+        if op is None and version.endswith('*'):
+            prefix = version.rstrip('*').rstrip('.')
+            if not prefix:
+                return lambda v: True
+            return lambda v: (v == prefix or v.startswith(prefix) and
+                              (prefix[-1] in '._' or
+                               not v[len(prefix)].isdigit() or
+                               not prefix[-1].isdigit()))
+        if op is None or op == '==':
+            if op is None and '*' in version:
+                return lambda v: fnmatch.fnmatchcase(v, version)
+            vo = VersionOrder(version)
+            return lambda v: v == version or VersionOrder(v) == vo
+        vo = VersionOrder(version)
+        if op == '!=':
+            return lambda v: VersionOrder(v) != vo
+        if op == '>=':
+            return lambda v: VersionOrder(v) >= vo
+        if op == '<=':
+            return lambda v: VersionOrder(v) <= vo
+        if op == '>':
+            return lambda v: VersionOrder(v) > vo
+        if op == '<':
+            return lambda v: VersionOrder(v) < vo
+        # op == '~=', compatible release
+        prefix = version.rsplit('.', 1)[0]
+        return lambda v: (VersionOrder(v) >= vo and
+                          (v == prefix or v.startswith(prefix + '.')))
+
+    def match(self, version):
+        return any(all(t(version) for t in alt) for alt in self._alternatives)
+
+
+class MatchSpec(object):
+    """
+    A conda package specification, such as 'numpy', 'numpy 1.7*',
+    'numpy 1.7.1 py27_0', 'numpy=1.7', 'numpy=1.7.1=py27_0' or
+    'numpy >=1.7,<2', which can be matched against package records.
+    """
+    _name_pat = re.compile(r'^([^=<>!~\s]+)\s*(.*)$')
+
+    def __init__(self, spec):
+        self.spec = spec
+        parts = spec.split()
+        version = build = None
+        if len(parts) > 1 and not parts[1][0] in '=<>!~' or len(parts) > 2:
+            # 'name version [build]'
+            self.name = parts[0]
+            version = parts[1]
+            if len(parts) > 2:
+                build = parts[2]
+        else:
+            self.name, rest = self._name_pat.match(spec.strip()).groups()
+            rest = rest.replace(' ', '')
+            if rest.startswith('=') and not rest.startswith('=='):
+                fields = rest[1:].split('=')
+                version = '=' + fields[0]
+                if len(fields) > 1:
+                    build = fields[1]
+            elif rest:
+                version = rest
+        self.version = _VersionSpec(version) if version else None
+        self.build = build
+
+    def match(self, record):
+        if self.name != record.get('name'):
+            if not ('*' in self.name and
+                    fnmatch.fnmatchcase(record.get('name', ''), self.name)):
+                return False
+        if self.version and not self.version.match(record.get('version', '')):
+            return False
+        if self.build and not fnmatch.fnmatchcase(record.get('build', ''),
+                                                  self.build):
+            return False
+        return True
+
+    def __repr__(self):
+        return 'MatchSpec(%r)' % self.spec
+
+
+class RepodataIndex(object):
+    """
+    In-memory index of the cached repodata files of conda (the *.json
+    files in the cache directory of the package caches), which answers
+    search queries without invoking conda.  Files are only read again
+    when their mtime (or size) changes.
+
+    `cache_dirs` is the list of directories containing the repodata files
+    (default is the 'cache' directory of each package cache).
+    """
+    def __init__(self, cache_dirs=None):
+        self.cache_dirs = cache_dirs
+        self.client = _client()
+        self._lock = threading.Lock()
+        self._files = {}
+        self.by_name = {}
+        self.by_feature = {}
+        self.loads = 0
+
+    def _cache_dirs(self):
+        if self.cache_dirs is not None:
+            return self.cache_dirs
+        with self.client.use():
+            return [join(d, 'cache') for d in _pkgs_dirs()]
+
+    @staticmethod
+    def _load_file(path):
+        # return the list of package records from a cached repodata file
+        with open(path) as fi:
+            data = json.load(fi)
+        if not isinstance(data, dict) or not ('packages' in data or
+                                              'packages.conda' in data):
+            return []
+        url = data.get('_url')
+        if url is None:
+            # newer conda keeps the state in a separate file
+            try:
+                with open(path[:-5] + '.info.json') as fi:
+                    url = json.load(fi).get('url')
+            except (IOError, OSError, ValueError):
+                pass
+        url = (url or '').rstrip('/')
+        subdir = (data.get('info') or {}).get('subdir') or basename(url)
+        channel = url.rsplit('/', 1)[0] if url else None
+        records = []
+        for key in 'packages', 'packages.conda':
+            for fn, record in (data.get(key) or {}).items():
+                record['fn'] = fn
+                record.setdefault('subdir', subdir)
+                if channel:
+                    record['channel'] = channel
+                    record['url'] = '%s/%s' % (url, fn)
+                records.append(record)
+        return records
+
+    def reload(self):
+        """
+        Read the repodata files which were added or changed since the last
+        call, and rebuild the index when anything changed.
+        Returns True when the index changed.
+        """
+        with self._lock:
+            stats = {}
+            for cache_dir in self._cache_dirs():
+                try:
+                    entries = list(os.scandir(cache_dir))
+                except OSError:
+                    continue
+                for e in entries:
+                    if (not e.name.endswith('.json') or
+                            e.name.endswith('.info.json')):
+                        continue
+                    try:
+                        st = e.stat()
+                    except OSError:
+                        continue
+                    stats[e.path] = (st.st_mtime, st.st_size)
+
+            changed = set(self._files) != set(stats)
+            for path, key in stats.items():
+                entry = self._files.get(path)
+                if entry is not None and entry[0] == key:
+                    continue
+                try:
+                    records = self._load_file(path)
+                except (IOError, OSError, ValueError):
+                    records = []
+                self.loads += 1
+                self._files[path] = (key, records)
+                changed = True
+            for path in set(self._files) - set(stats):
+                del self._files[path]
+
+            if changed:
+                self._build()
+            return changed
+
+    def _build(self):
+        by_name = {}
+        by_feature = {}
+        for key, records in self._files.values():
+            for record in records:
+                by_name.setdefault(record.get('name'), []).append(record)
+                for k in 'features', 'track_features':
+                    value = record.get(k) or ''
+                    if not isinstance(value, str):
+                        value = ' '.join(value)
+                    for feature in value.replace(',', ' ').split():
+                        by_feature.setdefault(feature, []).append(record)
+        keys = VersionOrder.sort_keys(r.get('version', '') for records
+                                      in by_name.values() for r in records)
+        for records in by_name.values():
+            records.sort(key=lambda r: (keys[r.get('version', '')],
+                                        r.get('build_number', 0)))
+        self.by_name = by_name
+        self.by_feature = by_feature
+
+    def __len__(self):
+        return sum(len(records) for records in self.by_name.values())
+
+    def records(self, name):
+        """
+        Return the list of records of package `name` (sorted by version).
+        """
+        self.reload()
+        return list(self.by_name.get(name, []))
+
+    def features(self, feature):
+        """
+        Return the list of records which have or track `feature`.
+        """
+        self.reload()
+        return list(self.by_feature.get(feature, []))
+
+    def search(self, regex=None, spec=None, platform=None, outdated=False,
+               prefix=None, canonical=False):
+        """
+        Search for packages, like `conda search --json`.  Returns a
+        dictionary mapping package names to lists of records (or a list of
+        canonical names when `canonical` is True).  With `outdated`, only
+        records newer than the packages linked into `prefix` are returned.
+        """
+        if regex and spec:
+            raise TypeError('conda search: only one of regex or spec allowed')
+        if outdated and not prefix:
+            raise TypeError('conda search: outdated requires a prefix')
+        self.reload()
+
+        ms = MatchSpec(spec) if spec else None
+        if ms is not None and '*' not in ms.name:
+            names = [ms.name] if ms.name in self.by_name else []
+        elif regex:
+            pat = re.compile(regex, re.I)
+            names = [n for n in self.by_name if n and pat.search(n)]
+        else:
+            names = list(self.by_name)
+
+        installed = {}
+        if outdated:
+            for record in linked_records(prefix).values():
+                installed[record.get('name')] = record
+
+        res = {}
+        for name in sorted(n for n in names if n):
+            if outdated and name not in installed:
+                continue
+            records = self.by_name[name]
+            if ms is not None:
+                records = [r for r in records if ms.match(r)]
+            if platform:
+                records = [r for r in records
+                           if r.get('subdir') in (platform, 'noarch')]
+            if outdated:
+                current = _record_key(installed[name])
+                records = [r for r in records if _record_key(r) > current]
+            if records:
+                res[name] = records
+
+        if canonical:
+            return sorted(r['fn'].rsplit('.tar.bz2', 1)[0].rsplit('.conda', 1)[0]
+                          for records in res.values() for r in records)
+        return res
+
+
+def repodata_index():
+    """
+    Return the RepodataIndex of the package caches of the root prefix.
+    """
+    client = _client()
+    with client._lock:
+        if client.repodata_index is None:
+            client.repodata_index = RepodataIndex()
+        return client.repodata_index
+
+
+OutdatedPackage = namedtuple('OutdatedPackage', 'prefix name version build '
+                             'latest_version latest_build')
+OutdatedPackage.__doc__ = """
+A package linked into the environment `prefix` (as `version` and `build`),
+of which the newer `latest_version` and `latest_build` is available, see
+outdated_report().
+"""
+
+
+def outdated_report(prefixes=None, index=None):
+    """
+    Return the sorted list of OutdatedPackages of the environments
+    `prefixes` (default is the root prefix and all environments), i.e. the
+    linked packages for which the cached repodata (see RepodataIndex)
+    contains a newer version (or build number) for the same platform.
+    The repodata is loaded once, the conda-meta records are read without
+    invoking conda, and each version is parsed only once.
+    """
+    if prefixes is None:
+        prefixes = [_client().root_prefix] + get_envs()
+    if index is None:
+        index = repodata_index()
+    index.reload()
+    by_name = index.by_name
+
+    # the newest record of each (name, subdir), records of the same subdir
+    # or noarch are candidates
+    latest = {}
+
+    def newest(name, subdir):
+        key = (name, subdir)
+        if key not in latest:
+            latest[key] = next(
+                (r for r in reversed(by_name.get(name, ()))
+                 if subdir is None or r.get('subdir') in (subdir, 'noarch')),
+                None)
+        return latest[key]
+
+    pairs = []
+    for prefix in prefixes:
+        for record in linked_records(prefix).values():
+            name = record.get('name')
+            if name not in by_name:
+                continue
+            candidate = newest(name, record.get('subdir'))
+            if candidate is not None:
+                pairs.append((prefix, record, candidate))
+
+    keys = VersionOrder.sort_keys(r.get('version', '') for pair in pairs
+                                  for r in pair[1:])
+
+    def record_key(record):
+        return keys[record.get('version', '')], record.get('build_number', 0)
+
+    res = [OutdatedPackage(prefix, record.get('name'), record.get('version'),
+                           record.get('build'), candidate.get('version'),
+                           candidate.get('build'))
+           for prefix, record, candidate in pairs
+           if record_key(candidate) > record_key(record)]
+    res.sort()
+    return res
+
+
+PackageRef = namedtuple('PackageRef', 'prefix name version build')
+PackageRef.__doc__ = """
+A package linked into the environment `prefix`, see FileIndex.
+"""
+
+_FILE_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    prefix TEXT NOT NULL,
+    fn TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    build TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    UNIQUE (prefix, fn)
+);
+CREATE INDEX IF NOT EXISTS records_name ON records (name);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT NOT NULL,
+    record INTEGER NOT NULL REFERENCES records (id)
+);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+CREATE INDEX IF NOT EXISTS files_record ON files (record);
+"""
+
+
+class FileIndex(object):
+    """
+    Persistent index (an SQLite database) of the packages linked into
+    environments, and the files they own, built from the conda-meta records
+    of the prefixes.  The database is only updated by update(), which reads
+    the conda-meta files whose (mtime, size) changed, in parallel over the
+    prefixes.
+
+    `path` is the database file (default is conda_api_files.sqlite in the
+    'cache' directory of the package cache of the root prefix), ':memory:'
+    keeps the index in memory.
+    """
+    def __init__(self, path=None):
+        import sqlite3
+
+        self.client = _client()
+        if path is None:
+            cache_dir = join(self.client.root_prefix, 'pkgs', 'cache')
+            if not isdir(cache_dir):
+                os.makedirs(cache_dir)
+            path = join(cache_dir, 'conda_api_files.sqlite')
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(_FILE_INDEX_SCHEMA)
+        self.reads = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    @staticmethod
+    def _scan(prefix, known):
+        # return (changed, removed) for the conda-meta directory of prefix,
+        # where changed is the list of (fn, mtime, size, record) of the new
+        # and changed files, and removed is the set of filenames of known
+        # (a dict mapping filenames to (mtime, size)) which are gone
+        changed = []
+        present = set()
+        for fn, mtime, size in _file_keys(join(prefix, 'conda-meta'), '.json'):
+            present.add(fn)
+            if known.get(fn) == (mtime, size):
+                continue
+            try:
+                with open(join(prefix, 'conda-meta', fn)) as fi:
+                    record = json.load(fi)
+            except (IOError, OSError, ValueError):
+                continue
+            changed.append((fn, mtime, size, record))
+        return changed, set(known) - present
+
+    def update(self, prefixes=None, max_workers=4):
+        """
+        Bring the index up to date for `prefixes` (default is the root
+        prefix and all environments, in which case prefixes which no longer
+        exist are dropped from the index).  Returns the number of conda-meta
+        files which were (re)read.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if prefixes is None:
+            with self.client.use():
+                prefixes = [self.client.root_prefix] + get_envs()
+            complete = True
+        else:
+            complete = False
+        prefixes = [normpath(prefix) for prefix in prefixes]
+
+        known = {}
+        with self._lock:
+            for prefix, fn, mtime, size in self._db.execute(
+                    'SELECT prefix, fn, mtime, size FROM records'):
+                known.setdefault(prefix, {})[fn] = (mtime, size)
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            scans = list(executor.map(
+                lambda prefix: self._scan(prefix, known.get(prefix, {})),
+                prefixes))
+
+        n = 0
+        with self._lock, self._db:
+            db = self._db
+            if complete:
+                for prefix in set(known) - set(prefixes):
+                    self._delete(prefix)
+            for prefix, (changed, removed) in zip(prefixes, scans):
+                for fn in removed:
+                    self._delete(prefix, fn)
+                for fn, mtime, size, record in changed:
+                    self._delete(prefix, fn)
+                    name, version, build = split_canonical_name(fn[:-5])
+                    cur = db.execute(
+                        'INSERT INTO records (prefix, fn, name, version, '
+                        'build, mtime, size) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (prefix, fn, record.get('name', name),
+                         record.get('version', version),
+                         record.get('build', build), mtime, size))
+                    db.executemany(
+                        'INSERT INTO files (path, record) VALUES (?, ?)',
+                        ((path.replace('\\', '/'), cur.lastrowid)
+                         for path in record.get('files', [])))
+                    n += 1
+            self.reads += n
+        return n
+
+    def _delete(self, prefix, fn=None):
+        # remove the records of prefix (only fn when given) from the index
+        query = 'SELECT id FROM records WHERE prefix = ?'
+        args = (prefix,)
+        if fn is not None:
+            query += ' AND fn = ?'
+            args += (fn,)
+        ids = [(row[0],) for row in self._db.execute(query, args)]
+        self._db.executemany('DELETE FROM files WHERE record = ?', ids)
+        self._db.executemany('DELETE FROM records WHERE id = ?', ids)
+
+    def _refs(self, where, args):
+        with self._lock:
+            return [PackageRef(*row) for row in self._db.execute(
+                'SELECT prefix, name, version, build FROM records ' + where +
+                ' ORDER BY prefix, name', args)]
+
+    def prefixes(self):
+        """
+        Return the sorted list of the indexed prefixes.
+        """
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                'SELECT DISTINCT prefix FROM records ORDER BY prefix')]
+
+    def owners(self, path):
+        """
+        Return the list of PackageRefs of the packages owning the file
+        `path`, which is either an absolute path (into some prefix), or a
+        path relative to the prefixes (e.g. 'bin/python'), in which case all
+        environments are searched.
+        """
+        if not os.path.isabs(path):
+            return self._refs(
+                'WHERE id IN (SELECT record FROM files WHERE path = ?)',
+                (path.replace(os.sep, '/'),))
+        path = normpath(path)
+        res = []
+        for prefix in self.prefixes():
+            if path.startswith(prefix + os.sep):
+                rel = path[len(prefix) + 1:].replace(os.sep, '/')
+                res.extend(self._refs(
+                    'WHERE prefix = ? AND id IN '
+                    '(SELECT record FROM files WHERE path = ?)',
+                    (prefix, rel)))
+        return res
+
+    def find(self, spec):
+        """
+        Return the list of PackageRefs of the packages matching the
+        MatchSpec `spec` (e.g. 'openssl 1.0*') in all environments.
+        """
+        ms = MatchSpec(spec)
+        where = 'WHERE name GLOB ?' if '*' in ms.name else 'WHERE name = ?'
+        return [ref for ref in self._refs(where, (ms.name,))
+                if ms.match(ref._asdict())]
+
+    def packages(self, prefix):
+        """
+        Return the list of PackageRefs of the packages in prefix.
+        """
+        return self._refs('WHERE prefix = ?', (normpath(prefix),))
+
+    def files(self, prefix, name):
+        """
+        Return the sorted list of files (relative to prefix) owned by the
+        package `name` in prefix.
+        """
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                'SELECT path FROM files JOIN records ON record = id '
+                'WHERE prefix = ? AND name = ? ORDER BY path',
+                (normpath(prefix), name))]
+
+
+def file_index(update=True):
+    """
+    Return the FileIndex of the root prefix, which is brought up to date
+    (for all environments) unless update is False.
+    """
+    client = _client()
+    with client._lock:
+        if client.file_index is None:
+            client.file_index = FileIndex()
+        index = client.file_index
+    if update:
+        index.update()
+    return index
+
+
+class DiskUsage(object):
     """
-    return _call_and_parse(['info', package, '--json'], abspath=abspath)
+    Disk usage of an environment or package cache, or of one package in
+    it: `apparent` is the total size of its files (counting each path),
+    `unique` the size of the files which are not hardlinked from any other
+    scanned location (i.e. what removing it would free), and `shared` the
+    size of the files which are (each inode is counted once).  `files` is
+    the number of files, and `packages` maps the canonical names of the
+    packages (None for files not owned by any package) to their DiskUsage.
+    """
+    __slots__ = ('apparent', 'unique', 'shared', 'files', 'packages')
+
+    def __init__(self):
+        self.apparent = 0
+        self.unique = 0
+        self.shared = 0
+        self.files = 0
+        self.packages = {}
+
+    def __repr__(self):
+        return '<DiskUsage apparent=%d unique=%d shared=%d>' % (
+            self.apparent, self.unique, self.shared)
+
+
+_usage_lock = threading.Lock()
+_usage_cache = {}
+
+
+def _usage_key(location, is_prefix):
+    # return the key which changes when the packages in location change
+    try:
+        st = os.stat(location)
+    except OSError:
+        return None
+    key = [st.st_ino, st.st_mtime]
+    if is_prefix:
+        key.append(_file_keys(join(location, 'conda-meta'), '.json'))
+    return key
+
+
+def _scan_usage(location, is_prefix, exclude):
+    # walk location (skipping the directories in exclude, e.g. the envs and
+    # pkgs directories of the root prefix), and return the list of
+    # (package, dev, inode, size) of its regular files.  The result is
+    # cached until the conda-meta records of the prefix, or the entries of
+    # the package cache, change.
+    key = (_usage_key(location, is_prefix), exclude)
+    with _usage_lock:
+        entry = _usage_cache.get(location)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+
+    owners = {}
+    if is_prefix:
+        for fn, (fkey, record) in _meta_cache.scan(location).items():
+            for path in record.get('files', ()):
+                owners[path.replace('\\', '/')] = fn[:-5]
+    res = []
+    stack = [('', location)]
+    while stack:
+        rel_dir, path = stack.pop()
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            continue
+        for e in entries:
+            rel = rel_dir + e.name
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    if e.path not in exclude:
+                        stack.append((rel + '/', e.path))
+                    continue
+                if not e.is_file(follow_symlinks=False):
+                    continue
+                st = e.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if is_prefix:
+                package = owners.get(rel)
+            else:
+                # the files of a package cache belong to the extracted
+                # package (or tarball) they are in
+                package = rel.split('/', 1)[0]
+            res.append((package, st.st_dev, st.st_ino, st.st_size))
+    with _usage_lock:
+        _usage_cache[location] = (key, res)
+    return res
+
+
+def disk_usage(prefixes=None, pkgs_dirs=None, max_workers=4):
+    """
+    Analyze the disk usage of environments, taking into account that conda
+    hardlinks files from the package caches into the environments.
+    `prefixes` defaults to the root prefix and all environments, and
+    `pkgs_dirs` to the package caches.  All these locations are walked in
+    parallel, and files are de-duplicated by (st_dev, st_ino).  Returns a
+    dictionary mapping each prefix and package cache to its DiskUsage.
+
+    A location is only walked again when its conda-meta records (or, for
+    package caches, its entries) changed since the last call, so changes
+    to files not managed by conda may be missed by repeated calls.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if prefixes is None:
+        prefixes = [_client().root_prefix] + get_envs()
+    if pkgs_dirs is None:
+        pkgs_dirs = _pkgs_dirs()
+    locations = ([(normpath(p), True) for p in prefixes] +
+                 [(normpath(p), False) for p in pkgs_dirs if isdir(p)])
+    # locations nested in other locations are not part of them
+    nested = set(join(loc, name) for loc, is_prefix in locations
+                 for name in ('envs', 'pkgs'))
+    nested.update(loc for loc, is_prefix in locations)
+
+    def scan(location):
+        exclude = frozenset(p for p in nested
+                            if p.startswith(location[0] + os.sep))
+        return _scan_usage(location[0], location[1], exclude)
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        scans = list(executor.map(scan, locations))
+
+    # the index of the location each inode is found in, or -1 when it is
+    # found in several locations
+    inodes = {}
+    for i, files in enumerate(scans):
+        for package, dev, ino, size in files:
+            if inodes.setdefault((dev, ino), i) != i:
+                inodes[dev, ino] = -1
+
+    res = {}
+    for i, files in enumerate(scans):
+        usage = res[locations[i][0]] = DiskUsage()
+        seen = set()
+        for package, dev, ino, size in files:
+            pkg_usage = usage.packages.get(package)
+            if pkg_usage is None:
+                pkg_usage = usage.packages[package] = DiskUsage()
+            for u in usage, pkg_usage:
+                u.apparent += size
+                u.files += 1
+            if (dev, ino) in seen:
+                continue
+            seen.add((dev, ino))
+            if inodes[dev, ino] == i:
+                usage.unique += size
+                pkg_usage.unique += size
+            else:
+                usage.shared += size
+                pkg_usage.shared += size
+    return res
+
+
+WatchEvent = namedtuple('WatchEvent', 'prefix added removed')
+WatchEvent.__doc__ = """
+A change of the environment `prefix`, reported by Watcher: `added` and
+`removed` are the sorted lists of the canonical names of the packages which
+were linked and unlinked.  When an environment is created (removed), all its
+packages are added (removed).
+"""
+
+# inotify constants, see <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_MOVE_SELF = 0x800
+_IN_IGNORED = 0x8000
+_IN_ONLYDIR = 0x1000000
+_IN_MASK = (_IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE |
+            _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR)
+
+
+class _Inotify(object):
+    """
+    Minimal ctypes binding of the Linux inotify API.
+    """
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._paths = {}
+        self._wds = {}
+
+    def watch(self, path):
+        if path in self._paths:
+            return
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), _IN_MASK)
+        if wd >= 0:
+            self._paths[path] = wd
+            self._wds[wd] = path
+
+    def unwatch(self, path):
+        wd = self._paths.pop(path, None)
+        if wd is not None:
+            self._wds.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def watched(self):
+        return set(self._paths)
+
+    def read(self, timeout):
+        # wait up to timeout seconds for events, and return the set of the
+        # watched paths which had events
+        import select
+        import struct
+
+        res = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return res
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return res
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, pos)
+                pos += 16 + length
+                path = self._wds.get(wd)
+                if path is None:
+                    continue
+                res.add(path)
+                if mask & _IN_IGNORED:
+                    # the watched directory is gone
+                    del self._wds[wd]
+                    self._paths.pop(path, None)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """
+    Watch environments for packages being linked or unlinked, and for
+    environments being created or removed, and report them as WatchEvents.
+    `prefixes` is the list of prefixes to watch (default is the root
+    prefix and all environments, including environments created later).
+
+    On Linux, inotify is used, otherwise (or when use_inotify is False) the
+    conda-meta directories are polled every `interval` seconds, which only
+    costs a stat of each directory when nothing changed.  Events also
+    invalidate the caches of this module for the changed prefixes.
+    """
+    def __init__(self, prefixes=None, interval=1.0, use_inotify=True):
+        self.fixed = (None if prefixes is None else
+                      [normpath(prefix) for prefix in prefixes])
+        self.interval = interval
+        self.client = _client()
+        self._inotify = None
+        if use_inotify and sys.platform.startswith('linux'):
+            try:
+                self._inotify = _Inotify()
+            except (OSError, AttributeError):
+                pass
+        self._thread = None
+        self._stop = threading.Event()
+        # map prefixes to (conda-meta key, set of canonical names)
+        self._state = {}
+        self._envs_key = None
+        self._check(None, True)
+
+    @property
+    def uses_inotify(self):
+        return self._inotify is not None
+
+    def _envs_locations(self):
+        # the envs directories and the directory of environments.txt
+        return [normpath(d) for d in _envs_dirs()] + [
+            join(expanduser('~'), '.conda')]
+
+    def _discover(self):
+        if self.fixed is not None:
+            return self.fixed
+        return [normpath(_client().root_prefix)] + [normpath(p) for p in
+                                          _discover_envs()]
+
+    @staticmethod
+    def _scan(prefix):
+        # return (conda-meta key, set of canonical names), or None when the
+        # prefix is not an environment
+        meta_dir = join(prefix, 'conda-meta')
+        try:
+            st = os.stat(meta_dir)
+            names = set(fn[:-5] for fn in os.listdir(meta_dir)
+                        if fn.endswith('.json'))
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size), names
+
+    @staticmethod
+    def _meta_key(prefix):
+        try:
+            st = os.stat(join(prefix, 'conda-meta'))
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime, st.st_size
+
+    def _check(self, dirty, rediscover):
+        with self.client.use():
+            return self._compare(dirty, rediscover)
+
+    def _compare(self, dirty, rediscover):
+        # rescan the prefixes in dirty (all prefixes whose conda-meta
+        # directory changed when None), and the list of environments when
+        # rediscover is True (or the envs directories changed), and return
+        # the list of WatchEvents
+        if self.fixed is None:
+            key = self._locations_key()
+            rediscover = rediscover or key != self._envs_key
+            self._envs_key = key
+        if rediscover:
+            prefixes = self._discover()
+        else:
+            prefixes = self.fixed or list(self._state)
+
+        events = []
+        envs_changed = False
+        for prefix in set(self._state) - set(prefixes):
+            events.append(WatchEvent(prefix, [],
+                                     sorted(self._state.pop(prefix)[1])))
+            envs_changed = True
+        for prefix in prefixes:
+            old = self._state.get(prefix)
+            if old is not None:
+                if dirty is not None and prefix not in dirty:
+                    continue
+                if dirty is None and old[0] == self._meta_key(prefix):
+                    continue
+            new = self._scan(prefix)
+            if new is None:
+                if old is not None:
+                    del self._state[prefix]
+                    events.append(WatchEvent(prefix, [], sorted(old[1])))
+                    envs_changed = True
+                continue
+            self._state[prefix] = new
+            if old is None:
+                envs_changed = True
+            old_names = old[1] if old is not None else set()
+            if new[1] != old_names:
+                events.append(WatchEvent(prefix, sorted(new[1] - old_names),
+                                         sorted(old_names - new[1])))
+
+        for event in events:
+            _meta_cache.invalidate(event.prefix)
+            _activation_cache.invalidate(event.prefix)
+        if envs_changed:
+            _client().info_cache.invalidate()
+        if self._inotify is not None and self._update_watches():
+            # directories may have been created before they were watched
+            events.extend(self._check(None, self.fixed is None))
+        return events
+
+    def _locations_key(self):
+        if self.fixed is not None:
+            return None
+        key = []
+        for path in self._envs_locations():
+            try:
+                st = os.stat(path)
+                key.append((path, st.st_ino, st.st_mtime))
+            except OSError:
+                key.append((path, None))
+        try:
+            st = os.stat(join(expanduser('~'), '.conda', 'environments.txt'))
+            key.append((st.st_ino, st.st_mtime, st.st_size))
+        except OSError:
+            pass
+        return key
+
+    def _update_watches(self):
+        # watch the directories of the current state, and return whether
+        # new directories are watched
+        watched = self._inotify.watched()
+        paths = set()
+        for prefix in set(self._state) | set(self.fixed or ()):
+            paths.add(prefix)
+            paths.add(join(prefix, 'conda-meta'))
+            parent = prefix
+            while not isdir(parent) and os.path.dirname(parent) != parent:
+                # to notice when the prefix is created
+                parent = os.path.dirname(parent)
+                paths.add(parent)
+        if self.fixed is None:
+            for d in self._envs_locations():
+                paths.add(d)
+                # environments being created, which have no conda-meta yet
+                try:
+                    paths.update(e.path for e in os.scandir(d)
+                                 if e.is_dir(follow_symlinks=False))
+                except OSError:
+                    pass
+        for path in watched - paths:
+            self._inotify.unwatch(path)
+        for path in paths:
+            if isdir(path):
+                self._inotify.watch(path)
+        return bool(self._inotify.watched() - watched)
+
+    def poll(self, timeout=0):
+        """
+        Return the list of WatchEvents of the changes since the last call,
+        waiting up to timeout seconds (None means forever) for changes.
+        """
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if end is None else max(0.0, end - time.time())
+            if self._inotify is not None:
+                paths = self._inotify.read(remaining)
+                dirty = set()
+                rediscover = False
+                for path in paths:
+                    if path in self._state:
+                        dirty.add(path)
+                    elif os.path.dirname(path) in self._state:
+                        dirty.add(os.path.dirname(path))
+                    else:
+                        rediscover = True
+                if rediscover and self.fixed is not None:
+                    # e.g. a watched prefix which did not exist was created
+                    rediscover = False
+                    dirty.update(self.fixed)
+                events = self._check(dirty, rediscover) if paths else []
+            else:
+                events = self._check(None, False)
+                if not events and remaining != 0:
+                    time.sleep(self.interval if remaining is None else
+                               min(self.interval, remaining))
+            if events or (end is not None and time.time() >= end):
+                return events
+
+    def start(self, callback):
+        """
+        Call callback(event) for each WatchEvent, from a background thread,
+        until close() is called.
+        """
+        def run():
+            while not self._stop.is_set():
+                for event in self.poll(self.interval):
+                    callback(event)
+
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
 
 
 def search(regex=None, spec=None, **kwargs):
     """
     Search for packages.
+
+    With local_index=True, the query is answered from all the cached
+    repodata files (see RepodataIndex) without invoking conda, unless
+    channels are specified, unknown is requested, or no cached repodata
+    exists.  Note that the cached files may include channels which are no
+    longer configured.
+    """
+    local_index = kwargs.pop('local_index', False)
+    index_kwargs = dict(kwargs)
+    cmd_list = _search_args(regex, spec, kwargs)
+    if local_index:
+        result = _local_search(regex, spec, index_kwargs)
+        if result is not None:
+            return result
+    return _call_and_parse(cmd_list, abspath=kwargs.get('abspath', True))
+
+
+def _local_search(regex, spec, kwargs):
+    # return the result of search() answered from the repodata index, or
+    # None when conda must be invoked
+    if any(kwargs.get(k) for k in ('channel', 'unknown', 'override_channels')):
+        return None
+    prefix = kwargs.get('prefix')
+    if kwargs.get('env'):
+        prefix = get_prefix_envname(kwargs['env'])
+    index = repodata_index()
+    index.reload()
+    if not len(index) or (kwargs.get('outdated') and not prefix):
+        return None
+    return index.search(regex=regex, spec=spec,
+                        platform=kwargs.get('platform'),
+                        outdated=kwargs.get('outdated', False),
+                        prefix=prefix, canonical=kwargs.get('canonical', False))
+
+
+def search_iter(regex=None, spec=None, **kwargs):
     """
+    Search for packages, like search(), but yield (name, record) pairs as
+    conda writes its result, instead of building one big dictionary.
+    The memory used is bounded by the size of the largest record, no
+    matter how big the entire result is.
+
+    This always invokes conda in a new process (and does not use the
+    persistent worker).
+    """
+    cmd_list = _search_args(regex, spec, kwargs)
+    stream = _Stream(cmd_list, abspath=kwargs.get('abspath', True))
+    try:
+        try:
+            for item in _iter_search_result(stream.reader, cmd_list):
+                yield item
+        except ValueError as e:
+            stream.invalid(e)
+        stream.finish()
+    except Exception as e:
+        stream.record.error = type(e).__name__
+        raise
+    finally:
+        stream.close()
+
+
+def _iter_search_result(reader, cmd_list):
+    # yield (name, record) pairs from the output of `conda search --json`,
+    # which is an object mapping names to lists of records
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if reader.peek() == '[':
+            reader.expect('[')
+            if reader.peek() != ']':
+                while True:
+                    yield name, reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+            else:
+                reader.expect(']')
+        else:
+            value = reader.value()
+            if name == 'error':
+                raise CondaError('conda %s: %s' % (" ".join(cmd_list), value))
+        if reader.expect(',}') == '}':
+            break
+
+
+def _search_args(regex, spec, kwargs):
     cmd_list = ['search', '--json']
 
     if regex and spec:
@@ -187,7 +2788,7 @@ def search(regex=None, spec=None, **kwargs):
             ('canonical', 'unknown', 'use_index_cache', 'outdated',
              'override_channels')))
 
-    return _call_and_parse(cmd_list, abspath=kwargs.get('abspath', True))
+    return cmd_list
 
 
 def create(name=None, prefix=None, pkgs=None):
@@ -195,38 +2796,51 @@ def create(name=None, prefix=None, pkgs=None):
     Create an environment either by name or path with a specified set of
     packages
     """
+    cmd_list = _create_args(name, prefix, pkgs)
+    _check_env_not_exists(name, prefix,
+                          _cached_info()['envs_dirs'] if name else None)
+    return _check_output(cmd_list, *_call_conda(cmd_list))
+
+
+def _create_args(name, prefix, pkgs):
     if not pkgs or not isinstance(pkgs, (list, tuple)):
         raise TypeError('must specify a list of one or more packages to '
                         'install into new environment')
 
-    cmd_list = ['create', '--yes', '--quiet']
     if name:
-        ref         = name
-        search      = [os.path.join(d, name) for d in info()['envs_dirs']]
         cmd_list    = ['create', '--yes', '--quiet', '--name', name]
     elif prefix:
-        ref         = prefix
-        search      = [prefix]
         cmd_list    = ['create', '--yes', '--quiet', '--prefix', prefix]
     else:
         raise TypeError('must specify either an environment name or a path '
                         'for new environment')
 
+    cmd_list.extend(pkgs)
+    return cmd_list
+
+
+def _check_env_not_exists(name, prefix, envs_dirs):
+    if name:
+        ref         = name
+        search      = [os.path.join(d, name) for d in envs_dirs]
+    else:
+        ref         = prefix
+        search      = [prefix]
+
     if any(os.path.exists(prefix) for prefix in search):
         raise CondaEnvExistsError('Conda environment [%s] already exists' % ref)
 
-    cmd_list.extend(pkgs)
-    (out, err) = _call_conda(cmd_list)
-    if err.decode().strip():
-        raise CondaError('conda %s: %s' % (" ".join(cmd_list), err.decode()))
-    return out
-
 
 def install(name=None, prefix=None, pkgs=None):
     """
     Install packages into an environment either by name or path with a
     specified set of packages
     """
+    cmd_list = _install_args(name, prefix, pkgs)
+    return _check_output(cmd_list, *_call_conda(cmd_list))
+
+
+def _install_args(name, prefix, pkgs):
     if not pkgs or not isinstance(pkgs, (list, tuple)):
         raise TypeError('must specify a list of one or more packages to '
                         'install into existing environment')
@@ -240,16 +2854,21 @@ def install(name=None, prefix=None, pkgs=None):
         pass
 
     cmd_list.extend(pkgs)
-    (out, err) = _call_conda(cmd_list)
-    if err.decode().strip():
-        raise CondaError('conda %s: %s' % (" ".join(cmd_list), err.decode()))
-    return out
+    return cmd_list
 
 
 def update(*pkgs, **kwargs):
     """
     Update package(s) (in an environment) by name.
     """
+    cmd_list = _update_args(pkgs, kwargs)
+    if '--dry-run' in cmd_list:
+        return _cached_plan(cmd_list, abspath=kwargs.get('abspath', True))
+    result = _call_and_parse(cmd_list, abspath=kwargs.get('abspath', True))
+    return _check_result(cmd_list, result)
+
+
+def _update_args(pkgs, kwargs):
     cmd_list = ['update', '--json', '--quiet', '--yes']
 
     if not pkgs and not kwargs.get('all'):
@@ -263,13 +2882,7 @@ def update(*pkgs, **kwargs):
              'alt_hint')))
 
     cmd_list.extend(pkgs)
-
-    result = _call_and_parse(cmd_list, abspath=kwargs.get('abspath', True))
-
-    if 'error' in result:
-        raise CondaError('conda %s: %s' % (" ".join(cmd_list), result['error']))
-
-    return result
+    return cmd_list
 
 
 def remove(*pkgs, **kwargs):
@@ -281,6 +2894,14 @@ def remove(*pkgs, **kwargs):
         (other information)
     }
     """
+    cmd_list = _remove_args(pkgs, kwargs)
+    if '--dry-run' in cmd_list:
+        return _cached_plan(cmd_list, abspath=kwargs.get('abspath', True))
+    result = _call_and_parse(cmd_list, abspath=kwargs.get('abspath', True))
+    return _check_result(cmd_list, result)
+
+
+def _remove_args(pkgs, kwargs):
     cmd_list = ['remove', '--json', '--quiet', '--yes']
 
     if not pkgs and not kwargs.get('all'):
@@ -302,13 +2923,7 @@ def remove(*pkgs, **kwargs):
              'no_pin', 'force', 'all')))
 
     cmd_list.extend(pkgs)
-
-    result = _call_and_parse(cmd_list, abspath=kwargs.get('abspath', True))
-
-    if 'error' in result:
-        raise CondaError('conda %s: %s' % (" ".join(cmd_list), result['error']))
-
-    return result
+    return cmd_list
 
 
 def remove_environment(name=None, path=None, **kwargs):
@@ -324,6 +2939,14 @@ def clone_environment(clone, name=None, path=None, **kwargs):
     """
     Clone the environment ``clone`` into ``name`` or ``path``.
     """
+    cmd_list = _clone_args(clone, name, path, kwargs)
+    if '--dry-run' in cmd_list:
+        return _cached_plan(cmd_list, abspath=kwargs.get('abspath', True))
+    result = _call_and_parse(cmd_list, abspath=kwargs.get('abspath', True))
+    return _check_result(cmd_list, result)
+
+
+def _clone_args(clone, name, path, kwargs):
     cmd_list = ['create', '--json', '--quiet']
 
     if (name and path) or not (name or path):
@@ -343,11 +2966,1091 @@ def clone_environment(clone, name=None, path=None, **kwargs):
             ('dry_run', 'unknown', 'use_index_cache', 'use_local', 'no_pin',
              'force', 'all', 'channel', 'override_channels', 'no_default_packages')))
 
-    result = _call_and_parse(cmd_list, abspath=kwargs.get('abspath', True))
+    return cmd_list
+
+
+def _record_url(cname, record):
+    # return the URL of the package of a conda-meta record
+    if record.get('url'):
+        return record['url']
+    fn = record.get('fn') or cname + '.tar.bz2'
+    channel = record.get('channel') or ''
+    if '://' not in channel:
+        raise CondaError('%s: unknown URL of package' % cname)
+    return '%s/%s' % (channel.rstrip('/'), fn)
+
+
+def _toposort(records):
+    # return the canonical names of records (a dictionary mapping canonical
+    # names to records) sorted such that dependencies come first
+    by_name = dict((record.get('name', split_canonical_name(cname)[0]), cname)
+                   for cname, record in records.items())
+    deps = {}
+    for name, cname in by_name.items():
+        deps[cname] = set(by_name[dep.split()[0]]
+                          for dep in records[cname].get('depends', [])
+                          if dep.split() and dep.split()[0] in by_name and
+                          by_name[dep.split()[0]] != cname)
+    res = []
+    done = set()
+    while deps:
+        ready = sorted(cname for cname, d in deps.items() if d <= done)
+        if not ready:
+            # a dependency cycle, which conda resolves
+            ready = sorted(deps)
+        for cname in ready:
+            del deps[cname]
+            done.add(cname)
+        res.extend(ready)
+    return res
+
+
+def export_explicit(prefix, path=None):
+    """
+    Return the explicit specification of the environment prefix (as the
+    text `conda list --explicit --md5` would print), i.e. the list of
+    the URLs of its packages, each followed by '#' and the md5 sum of the
+    package.  The conda-meta records are read directly, without invoking
+    conda.  When path is given, the specification is also written there.
+    """
+    records = linked_records(prefix)
+    subdirs = set(record.get('subdir') for record in records.values())
+    subdirs.discard('noarch')
+    subdirs.discard(None)
+    lines = ['# This file may be used to create an environment using:',
+             '# $ conda create --name <env> --file <this file>']
+    if len(subdirs) == 1:
+        lines.append('# platform: %s' % subdirs.pop())
+    lines.append('@EXPLICIT')
+    for cname in _toposort(records):
+        record = records[cname]
+        url = _record_url(cname, record)
+        lines.append('%s#%s' % (url, record['md5']) if record.get('md5')
+                     else url)
+    text = '\n'.join(lines) + '\n'
+    if path is not None:
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as fo:
+            fo.write(text)
+        os.replace(tmp_path, path)
+    return text
+
+
+def parse_explicit(text):
+    """
+    Parse an explicit specification (see export_explicit), and return the
+    list of (url, md5) tuples, where md5 is None when not given.
+    """
+    res = []
+    explicit = False
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line == '@EXPLICIT':
+            explicit = True
+            continue
+        if not explicit:
+            raise CondaError('not an explicit specification, '
+                             '@EXPLICIT missing')
+        url, sep, md5 = line.partition('#')
+        res.append((url, md5 or None))
+    return res
+
+
+_md5_lock = threading.Lock()
+_md5_cache = {}
+
+
+def _md5_file(path):
+    # return the md5 sum of the file path, which is cached until the file
+    # changes, or None when it does not exist
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (st.st_ino, st.st_mtime, st.st_size)
+    with _md5_lock:
+        entry = _md5_cache.get(path)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+    h = hashlib.md5()
+    with open(path, 'rb') as fi:
+        for chunk in iter(lambda: fi.read(1 << 20), b''):
+            h.update(chunk)
+    with _md5_lock:
+        _md5_cache[path] = (key, h.hexdigest())
+    return h.hexdigest()
+
+
+def _url_path(url):
+    # return the local path of a file:// URL, or None
+    if not url.startswith('file://'):
+        return None
+    from urllib.request import url2pathname
+    return url2pathname(url[len('file://'):])
+
+
+def verify_explicit(packages, max_workers=4):
+    """
+    Verify the md5 sums of the (url, md5) tuples `packages` (see
+    parse_explicit), against the local files of file:// URLs and the
+    tarballs in the package caches, in parallel.  Packages which are
+    neither local nor cached are verified by conda when downloaded.
+    Raises CondaError listing the mismatching packages.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    pkgs_dirs = _pkgs_dirs()
+
+    def check(package):
+        url, md5 = package
+        paths = [join(d, url.rsplit('/', 1)[-1]) for d in pkgs_dirs]
+        if _url_path(url) is not None:
+            paths.insert(0, _url_path(url))
+        for path in paths:
+            actual = _md5_file(path)
+            if actual is not None and actual != md5:
+                return '%s: md5 %s != %s' % (path, actual, md5)
+        return None
+
+    packages = [package for package in packages if package[1]]
+    with ThreadPoolExecutor(max_workers) as executor:
+        errors = [e for e in executor.map(check, packages) if e]
+    if errors:
+        raise CondaError('md5 mismatch:\n%s' % '\n'.join(errors))
+
+
+def create_from_explicit(prefix, lockfile, verify=True, max_workers=4):
+    """
+    Create the environment prefix from the explicit specification in the
+    file lockfile (see export_explicit), without invoking the solver.
+    Unless verify is False, the md5 sums are verified first (see
+    verify_explicit).  Returns the list of (url, md5) of the packages.
+    """
+    _check_env_not_exists(None, prefix, None)
+    with open(lockfile) as fi:
+        packages = parse_explicit(fi.read())
+    if verify:
+        verify_explicit(packages, max_workers)
+
+    cmd_list = ['create', '--yes', '--quiet', '--json', '--prefix', prefix,
+                '--file', lockfile]
+    stdout, stderr = _call_conda(cmd_list)
+    if stdout.strip():
+        _check_result(cmd_list, _parse_output(cmd_list, stdout, stderr))
+    else:
+        _check_output(cmd_list, stdout, stderr)
+    return packages
+
+
+def install_plan(name=None, prefix=None, pkgs=None, **kwargs):
+    """
+    Return the plan (the JSON result of a dry run) of installing packages
+    into an environment, see install().  Plans are cached, see PlanCache.
+    """
+    cmd_list = _install_plan_args(name, prefix, pkgs, kwargs)
+    return _cached_plan(cmd_list, abspath=kwargs.get('abspath', True))
+
+
+def _install_plan_args(name, prefix, pkgs, kwargs):
+    cmd_list = _install_args(name, prefix, pkgs)
+    flags = _setup_install_commands_from_kwargs(
+        kwargs, ('no_deps', 'override_channels', 'no_pin', 'force',
+                 'use_index_cache', 'use_local', 'alt_hint'))
+    return (cmd_list[:1] + ['--json', '--dry-run'] +
+            cmd_list[1:-len(pkgs)] + flags + list(pkgs))
+
+
+
+class PrefetchResult(object):
+    """
+    The outcome of prefetch(): the canonical names of the packages which
+    were already `cached` (extracted), `fetched` (downloaded) and
+    `extracted`, and the number of bytes downloaded.  Packages which were
+    fetched but could not be extracted (i.e. .conda packages, without the
+    zstandard module) are extracted by conda when linked.
+    """
+    __slots__ = ('cached', 'fetched', 'extracted', 'bytes')
+
+    def __init__(self):
+        self.cached = []
+        self.fetched = []
+        self.extracted = []
+        self.bytes = 0
+
+    def __repr__(self):
+        return '<PrefetchResult cached=%d fetched=%d extracted=%d>' % (
+            len(self.cached), len(self.fetched), len(self.extracted))
+
+
+def _prefetch_records(specs_or_plan, channels):
+    # return the list of package records (with at least 'url') to prefetch
+    # for a plan (see install_plan), a list of (url, md5) tuples (see
+    # parse_explicit) or URLs, or a list of specs to resolve
+    if isinstance(specs_or_plan, dict):
+        actions = specs_or_plan.get('actions', {})
+        records = []
+        for record in actions.get('FETCH') or actions.get('LINK') or []:
+            if not isinstance(record, dict):
+                continue
+            if 'url' not in record and 'base_url' in record:
+                # LINK records of conda 4.x
+                record = dict(record, url='%s/%s/%s.tar.bz2' % (
+                    record['base_url'], record['platform'],
+                    record['dist_name']))
+            if 'url' in record:
+                records.append(record)
+        return records
+
+    records = []
+    specs = []
+    for item in specs_or_plan:
+        if isinstance(item, (tuple, list)):
+            records.append({'url': item[0], 'md5': item[1]})
+        elif '://' in item:
+            url, sep, md5 = item.partition('#')
+            records.append({'url': url, 'md5': md5 or None})
+        else:
+            specs.append(item)
+    if specs:
+        cmd_list = ['create', '--json', '--dry-run', '--prefix',
+                    join(_client().root_prefix, 'envs', '.conda_api_prefetch')]
+        if channels:
+            cmd_list.append('--override-channels')
+            for channel in channels:
+                cmd_list.extend(['--channel', channel])
+        records.extend(_prefetch_records(_cached_plan(cmd_list + specs),
+                                         None))
+    return records
+
+
+def _dist_name(fn):
+    # return the canonical name of the package filename fn
+    for ext in '.tar.bz2', '.conda':
+        if fn.endswith(ext):
+            return fn[:-len(ext)]
+    return fn
+
+
+def _fetch(url, path, md5=None, sha256=None):
+    # download url to path (via a temporary file), verifying its checksums,
+    # and return the number of bytes downloaded
+    from urllib.request import urlopen
+
+    tmp_path = '%s.%d.%d.partial' % (path, os.getpid(), threading.get_ident())
+    h_md5 = hashlib.md5()
+    h_sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with urlopen(url) as fi, open(tmp_path, 'wb') as fo:
+            for chunk in iter(lambda: fi.read(1 << 20), b''):
+                h_md5.update(chunk)
+                h_sha256.update(chunk)
+                fo.write(chunk)
+                size += len(chunk)
+        if md5 and h_md5.hexdigest() != md5:
+            raise CondaError('%s: md5 %s != %s' % (
+                url, h_md5.hexdigest(), md5))
+        if sha256 and h_sha256.hexdigest() != sha256:
+            raise CondaError('%s: sha256 %s != %s' % (
+                url, h_sha256.hexdigest(), sha256))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        raise CondaError('%s: could not download: %s' % (url, e))
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return size
+
+
+def _extract_all(tar, dest):
+    # extract all members of the tarfile into dest, refusing packages with
+    # members which would be written (or link) outside of dest; the 'tar'
+    # filter of newer Pythons only skips such members
+    import tarfile
+
+    kwargs = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+    tar.extractall(dest, members=_checked_members(tar, dest), **kwargs)
+
+
+def _checked_members(tar, dest):
+    # yield the members of the tarfile, like the 'tar' extraction filter
+    # of newer Pythons: raise TarError for absolute paths, paths or links
+    # leaving dest, and clear the setuid/setgid/sticky and write bits of
+    # group and others
+    import stat
+    import tarfile
+
+    dest = os.path.realpath(dest)
+
+    def check(path, member):
+        path = os.path.realpath(path)
+        if path != dest and not path.startswith(join(dest, '')):
+            raise tarfile.TarError('%r is outside of the destination'
+                                   % member.name)
+
+    for member in tar:
+        if os.path.isabs(member.name):
+            raise tarfile.TarError('%r is an absolute path' % member.name)
+        check(join(dest, member.name), member)
+        if member.issym():
+            if os.path.isabs(member.linkname):
+                raise tarfile.TarError('%r links to an absolute path'
+                                       % member.name)
+            check(join(dest, os.path.dirname(member.name), member.linkname),
+                  member)
+        elif member.islnk():
+            check(join(dest, member.linkname), member)
+        member.mode &= ~(stat.S_ISUID | stat.S_ISGID | stat.S_ISVTX |
+                         stat.S_IWGRP | stat.S_IWOTH)
+        yield member
+
+
+def _extract(path, dest):
+    # extract the package tarball path into the directory dest (via a
+    # temporary directory), and return whether it could be extracted
+    import tarfile
+
+    tmp_dest = '%s.%d.%d.tmp' % (dest, os.getpid(), threading.get_ident())
+    try:
+        if path.endswith('.conda'):
+            try:
+                import zstandard
+            except ImportError:
+                return False
+            import zipfile
+            with zipfile.ZipFile(path) as zf:
+                for member in zf.namelist():
+                    if not member.endswith('.tar.zst'):
+                        continue
+                    reader = zstandard.ZstdDecompressor().stream_reader(
+                        zf.open(member))
+                    with tarfile.open(fileobj=reader, mode='r|') as tar:
+                        _extract_all(tar, tmp_dest)
+        else:
+            with tarfile.open(path) as tar:
+                _extract_all(tar, tmp_dest)
+        if isdir(dest):
+            shutil.rmtree(dest)
+        os.replace(tmp_dest, dest)
+    except (OSError, tarfile.TarError) as e:
+        raise CondaError('%s: could not extract: %s' % (path, e))
+    finally:
+        if os.path.exists(tmp_dest):
+            shutil.rmtree(tmp_dest)
+    return True
+
+
+def prefetch(specs_or_plan, channels=None, max_workers=4, pkgs_dir=None):
+    """
+    Fill the package cache with the packages of specs_or_plan, which is
+    either a plan (see install_plan, or the result of any dry run), a list
+    of (url, md5) tuples (see parse_explicit) or URLs, or a list of specs
+    which are resolved by a dry run of conda create (using only channels,
+    unless None).
+    The packages are downloaded, verified and extracted by a pool of
+    max_workers threads, such that conda only has to link them afterwards.
+    Packages which are already extracted in one of the package caches are
+    skipped.  `pkgs_dir` defaults to the first package cache.
+    Returns a PrefetchResult, and raises CondaError listing the packages
+    which failed (after all others are done).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    records = _prefetch_records(specs_or_plan, channels)
+    pkgs_dirs = _pkgs_dirs()
+    if pkgs_dir is None:
+        pkgs_dir = pkgs_dirs[0]
+    if not isdir(pkgs_dir):
+        os.makedirs(pkgs_dir)
+
+    cached = {}
+    for d in reversed(pkgs_dirs):
+        cached.update(_scan_pkgs_dir(d))
+
+    result = PrefetchResult()
+    lock = threading.Lock()
+
+    def run(record):
+        fn = record.get('fn') or record['url'].rsplit('/', 1)[-1]
+        dist = _dist_name(fn)
+        md5 = record.get('md5')
+        if dist in cached:
+            with lock:
+                result.cached.append(dist)
+            return None
+        path = join(pkgs_dir, fn)
+        try:
+            if not md5 or _md5_file(path) != md5:
+                size = _fetch(record['url'], path, md5, record.get('sha256'))
+                with lock:
+                    result.fetched.append(dist)
+                    result.bytes += size
+            if not _extract(path, join(pkgs_dir, dist)):
+                return None
+            info_dir = join(pkgs_dir, dist, 'info')
+            # the record conda reads for the cached package
+            with open(join(info_dir, 'index.json')) as fi:
+                repodata_record = json.load(fi)
+            repodata_record.update(record)
+            repodata_record.setdefault('fn', fn)
+            if not md5:
+                repodata_record['md5'] = _md5_file(path)
+            with open(join(info_dir, 'repodata_record.json'), 'w') as fo:
+                json.dump(repodata_record, fo, indent=2, sort_keys=True)
+        except (CondaError, OSError, ValueError) as e:
+            return str(e)
+        with lock:
+            result.extracted.append(dist)
+            with open(join(pkgs_dir, 'urls.txt'), 'a') as fo:
+                fo.write(record['url'] + '\n')
+        return None
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        errors = [e for e in executor.map(run, records) if e]
+    for names in result.cached, result.fetched, result.extracted:
+        names.sort()
+    if errors:
+        raise CondaError('prefetch failed:\n%s' % '\n'.join(errors))
+    return result
+
+
+def _file_keys(path, suffix):
+    # return the sorted list of (filename, mtime, size) of the files in the
+    # directory path which end with suffix
+    res = []
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return res
+    for e in entries:
+        if e.name.endswith(suffix):
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            res.append((e.name, st.st_mtime, st.st_size))
+    res.sort()
+    return res
+
+
+def _plan_prefix(cmd_list):
+    # return the prefix whose packages the plan of cmd_list depends on,
+    # or None when it cannot be determined
+    def arg(option):
+        if option in cmd_list:
+            i = cmd_list.index(option)
+            if i + 1 < len(cmd_list):
+                return cmd_list[i + 1]
+        return None
+
+    clone = arg('--clone')
+    if clone is not None:
+        if os.sep in clone or '/' in clone:
+            return clone
+        return get_prefix_envname(clone)
+    if arg('--prefix') is not None:
+        return arg('--prefix')
+    if arg('--name') is not None:
+        return get_prefix_envname(arg('--name'))
+    return None
+
+
+# the config files conda reads, see conda.base.constants.SEARCH_PATH
+_RC_SEARCH_PATH = (
+    '/etc/conda/.condarc', '/etc/conda/condarc', '/etc/conda/condarc.d/',
+    '/var/lib/conda/.condarc', '/var/lib/conda/condarc',
+    '/var/lib/conda/condarc.d/',
+    '$CONDA_ROOT/.condarc', '$CONDA_ROOT/condarc', '$CONDA_ROOT/condarc.d/',
+    '$XDG_CONFIG_HOME/conda/.condarc', '$XDG_CONFIG_HOME/conda/condarc',
+    '$XDG_CONFIG_HOME/conda/condarc.d/',
+    '~/.config/conda/.condarc', '~/.config/conda/condarc',
+    '~/.config/conda/condarc.d/',
+    '~/.conda/.condarc', '~/.conda/condarc', '~/.conda/condarc.d/',
+    '~/.condarc',
+    '$CONDA_PREFIX/.condarc', '$CONDA_PREFIX/condarc',
+    '$CONDA_PREFIX/condarc.d/',
+    '$CONDARC',
+)
+
+
+def _config_keys():
+    # return the (path, mtime, size) of the config files conda reads, and
+    # the CONDA* environment variables, which together determine the
+    # configuration of conda (e.g. its channels)
+    environ = dict(os.environ)
+    environ.setdefault('CONDA_ROOT', _client().root_prefix or '')
+    res = []
+    for path in _RC_SEARCH_PATH:
+        path = re.sub(r'\$(\w+)', lambda m: environ.get(m.group(1), '$'),
+                      expanduser(path))
+        if path.startswith('$') or '/$' in path:
+            continue
+        if path.endswith('/'):
+            for suffix in '.yml', '.yaml':
+                res.extend((join(path, fn), mtime, size) for fn, mtime, size
+                           in _file_keys(path, suffix))
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        res.append((path, st.st_mtime, st.st_size))
+    res.extend(sorted((k, v) for k, v in environ.items()
+                      if k.startswith('CONDA')))
+    return res
+
+
+def _plan_key(cmd_list):
+    # return the key of the plan of cmd_list, which changes whenever the
+    # conda-meta records of the prefix, the cached repodata or the
+    # configuration change, or None when the plan cannot be cached
+    prefix = _plan_prefix(cmd_list)
+    if prefix is None or not isdir(join(prefix, 'conda-meta')):
+        return None
+    data = [normpath(prefix), cmd_list,
+            _file_keys(join(prefix, 'conda-meta'), '.json'), _config_keys()]
+    for d in _pkgs_dirs():
+        data.append(_file_keys(join(d, 'cache'), '.json'))
+    data = json.dumps(data, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+class PlanCache(object):
+    """
+    Least recently used cache of solver plans, i.e. the JSON results of dry
+    runs of conda, keyed on the conda-meta records of the prefix, the
+    requested specs, channels and flags, and the cached repodata.  Plans are
+    kept in memory and, unless `directory` is None, as files in directory,
+    such that they are shared between processes.  Both are limited to
+    `max_entries` plans of at most `max_bytes` in total.  Plans expire after
+    `max_age` seconds (None means never), such that dry runs eventually see
+    newly published packages, even when the cached repodata is unchanged.
+    """
+    def __init__(self, directory=None, max_entries=256, max_bytes=1 << 24,
+                 max_age=300.0):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._size = 0
+
+    def _path(self, key):
+        return join(self.directory, key + '.json')
+
+    def _expired(self, created):
+        return (self.max_age is not None and
+                time.time() - created >= self.max_age)
+
+    def _store(self, key, created, data):
+        # store the serialized plan data in memory, evicting old plans
+        if key in self._data:
+            self._size -= len(self._data.pop(key)[1])
+        self._data[key] = (created, data)
+        self._size += len(data)
+        while self._data and (len(self._data) > self.max_entries or
+                              self._size > self.max_bytes):
+            self._size -= len(self._data.popitem(last=False)[1][1])
+
+    def get(self, key):
+        data = None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if self._expired(entry[0]):
+                    self._size -= len(self._data.pop(key)[1])
+                else:
+                    self._data.move_to_end(key)
+                    data = entry[1]
+        if data is None and self.directory is not None:
+            # the mtime of the files is their time of creation, and the
+            # atime their time of last use
+            path = self._path(key)
+            try:
+                created = os.stat(path).st_mtime
+                if not self._expired(created):
+                    with open(path, 'rb') as fi:
+                        data = fi.read()
+                    os.utime(path, (time.time(), created))
+            except (IOError, OSError):
+                pass
+            if data is not None:
+                with self._lock:
+                    self._store(key, created, data)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(data.decode('utf-8'))
+
+    def put(self, key, plan):
+        data = json.dumps(plan).encode('utf-8')
+        with self._lock:
+            self._store(key, time.time(), data)
+        if self.directory is None:
+            return
+        try:
+            if not isdir(self.directory):
+                os.makedirs(self.directory)
+            tmp_path = '%s.%d.tmp' % (self._path(key), os.getpid())
+            with open(tmp_path, 'wb') as fo:
+                fo.write(data)
+            os.replace(tmp_path, self._path(key))
+            self._evict_files()
+        except (IOError, OSError):
+            pass
+
+    def _evict_files(self):
+        # remove the least recently used files beyond the limits
+        files = []
+        for e in os.scandir(self.directory):
+            if e.name.endswith('.json'):
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                files.append((st.st_atime, st.st_size, e.path))
+        files.sort(reverse=True)
+        total = 0
+        for i, (atime, size, path) in enumerate(files):
+            total += size
+            if i >= self.max_entries or total > self.max_bytes:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+        if self.directory is not None and isdir(self.directory):
+            for fn in os.listdir(self.directory):
+                if fn.endswith('.json'):
+                    try:
+                        os.unlink(join(self.directory, fn))
+                    except OSError:
+                        pass
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._data), 'bytes': self._size,
+                    'directory': self.directory, 'max_age': self.max_age}
+
+
+_plan_cache = PlanCache()
+
+
+def set_plan_cache(cache):
+    """
+    Set the PlanCache used for dry runs (None disables caching plans), and
+    return the previous one.  By default, plans are cached in memory only,
+    for 5 minutes; e.g. set_plan_cache(PlanCache('/var/cache/plans')) also
+    stores them on disk, shared between processes.
+    """
+    global _plan_cache
+
+    old, _plan_cache = _plan_cache, cache
+    return old
+
+
+def _cached_plan(cmd_list, abspath=True):
+    # return the (checked) result of the dry run cmd_list, from the plan
+    # cache when possible
+    cache = _plan_cache
+    key = _plan_key(cmd_list) if cache is not None else None
+    if key is not None:
+        plan = cache.get(key)
+        if plan is not None:
+            return plan
+    result = _check_result(cmd_list, _call_and_parse(cmd_list, abspath))
+    if key is not None:
+        cache.put(key, result)
+    return result
+
+
+class BatchResult(object):
+    """
+    The outcome of one operation of a batch (see install_many): the prefix
+    and packages it was applied to, and either its result or the exception
+    it raised (error).
+    """
+    __slots__ = ('prefix', 'pkgs', 'result', 'error')
+
+    def __init__(self, prefix, pkgs, result=None, error=None):
+        self.prefix = prefix
+        self.pkgs = pkgs
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<BatchResult %s %s: %s>' % (
+            self.prefix, ' '.join(self.pkgs),
+            'ok' if self.ok else 'error %r' % self.error)
+
+
+def _run_batch(func, operations, max_workers):
+    # Call func(prefix, pkgs) for each of the (prefix, pkgs) operations, in
+    # a pool of max_workers threads.  Operations on the same prefix run one
+    # after another (in the given order), operations on different prefixes
+    # in parallel.  Returns a dictionary mapping each prefix to the list of
+    # its BatchResults.
+    from concurrent.futures import ThreadPoolExecutor
+
+    groups = {}
+    order = []
+    for prefix, pkgs in operations:
+        key = normcase(normpath(prefix))
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(BatchResult(prefix, list(pkgs)))
+
+    # the worker threads inherit the client and deadline of the caller
+    client = _client()
+    scope = _scope.get()
+
+    def run_group(results):
+        _local.client = client
+        _scope.set(scope)
+        for res in results:
+            try:
+                res.result = func(res.prefix, res.pkgs)
+            except Exception as e:
+                res.error = e
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        for future in [executor.submit(run_group, groups[key])
+                       for key in order]:
+            future.result()
+
+    res = {}
+    for key in order:
+        for batch_result in groups[key]:
+            res.setdefault(batch_result.prefix, []).append(batch_result)
+    return res
+
+
+def install_many(operations, max_workers=4):
+    """
+    Install packages into many environments: `operations` is a list of
+    (prefix, pkgs) tuples, each of which is applied with install().
+    At most max_workers conda processes run at the same time, and
+    operations on the same prefix are serialized.
+
+    Returns a dictionary mapping each prefix to the list of BatchResults of
+    its operations.  A failing operation does not stop the batch, its
+    exception is stored in the error attribute of its BatchResult.
+    """
+    return _run_batch(lambda prefix, pkgs: install(prefix=prefix, pkgs=pkgs),
+                      operations, max_workers)
+
+
+def update_many(operations, max_workers=4, **kwargs):
+    """
+    Update packages in many environments, like install_many().  Each
+    operation is applied with update(*pkgs, prefix=prefix, **kwargs).
+    """
+    return _run_batch(
+        lambda prefix, pkgs: update(*pkgs, prefix=prefix, **dict(kwargs)),
+        operations, max_workers)
+
+
+def remove_many(operations, max_workers=4, **kwargs):
+    """
+    Remove packages from many environments, like install_many().  Each
+    operation is applied with remove(*pkgs, path=prefix, **kwargs).
+    """
+    return _run_batch(
+        lambda prefix, pkgs: remove(*pkgs, path=prefix, **dict(kwargs)),
+        operations, max_workers)
+
+
+class _MutationBatch(object):
+    # pending install or remove requests on one prefix, which are run as a
+    # single conda command
+    def __init__(self, kind, prefix, scope):
+        self.kind = kind
+        self.prefix = prefix
+        self.scope = scope
+        self.pkgs = []
+        self.names = {}
+        # the list of (pkgs, future) of the merged requests
+        self.requests = []
+
+    def compatible(self, pkgs):
+        # requests are compatible unless they ask for different specs of
+        # the same package
+        for spec in pkgs:
+            name = MatchSpec(spec).name
+            if self.names.get(name, spec) != spec:
+                return False
+        return True
+
+    def add(self, pkgs, future):
+        for spec in pkgs:
+            if spec not in self.pkgs:
+                self.pkgs.append(spec)
+                self.names[MatchSpec(spec).name] = spec
+        self.requests.append((list(pkgs), future))
+
+
+MutationResult = namedtuple('MutationResult', 'prefix pkgs merged result')
+MutationResult.__doc__ = """
+The share of a request of MutationScheduler in the conda command it was
+merged into: the `prefix` and the package specs `pkgs` of the request, the
+specs `merged` of the command (which include `pkgs`), and the `result` of
+the command.  The output of conda cannot be attributed to single specs
+(e.g. dependencies are shared), so `result` is that of the whole command.
+"""
+
+
+class MutationScheduler(object):
+    """
+    Per-prefix queue of install and remove requests.  Requests for one
+    prefix are executed one after another, and pending requests of the same
+    kind are merged into a single conda command (with the union of their
+    package specs), as long as they do not ask for different specs of the
+    same package.  This saves solver runs and contention on conda's lock,
+    when many callers mutate the same prefix at about the same time.
+
+    Each request returns a concurrent.futures.Future, whose result is the
+    MutationResult of the request.  When a merged command fails, its
+    requests are run again one at a time, such that each request fails
+    (or succeeds) on its own.  `window` is the number of seconds a new
+    queue waits for further requests before running the first command.
+    """
+    def __init__(self, window=0.05):
+        self.window = window
+        self.client = _client()
+        self._lock = threading.Lock()
+        self._queues = {}
+        self.requests = 0
+        self.runs = 0
+
+    def install(self, prefix, pkgs):
+        """
+        Queue installing pkgs into prefix, see install().
+        """
+        return self._submit('install', prefix, pkgs)
+
+    def remove(self, prefix, pkgs):
+        """
+        Queue removing pkgs from prefix, see remove().
+        """
+        return self._submit('remove', prefix, pkgs)
+
+    def _submit(self, kind, prefix, pkgs):
+        from concurrent.futures import Future
+
+        if not pkgs or not isinstance(pkgs, (list, tuple)):
+            raise TypeError('must specify a list of one or more packages')
+        future = Future()
+        key = normcase(normpath(prefix))
+        with self._lock:
+            self.requests += 1
+            queue = self._queues.get(key)
+            start = queue is None
+            if start:
+                queue = self._queues[key] = []
+            if (queue and queue[-1].kind == kind and
+                    queue[-1].compatible(pkgs)):
+                queue[-1].add(pkgs, future)
+            else:
+                batch = _MutationBatch(kind, prefix,
+                                       _scope.get())
+                batch.add(pkgs, future)
+                queue.append(batch)
+        if start:
+            t = threading.Thread(target=self._drain, args=(key,))
+            t.daemon = True
+            t.start()
+        return future
+
+    def _drain(self, key):
+        # run the batches queued for key, until the queue is empty
+        time.sleep(self.window)
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                batch = queue.pop(0)
+                self.runs += 1
+            _local.client = self.client
+            _scope.set(batch.scope)
+            try:
+                result = self._run(batch.kind, batch.prefix, batch.pkgs)
+            except Exception as e:
+                if len(batch.requests) == 1:
+                    batch.requests[0][1].set_exception(e)
+                    continue
+                # find out which requests fail on their own
+                for pkgs, future in batch.requests:
+                    with self._lock:
+                        self.runs += 1
+                    try:
+                        result = self._run(batch.kind, batch.prefix, pkgs)
+                    except Exception as error:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(MutationResult(
+                            batch.prefix, pkgs, pkgs, result))
+            else:
+                for pkgs, future in batch.requests:
+                    future.set_result(MutationResult(
+                        batch.prefix, pkgs, list(batch.pkgs), result))
+
+    @staticmethod
+    def _run(kind, prefix, pkgs):
+        if kind == 'install':
+            return install(prefix=prefix, pkgs=pkgs)
+        return remove(*pkgs, path=prefix)
+
+
+def mutation_scheduler():
+    """
+    Return the default MutationScheduler.
+    """
+    client = _client()
+    with client._lock:
+        if client.mutation_scheduler is None:
+            client.mutation_scheduler = MutationScheduler()
+        return client.mutation_scheduler
+
+
+CondaEvent = namedtuple('CondaEvent', 'kind name done total finished data')
+CondaEvent.__doc__ = """
+An event reported by conda while executing a command.  `kind` is one of:
+'fetch' (downloading package `name`, `done` of `total` bytes), 'extract',
+'link' and 'unlink' (of package `name`), 'progress' (unlabelled progress
+of `name`, `done` of `total` steps), 'message' (any other JSON message in
+`data`), and finally 'result' (the result of the command in `data`).
+"""
+
+
+def _progress_event(doc):
+    # return the CondaEvent for a progress document of conda, or None
+    if not isinstance(doc, dict):
+        return None
+    done = doc.get('progress')
+    total = doc.get('maxval')
+    if (isinstance(done, float) and 0 <= done <= 1.0 and
+            isinstance(total, int) and total > 1):
+        # newer conda reports the fraction instead of the number of bytes
+        done = int(done * total)
+    finished = bool(doc.get('finished', False))
+    for kind in 'fetch', 'extract', 'link', 'unlink':
+        if kind in doc:
+            return CondaEvent(kind, doc[kind], done, total, finished, doc)
+    if 'progress' in doc and 'maxval' in doc:
+        return CondaEvent('progress', doc.get('name'), done, total, finished,
+                          doc)
+    return None
+
+
+def _iter_events(cmd_list, abspath=True):
+    # run conda with cmd_list (which contains --json), and yield the
+    # CondaEvents for the JSON documents conda writes, as they arrive
+    stream = _Stream(cmd_list, abspath=abspath)
+    try:
+        # conda separates documents by newlines or NUL characters
+        skip = ' \t\r\n\x00'
+        pending = None
+        while stream.reader.peek(skip):
+            try:
+                doc = stream.reader.value()
+            except ValueError as e:
+                stream.invalid(e)
+            event = _progress_event(doc)
+            if event is None:
+                # the last document which is not progress is the result
+                if pending is not None:
+                    yield CondaEvent('message', None, None, None, False,
+                                     pending)
+                pending = doc
+            else:
+                yield event
+        stream.finish()
+        if pending is None:
+            raise CondaError('conda %s: no result' % " ".join(cmd_list))
+        _check_result(cmd_list, pending)
+        yield CondaEvent('result', None, None, None, True, pending)
+    except Exception as e:
+        stream.record.error = type(e).__name__
+        raise
+    finally:
+        _invalidate_after(cmd_list)
+        stream.close()
+
+
+def _progress_args(cmd_list):
+    # return cmd_list with JSON output and without --quiet, which would
+    # suppress the progress reports
+    res = [arg for arg in cmd_list if arg != '--quiet']
+    if '--json' not in res:
+        res.insert(1, '--json')
+    return res
+
+
+def install_events(name=None, prefix=None, pkgs=None):
+    """
+    Like install(), but run conda with progress reports, and yield a
+    CondaEvent for each report as it arrives.  The last event has kind
+    'result', and the JSON result of conda as data.
+    """
+    return _iter_events(_progress_args(_install_args(name, prefix, pkgs)))
+
+
+def create_events(name=None, prefix=None, pkgs=None):
+    """
+    Like create(), but yield CondaEvents, see install_events().
+    """
+    cmd_list = _create_args(name, prefix, pkgs)
+    _check_env_not_exists(name, prefix,
+                          _cached_info()['envs_dirs'] if name else None)
+    return _iter_events(_progress_args(cmd_list))
+
+
+def update_events(*pkgs, **kwargs):
+    """
+    Like update(), but yield CondaEvents, see install_events().
+    """
+    cmd_list = _progress_args(_update_args(pkgs, kwargs))
+    return _iter_events(cmd_list, abspath=kwargs.get('abspath', True))
+
+
+def clone_environment_events(clone, name=None, path=None, **kwargs):
+    """
+    Like clone_environment(), but yield CondaEvents, see install_events().
+    """
+    cmd_list = _progress_args(_clone_args(clone, name, path, kwargs))
+    return _iter_events(cmd_list, abspath=kwargs.get('abspath', True))
 
-    if 'error' in result:
-        raise CondaError('conda %s: %s' % (" ".join(cmd_list), result['error']))
 
+def consume_events(events, callback=None):
+    """
+    Consume the CondaEvents from one of the *_events() functions, calling
+    callback(event) for each progress event, and return the final result.
+    """
+    result = None
+    for event in events:
+        if event.kind == 'result':
+            result = event.data
+        elif callback is not None:
+            callback(event)
     return result
 
 
@@ -358,12 +4061,10 @@ def process(name=None, prefix=None, cmd=None, args=None,
     environment specified by name or prefix.
 
     The returned object will need to be invoked with p.communicate() or similar.
+    When timeout is given, the process (and its process group) is killed
+    after timeout seconds.
     """
-    if bool(name) == bool(prefix):
-        raise TypeError('exactly one of name or prefix must be specified')
-
-    if not cmd:
-        raise TypeError('cmd to execute must be specified')
+    _check_process_args(name, prefix, cmd)
 
     if not args:
         args = []
@@ -371,25 +4072,351 @@ def process(name=None, prefix=None, cmd=None, args=None,
     if name:
         prefix = get_prefix_envname(name)
 
-    conda_env = dict(os.environ)
-
-    if sys.platform == 'win32':
-        conda_env['PATH'] = join(prefix, 'Scripts') + os.pathsep + conda_env['PATH']
-    else: # Unix
-        conda_env['PATH'] = join(prefix, 'bin') + os.pathsep + conda_env['PATH']
-
-    conda_env['PATH'] = prefix + os.pathsep + conda_env['PATH']
-
     cmd_list = [cmd]
     cmd_list.extend(args)
 
+    kwargs = _group_kwargs() if timeout is not None else {}
     try:
-        p = Popen(cmd_list, env=conda_env, stdin=stdin, stdout=stdout, stderr=stderr)
+        p = Popen(cmd_list, env=_process_env(prefix),
+                  stdin=stdin, stdout=stdout, stderr=stderr, **kwargs)
     except OSError:
         raise Exception("could not invoke %r\n" % cmd_list)
+    if timeout is not None:
+        timer = threading.Timer(timeout, lambda: p.poll() is None and
+                                _kill_group(p))
+        timer.daemon = True
+        timer.start()
     return p
 
 
+def _check_process_args(name, prefix, cmd):
+    if bool(name) == bool(prefix):
+        raise TypeError('exactly one of name or prefix must be specified')
+
+    if not cmd:
+        raise TypeError('cmd to execute must be specified')
+
+
+def _process_env(prefix):
+    # return the environment for running a process in `prefix`, i.e. the
+    # current environment plus the variables of activating prefix
+    conda_env = dict(os.environ)
+    path, variables = _activation_cache.get(prefix)
+    conda_env.update(variables)
+    conda_env['PATH'] = path + os.pathsep + conda_env.get('PATH', '')
+    return conda_env
+
+
+if sys.platform == 'win32':
+    _SCRIPT_SUFFIX = '.bat'
+    _EXPORT_PAT = re.compile(r'\s*@?set\s+"?([A-Za-z_]\w*)=([^"]*)"?\s*$',
+                             re.I)
+    _VAR_PAT = re.compile(r'%(\w+)%()')
+else:
+    _SCRIPT_SUFFIX = '.sh'
+    _EXPORT_PAT = re.compile(r'\s*export\s+([A-Za-z_]\w*)=(.*?)\s*$')
+    _VAR_PAT = re.compile(r'\$\{(\w+)\}|\$(\w+)')
+
+
+def _parse_export(value, variables):
+    # return the value of a simple (static) shell assignment, with the
+    # given variables expanded, or None when it is not simple
+    if sys.platform != 'win32':
+        if len(value) >= 2 and value[0] == value[-1] == "'":
+            return None if "'" in value[1:-1] else value[1:-1]
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            value = value[1:-1]
+            special = r'["`\\]|\$\('
+        else:
+            special = r'["\'`\\;&|<>()#\s]'
+        if re.search(special, value):
+            return None
+    unknown = []
+
+    def expand(m):
+        name = m.group(1) or m.group(2)
+        if name not in variables:
+            unknown.append(name)
+            return ''
+        return variables[name]
+
+    value = _VAR_PAT.sub(expand, value)
+    return None if unknown else value
+
+
+class _ActivationCache(object):
+    """
+    The variables set by activating prefixes: CONDA_PREFIX and
+    CONDA_DEFAULT_ENV, the env_vars of conda-meta/state (`conda env config
+    vars`), and the simple exports of the etc/conda/activate.d scripts
+    (exports using other commands or unknown variables are ignored).
+    Cached per prefix, until the conda-meta or activate.d directories, or
+    any of the files read, change.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._prefixes = {}
+        self.builds = 0
+
+    @staticmethod
+    def _key(prefix):
+        key = []
+        activate_d = join(prefix, 'etc', 'conda', 'activate.d')
+        for path in (join(prefix, 'conda-meta'),
+                     join(prefix, 'conda-meta', 'state'), activate_d):
+            try:
+                st = os.stat(path)
+            except OSError:
+                key.append(None)
+                continue
+            key.append((st.st_ino, st.st_mtime, st.st_size))
+        if key[-1] is not None:
+            key.extend(_file_keys(activate_d, _SCRIPT_SUFFIX))
+        return tuple(key)
+
+    def get(self, prefix):
+        # return (path, variables) for prefix, where path is to be put in
+        # front of PATH, and variables must not be modified
+        key = self._key(prefix)
+        with self._lock:
+            entry = self._prefixes.get(prefix)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        bin_dir = join(prefix, 'Scripts' if sys.platform == 'win32' else 'bin')
+        path = prefix + os.pathsep + bin_dir
+        variables = self._build(prefix)
+        with self._lock:
+            self.builds += 1
+            self._prefixes[prefix] = (key, (path, variables))
+        return path, variables
+
+    @staticmethod
+    def _build(prefix):
+        if _same_prefix(prefix, _client().root_prefix):
+            env_name = 'base'
+        elif any(_same_prefix(os.path.dirname(normpath(prefix)), d)
+                 for d in _envs_dirs()):
+            env_name = basename(normpath(prefix))
+        else:
+            env_name = prefix
+        variables = {'CONDA_PREFIX': prefix, 'CONDA_DEFAULT_ENV': env_name}
+        try:
+            with open(join(prefix, 'conda-meta', 'state')) as fi:
+                state = json.load(fi)
+            for name, value in state.get('env_vars', {}).items():
+                variables[str(name)] = str(value)
+        except (IOError, OSError, ValueError, AttributeError):
+            pass
+
+        activate_d = join(prefix, 'etc', 'conda', 'activate.d')
+        for fn, mtime, size in _file_keys(activate_d, _SCRIPT_SUFFIX):
+            try:
+                with open(join(activate_d, fn)) as fi:
+                    lines = fi.read().splitlines()
+            except (IOError, OSError, UnicodeDecodeError):
+                continue
+            for line in lines:
+                m = _EXPORT_PAT.match(line)
+                if m is None:
+                    continue
+                value = _parse_export(m.group(2), variables)
+                if value is not None:
+                    variables[m.group(1)] = value
+        return variables
+
+    def invalidate(self, prefix=None):
+        with self._lock:
+            if prefix is None:
+                self._prefixes.clear()
+            else:
+                self._prefixes.pop(prefix, None)
+
+
+_activation_cache = _ActivationCache()
+
+
+class ProcessResult(object):
+    """
+    The outcome of one job of process_many(): its index in the list of jobs,
+    prefix, cmd and args, and the returncode, stdout and stderr of the
+    process.  Only the last max_output bytes of stdout and stderr are kept,
+    truncated is True when output was dropped.  timed_out is True when the
+    process was killed after its timeout, and error is the exception when
+    the process could not be started (returncode is then None).
+    """
+    __slots__ = ('index', 'prefix', 'cmd', 'args', 'returncode', 'stdout',
+                 'stderr', 'truncated', 'timed_out', 'error')
+
+    def __init__(self, index, prefix, cmd, args):
+        self.index = index
+        self.prefix = prefix
+        self.cmd = cmd
+        self.args = args
+        self.returncode = None
+        self.stdout = b''
+        self.stderr = b''
+        self.truncated = False
+        self.timed_out = False
+        self.error = None
+
+    def __repr__(self):
+        return '<ProcessResult %d %s: %r>' % (self.index, self.cmd,
+                                              self.returncode)
+
+
+class _Job(object):
+    # a running process of process_many(), with its bounded output buffers
+    def __init__(self, p, result, max_output, expires):
+        self.p = p
+        self.result = result
+        self.max_output = max_output
+        self.expires = expires
+        self.buffers = {'stdout': bytearray(), 'stderr': bytearray()}
+        self.open = 2
+
+    def append(self, name, data):
+        buf = self.buffers[name]
+        buf.extend(data)
+        if len(buf) > 2 * self.max_output:
+            del buf[:-self.max_output]
+            self.result.truncated = True
+
+    def finish(self):
+        res = self.result
+        res.returncode = self.p.wait()
+        for name, buf in self.buffers.items():
+            if len(buf) > self.max_output:
+                del buf[:-self.max_output]
+                res.truncated = True
+            setattr(res, name, bytes(buf))
+        return res
+
+
+def process_many(jobs, max_workers=4, max_output=65536, timeout=None):
+    """
+    Run many commands in conda environments: `jobs` is a list of
+    (prefix, cmd, args) tuples, each of which is run like process(), with
+    at most max_workers processes running at the same time.  Returns an
+    iterator yielding a ProcessResult for each job as it completes.
+    When timeout is given, a process running longer than timeout seconds
+    is killed (and its result has timed_out set).  The deadline of the
+    current scope (see deadline()) applies to the whole batch.
+    """
+    jobs = list(jobs)
+    for prefix, cmd, args in jobs:
+        _check_process_args(None, prefix, cmd)
+    if max_workers < 1:
+        raise ValueError('max_workers must be at least 1')
+    if sys.platform == 'win32':
+        # pipes cannot be selected on Windows
+        return _process_many_threads(jobs, max_workers, max_output, timeout)
+    return _process_many(jobs, max_workers, max_output, timeout)
+
+
+def _process_many_threads(jobs, max_workers, max_output, timeout):
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    client = _client()
+
+    def run(index, prefix, cmd, args):
+        _local.client = client
+        res = ProcessResult(index, prefix, cmd, list(args or []))
+        try:
+            p = Popen([cmd] + res.args, env=_process_env(prefix),
+                      stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
+                      **_group_kwargs())
+        except OSError as e:
+            res.error = e
+            return res
+        job = _Job(p, res, max_output, None)
+        try:
+            stdout, stderr = p.communicate(timeout=timeout)
+        except TimeoutExpired:
+            res.timed_out = True
+            _kill_group(p)
+            stdout, stderr = p.communicate()
+        job.append('stdout', stdout)
+        job.append('stderr', stderr)
+        return job.finish()
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(run, index, *job)
+                   for index, job in enumerate(jobs)]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def _process_many(jobs, max_workers, max_output, timeout):
+    # run the jobs of process_many(), reading the output of all processes
+    # in a single thread
+    import selectors
+
+    pending = deque(enumerate(jobs))
+    scope_expires, tokens = _current_scope()
+    sel = selectors.DefaultSelector()
+    running = []
+    try:
+        while pending or running:
+            while pending and len(running) < max_workers:
+                index, (prefix, cmd, args) = pending.popleft()
+                res = ProcessResult(index, prefix, cmd, list(args or []))
+                try:
+                    p = Popen([cmd] + res.args, env=_process_env(prefix),
+                              stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
+                              **_group_kwargs())
+                except OSError as e:
+                    res.error = e
+                    yield res
+                    continue
+                expires = None if timeout is None else time.time() + timeout
+                job = _Job(p, res, max_output, expires)
+                for token in tokens:
+                    token._register(p)
+                sel.register(p.stdout, selectors.EVENT_READ, (job, 'stdout'))
+                sel.register(p.stderr, selectors.EVENT_READ, (job, 'stderr'))
+                running.append(job)
+
+            expires = [job.expires for job in running if job.expires]
+            if scope_expires is not None:
+                expires.append(scope_expires)
+            wait = max(0.0, min(expires) - time.time()) if expires else None
+            for key, events in sel.select(wait):
+                job, name = key.data
+                data = os.read(key.fd, 65536)
+                if data:
+                    job.append(name, data)
+                else:
+                    sel.unregister(key.fileobj)
+                    key.fileobj.close()
+                    job.open -= 1
+
+            if any(token.cancelled for token in tokens):
+                raise CondaCancelledError('process_many: cancelled')
+            now = time.time()
+            if scope_expires is not None and now >= scope_expires:
+                raise CondaTimeoutError('process_many: deadline expired')
+            for job in running[:]:
+                if (job.expires is not None and now >= job.expires and
+                        not job.result.timed_out):
+                    job.result.timed_out = True
+                    _kill_group(job.p)
+                if job.open == 0:
+                    running.remove(job)
+                    for token in tokens:
+                        token._unregister(job.p)
+                    yield job.finish()
+    finally:
+        for job in running:
+            for token in tokens:
+                token._unregister(job.p)
+            if job.p.poll() is None:
+                _kill_group(job.p)
+            job.p.wait()
+        for key in list(sel.get_map().values()):
+            key.fileobj.close()
+        sel.close()
+
+
 def _setup_config_from_kwargs(kwargs):
     cmd_list = ['--json', '--force']
 
@@ -402,18 +4429,221 @@ def _setup_config_from_kwargs(kwargs):
     return cmd_list
 
 
+def _rc_path(kwargs):
+    # return the path to the config file conda uses for kwargs
+    if 'file' in kwargs:
+        return kwargs['file']
+    if 'system' in kwargs:
+        return join(_client().root_prefix, '.condarc')
+    return join(expanduser('~'), '.condarc')
+
+
+def _local_config_get(keys, kwargs):
+    # return the values of keys read in-process from the config file, or
+    # None when the file must be read by conda
+    if yaml is None:
+        return None
+    config = _rc_cache.read(_rc_path(kwargs))
+    if config is None:
+        return None
+    if not keys:
+        return copy.deepcopy(config)
+    return dict((key, copy.deepcopy(config[key]))
+                for key in keys if key in config)
+
+
+class _RcCache(object):
+    """
+    Parsed .condarc files, which are only read again when their (inode,
+    mtime, size) changes.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}
+        self.reads = 0
+
+    def read(self, path):
+        # return the (shared) configuration dictionary of the file, which
+        # must not be modified, or None when it cannot be parsed
+        path = normpath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return {}
+        key = (st.st_ino, st.st_mtime, st.st_size)
+        with self._lock:
+            entry = self._files.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        try:
+            with open(path) as fi:
+                config = yaml.safe_load(fi)
+        except (IOError, OSError, yaml.YAMLError):
+            return None
+        if config is None:
+            config = {}
+        elif not isinstance(config, dict):
+            return None
+        with self._lock:
+            self.reads += 1
+            self._files[path] = (key, config)
+        return config
+
+    def invalidate(self):
+        with self._lock:
+            self._files.clear()
+
+
+_rc_cache = _RcCache()
+
+
+def _config_value(value):
+    # parse the value as a YAML scalar, like conda does, e.g. '5' becomes 5
+    # and 'yes' becomes True
+    if isinstance(value, (bool, int, float)):
+        return value
+    value = str(value)
+    lower = value.lower()
+    if lower in ('true', 'yes', 'on', 'y'):
+        return True
+    if lower in ('false', 'no', 'off', 'n'):
+        return False
+    try:
+        parsed = yaml.safe_load(value)
+    except yaml.YAMLError:
+        return value
+    if isinstance(parsed, (bool, int, float)):
+        return parsed
+    return value
+
+
+class ConfigTransaction(object):
+    """
+    A batch of changes to a config file, see config_transaction().  The
+    set, add, remove and delete methods take the same arguments as the
+    config_* functions (without keyword arguments), and return the list
+    of warnings.  Errors raise CondaError when the method is called.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.ops = []
+        self.config = copy.deepcopy(self._read())
+
+    def _read(self):
+        config = _rc_cache.read(self.path)
+        if config is None:
+            raise CondaError('could not parse config file %r' % self.path)
+        return config
+
+    @staticmethod
+    def _apply(config, op, key, value):
+        # apply one operation to the dictionary config, and return the list
+        # of warnings
+        if op == 'set':
+            config[key] = _config_value(value)
+        elif op == 'add':
+            items = config.get(key)
+            if items is None:
+                items = config[key] = ['defaults'] if key == 'channels' else []
+            if not isinstance(items, list):
+                raise CondaError('key %r should be a list, not %s' %
+                                 (key, type(items).__name__))
+            if value in items:
+                items.remove(value)
+                items.insert(0, value)
+                return ["Warning: '%s' already in '%s' list, moving to the top"
+                        % (value, key)]
+            items.insert(0, value)
+        elif op == 'remove':
+            if key not in config:
+                raise CondaError('key %r is not in the config file' % key)
+            if value not in config[key]:
+                raise CondaError('%r is not in the %r key of the config file'
+                                 % (value, key))
+            config[key] = [item for item in config[key] if item != value]
+        else:
+            if key not in config:
+                raise CondaError('key %r is not in the config file' % key)
+            del config[key]
+        return []
+
+    def _queue(self, op, key, value=None):
+        warnings = self._apply(self.config, op, key, value)
+        self.ops.append((op, key, value))
+        return warnings
+
+    def set(self, key, value):
+        return self._queue('set', key, value)
+
+    def add(self, key, value):
+        return self._queue('add', key, value)
+
+    def remove(self, key, value):
+        return self._queue('remove', key, value)
+
+    def delete(self, key):
+        return self._queue('delete', key)
+
+    def commit(self):
+        # replay the operations on the current content of the file (which
+        # may have been changed by others meanwhile), and replace the file
+        if not self.ops:
+            return
+        config = copy.deepcopy(self._read())
+        for op, key, value in self.ops:
+            self._apply(config, op, key, value)
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as fo:
+                yaml.safe_dump(config, fo, default_flow_style=False)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            raise CondaError('could not write config file %r: %s' %
+                             (self.path, e))
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        self.ops = []
+        _client().info_cache.invalidate()
+
+
+@contextmanager
+def config_transaction(**kwargs):
+    """
+    Context manager collecting many changes to a config file (`file` or
+    `system` keyword, as for the config_* functions), which are written
+    at once when the block exits without an exception:
+
+        with config_transaction(file=path) as t:
+            t.set('always_yes', True)
+            t.add('channels', 'wakari')
+
+    The changes are applied in-process, which requires PyYAML, and the
+    file is replaced atomically.  Note that comments in the file are not
+    preserved, and keys and values are not validated as conda would.
+    Values are parsed as YAML scalars (e.g. '5' is written as 5), whereas
+    conda converts them to the type of the parameter (e.g. 10 to 10.0 for
+    a float parameter, and 5 to '5' for a string parameter).
+    """
+    if yaml is None:
+        raise CondaError('config_transaction requires PyYAML')
+    transaction = ConfigTransaction(_rc_path(kwargs))
+    yield transaction
+    transaction.commit()
+
+
 def config_path(**kwargs):
     """
     Get the path to the config file.
     """
+    if yaml is not None:
+        return _rc_path(kwargs)
+
     cmd_list = ['config', '--get']
     cmd_list.extend(_setup_config_from_kwargs(kwargs))
 
     result = _call_and_parse(cmd_list, abspath=kwargs.get('abspath', True))
-
-    if 'error' in result:
-        raise CondaError('conda %s: %s' % (" ".join(cmd_list), result['error']))
-    return result['rc_path']
+    return _check_result(cmd_list, result)['rc_path']
 
 
 def config_get(*keys, **kwargs):
@@ -422,16 +4652,19 @@ def config_get(*keys, **kwargs):
 
     Returns a dictionary of values. Note, the key may not be in the
     dictionary if the key wasn't set in the configuration file.
+    The file is read in-process (when PyYAML is available), and only read
+    again when it changes.
     """
+    result = _local_config_get(keys, kwargs)
+    if result is not None:
+        return result
+
     cmd_list = ['config', '--get']
     cmd_list.extend(keys)
     cmd_list.extend(_setup_config_from_kwargs(kwargs))
 
     result = _call_and_parse(cmd_list, abspath=kwargs.get('abspath', True))
-
-    if 'error' in result:
-        raise CondaError('conda %s: %s' % (" ".join(cmd_list), result['error']))
-    return result['get']
+    return _check_result(cmd_list, result)['get']
 
 
 def config_set(key, value, **kwargs):
@@ -444,10 +4677,7 @@ def config_set(key, value, **kwargs):
     cmd_list.extend(_setup_config_from_kwargs(kwargs))
 
     result = _call_and_parse(cmd_list, abspath=kwargs.get('abspath', True))
-
-    if 'error' in result:
-        raise CondaError('conda %s: %s' % (" ".join(cmd_list), result['error']))
-    return result.get('warnings', [])
+    return _check_result(cmd_list, result).get('warnings', [])
 
 
 def config_add(key, value, **kwargs):
@@ -460,10 +4690,7 @@ def config_add(key, value, **kwargs):
     cmd_list.extend(_setup_config_from_kwargs(kwargs))
 
     result = _call_and_parse(cmd_list, abspath=kwargs.get('abspath', True))
-
-    if 'error' in result:
-        raise CondaError('conda %s: %s' % (" ".join(cmd_list), result['error']))
-    return result.get('warnings', [])
+    return _check_result(cmd_list, result).get('warnings', [])
 
 
 def config_remove(key, value, **kwargs):
@@ -476,10 +4703,7 @@ def config_remove(key, value, **kwargs):
     cmd_list.extend(_setup_config_from_kwargs(kwargs))
 
     result = _call_and_parse(cmd_list, abspath=kwargs.get('abspath', True))
-
-    if 'error' in result:
-        raise CondaError('conda %s: %s' % (" ".join(cmd_list), result['error']))
-    return result.get('warnings', [])
+    return _check_result(cmd_list, result).get('warnings', [])
 
 
 def config_delete(key, **kwargs):
@@ -492,10 +4716,7 @@ def config_delete(key, **kwargs):
     cmd_list.extend(_setup_config_from_kwargs(kwargs))
 
     result = _call_and_parse(cmd_list, abspath=kwargs.get('abspath', True))
-
-    if 'error' in result:
-        raise CondaError('conda %s: %s' % (" ".join(cmd_list), result['error']))
-    return result.get('warnings', [])
+    return _check_result(cmd_list, result).get('warnings', [])
 
 
 def run(command, abspath=True):
@@ -508,10 +4729,150 @@ def run(command, abspath=True):
     cmd_list = ['run', '--json', command]
 
     result = _call_and_parse(cmd_list, abspath=abspath)
+    return _check_result(cmd_list, result)
 
-    if 'error' in result:
-        raise CondaError('conda %s: %s' % (" ".join(cmd_list), result['error']))
-    return result
+
+class CondaClient(object):
+    """
+    A conda installation, given by its root prefix (by default, the root
+    prefix of the conda on PATH), which owns its state: the cached result
+    of `conda info`, the persistent worker, the instrumentation hooks, the
+    repodata and file indexes, the mutation scheduler, and the read-only
+    calls in flight.  The functions
+    of this module are available as methods, e.g.
+
+        client = CondaClient('/opt/anaconda')
+        client.install(prefix='/opt/anaconda/envs/test', pkgs=['numpy'])
+
+    Methods are safe to call from many threads, such that clients of
+    different conda installations can be used in parallel.  The module
+    level functions use the default client, whose root prefix is
+    ROOT_PREFIX (see set_root_prefix).  Caches which are keyed on paths,
+    such as the parsed conda-meta records, are shared by all clients.
+    """
+    def __init__(self, root_prefix=None):
+        self._init_state()
+        with self.use():
+            set_root_prefix(root_prefix)
+
+    def _init_state(self):
+        self._lock = threading.RLock()
+        self.info_cache = _InfoCache()
+        self.worker = None
+        self.hooks = []
+        self.repodata_index = None
+        self.file_index = None
+        self.mutation_scheduler = None
+        self.single_flight = _SingleFlight()
+
+    @contextmanager
+    def use(self):
+        """
+        Context manager making the module level functions (and the classes
+        such as Watcher or RepodataIndex created) in the block, use this
+        client in the current thread.
+        """
+        prev = getattr(_local, 'client', None)
+        _local.client = self
+        try:
+            yield self
+        finally:
+            _local.client = prev
+
+    def close(self):
+        """
+        Stop the worker of the client, and close its file index.
+        """
+        with self.use():
+            stop_worker()
+        with self._lock:
+            if self.file_index is not None:
+                self.file_index.close()
+                self.file_index = None
+
+    def __repr__(self):
+        return '<CondaClient %s>' % self.root_prefix
+
+
+class _DefaultClient(CondaClient):
+    # the client of the module level functions, whose root prefix is the
+    # module global ROOT_PREFIX
+    def __init__(self):
+        self._init_state()
+
+    @property
+    def root_prefix(self):
+        return globals().get('ROOT_PREFIX')
+
+    @root_prefix.setter
+    def root_prefix(self, prefix):
+        global ROOT_PREFIX
+
+        ROOT_PREFIX = prefix
+
+
+class _BoundContext(object):
+    # a context manager entered and exited using client
+    def __init__(self, client, context):
+        self.client = client
+        self.context = context
+
+    def __enter__(self):
+        with self.client.use():
+            return self.context.__enter__()
+
+    def __exit__(self, *exc_info):
+        with self.client.use():
+            return self.context.__exit__(*exc_info)
+
+
+def _iter_bound(client, iterator):
+    # iterate over iterator (a generator) using client
+    while True:
+        with client.use():
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def _client_method(func):
+    # return the CondaClient method calling the module function func
+    def method(self, *args, **kwargs):
+        with self.use():
+            result = func(*args, **kwargs)
+        if isinstance(result, types.GeneratorType):
+            return _iter_bound(self, result)
+        if hasattr(result, '__enter__') and hasattr(result, 'gen'):
+            # a context manager created by contextlib.contextmanager
+            return _BoundContext(self, result)
+        return result
+
+    method.__name__ = func.__name__
+    method.__doc__ = func.__doc__
+    return method
+
+
+for _name in ('start_worker', 'stop_worker', 'add_hook', 'remove_hook',
+              'collect_metrics', 'set_root_prefix', 'get_conda_version',
+              'get_envs', 'get_prefix_envname', 'linked', 'linked_records',
+              'set_info_ttl', 'refresh', 'info_cache_stats', 'info',
+              'package_info', 'package_info_many', 'repodata_index',
+              'outdated_report', 'file_index', 'disk_usage', 'search',
+              'search_iter', 'create', 'install', 'update', 'remove',
+              'remove_environment', 'clone_environment', 'export_explicit',
+              'verify_explicit', 'create_from_explicit', 'install_plan',
+              'prefetch', 'install_many', 'update_many', 'remove_many',
+              'mutation_scheduler', 'install_events', 'create_events',
+              'update_events', 'clone_environment_events', 'process',
+              'process_many', 'config_transaction', 'config_path',
+              'config_get', 'config_set', 'config_add', 'config_remove',
+              'config_delete', 'run'):
+    setattr(CondaClient, _name, _client_method(globals()[_name]))
+del _name
+
+_default_client = _DefaultClient()
 
 
 def test():
@@ -0,0 +1,465 @@
+"""
+asyncio interface to conda.
+
+Every function mirrors the function of the same name in conda_api, with
+the same arguments, return values and errors, but is a coroutine which runs
+conda using asyncio.create_subprocess_exec, such that many calls may be in
+flight concurrently without blocking the event loop.  The root prefix is
+shared with conda_api (see conda_api.set_root_prefix).
+
+This module requires Python 3.7 (or above).
+"""
+import copy
+import time
+import asyncio
+from asyncio.subprocess import PIPE
+
+import conda_api
+from conda_api import CondaTimeoutError, CondaCancelledError
+
+
+async def _execute(extra_args, abspath=True):
+    # call conda with the list of extra arguments, and return the tuple
+    # stdout, stderr, record (see conda_api.CallRecord).  The call is
+    # subject to the deadline and cancel tokens of the current scope (see
+    # conda_api.deadline), like in conda_api.
+    record = conda_api.CallRecord(extra_args)
+    cmd_list = conda_api._conda_cmd_list(extra_args, abspath=abspath)
+    expires, tokens = conda_api._current_scope()
+    t0 = time.time()
+    try:
+        if any(token.cancelled for token in tokens):
+            raise CondaCancelledError('%r: cancelled' % cmd_list)
+        if expires is not None and time.time() >= expires:
+            raise CondaTimeoutError('%r: deadline expired' % cmd_list)
+        try:
+            p = await asyncio.create_subprocess_exec(
+                *cmd_list, stdout=PIPE, stderr=PIPE,
+                **conda_api._group_kwargs())
+        except OSError:
+            raise Exception("could not invoke %r\n" % cmd_list)
+        record.spawn_time = time.time() - t0
+        for token in tokens:
+            token._register(p)
+        # read the output until EOF (also after the process was killed),
+        # such that the partial output is available on timeouts
+        output = asyncio.ensure_future(asyncio.gather(
+            p.stdout.read(), p.stderr.read(), p.wait()))
+        timed_out = False
+        try:
+            try:
+                stdout, stderr, returncode = await asyncio.wait_for(
+                    asyncio.shield(output),
+                    None if expires is None else max(0.0,
+                                                     expires - time.time()))
+            except asyncio.TimeoutError:
+                timed_out = True
+                conda_api._kill_group(p)
+                stdout, stderr, returncode = await output
+        except asyncio.CancelledError:
+            # e.g. asyncio.wait_for timed out, kill conda and its children
+            if p.returncode is None:
+                conda_api._kill_group(p)
+            raise
+        finally:
+            for token in tokens:
+                token._unregister(p)
+            record.returncode = p.returncode
+            conda_api._invalidate_after(extra_args)
+        if timed_out:
+            record.stdout_bytes = len(stdout)
+            record.stderr_bytes = len(stderr)
+            raise CondaTimeoutError(
+                'conda %r: timed out\nSTDERR:\n%s\nEND' % (
+                    cmd_list, stderr.decode('utf-8', 'replace')),
+                stdout, stderr)
+        if any(token.cancelled for token in tokens):
+            record.stdout_bytes = len(stdout)
+            record.stderr_bytes = len(stderr)
+            raise CondaCancelledError('conda %r: cancelled' % cmd_list,
+                                      stdout, stderr)
+    except BaseException as e:
+        record.wall_time = time.time() - t0
+        record.error = type(e).__name__
+        conda_api._emit(record)
+        raise
+    record.wall_time = time.time() - t0
+    record.stdout_bytes = len(stdout)
+    record.stderr_bytes = len(stderr)
+    return stdout, stderr, record
+
+
+async def _call_conda(extra_args, abspath=True):
+    # call conda with the list of extra arguments, and return the tuple
+    # stdout, stderr
+    stdout, stderr, record = await _execute(extra_args, abspath=abspath)
+    conda_api._emit(record)
+    return stdout, stderr
+
+
+async def _call_and_parse_record(extra_args, abspath=True):
+    # call conda with the list of extra arguments, and return the tuple
+    # (parsed output, CallRecord)
+    stdout, stderr, record = await _execute(extra_args, abspath=abspath)
+    t0 = time.time()
+    try:
+        return conda_api._parse_output(extra_args, stdout, stderr), record
+    except Exception as e:
+        record.error = type(e).__name__
+        raise
+    finally:
+        record.decode_time = time.time() - t0
+        conda_api._emit(record)
+
+
+# read-only calls in flight, mapping (event loop, client, argv, abspath,
+# info cache generation) to [task, number of awaiting coroutines], see
+# conda_api._SingleFlight
+_flights = {}
+
+
+async def _call_and_parse(extra_args, abspath=True):
+    if not conda_api._is_read_only(extra_args):
+        return (await _call_and_parse_record(extra_args, abspath))[0]
+
+    # concurrent identical calls (on the same event loop) await the same
+    # task, which is only cancelled when all of them are cancelled
+    loop = asyncio.get_running_loop()
+    client = conda_api._client()
+    key = (loop, client, tuple(extra_args), abspath,
+           client.info_cache.generation())
+    flight = _flights.get(key)
+    leader = flight is None
+    if leader:
+        task = loop.create_task(_call_and_parse_record(extra_args, abspath))
+        flight = _flights[key] = [task, 0]
+
+        def land(task):
+            if _flights.get(key) is flight:
+                del _flights[key]
+
+        task.add_done_callback(land)
+
+    record = None
+    if not leader:
+        record = conda_api.CallRecord(extra_args)
+        record.coalesced = True
+    flight[1] += 1
+    t0 = time.time()
+    try:
+        result, leader_record = await asyncio.shield(flight[0])
+        if record is not None:
+            record.returncode = leader_record.returncode
+    except asyncio.CancelledError:
+        flight[1] -= 1
+        if flight[1] == 0:
+            flight[0].cancel()
+        if record is not None:
+            record.error = 'CancelledError'
+        raise
+    except Exception as e:
+        if record is not None:
+            record.error = type(e).__name__
+        raise
+    finally:
+        if record is not None:
+            record.wall_time = time.time() - t0
+            conda_api._emit(record)
+    # the result of the task is shared by all callers which awaited it, so
+    # each one gets its own copy, unless there is no other
+    return result if flight[1] == 1 else copy.deepcopy(result)
+
+
+async def _cached_info(abspath=True):
+    # return the (shared) cached info dictionary, see conda_api._cached_info
+    cache = conda_api._client().info_cache
+    info = cache.get(abspath)
+    if info is None:
+        generation = cache.generation()
+        info = await _call_and_parse(['info', '--json'], abspath=abspath)
+        cache.put(abspath, info, generation)
+    return info
+
+
+async def _cached_plan(cmd_list, abspath=True):
+    # return the (checked) result of the dry run cmd_list, from the (shared)
+    # plan cache when possible, see conda_api._cached_plan
+    cache = conda_api._plan_cache
+    key = conda_api._plan_key(cmd_list) if cache is not None else None
+    if key is not None:
+        plan = cache.get(key)
+        if plan is not None:
+            return plan
+    result = conda_api._check_result(
+        cmd_list, await _call_and_parse(cmd_list, abspath=abspath))
+    if key is not None:
+        cache.put(key, result)
+    return result
+
+
+async def set_root_prefix(prefix=None):
+    """
+    Set the prefix to the root environment (default is /opt/anaconda).
+    See conda_api.set_root_prefix.
+    """
+    if not prefix:
+        # find some conda instance, and then use info to get 'root_prefix'
+        info = await _call_and_parse(['info', '--json'], abspath=False)
+        prefix = info['root_prefix']
+    conda_api.set_root_prefix(prefix)
+
+
+async def get_conda_version():
+    """
+    return the version of conda being used (invoked) as a string
+    """
+    stdout, stderr = await _call_conda(['--version'])
+    return conda_api._parse_conda_version(stdout, stderr)
+
+
+async def get_envs(verify=False):
+    """
+    Return all of the (named) environment (this does not include the root
+    environment), as a list of absolute path to their prefixes.
+    See conda_api.get_envs.
+    """
+    if verify:
+        # make sure the conda info result is cached, without blocking
+        await _cached_info()
+    return conda_api.get_envs(verify)
+
+
+async def get_prefix_envname(name):
+    """
+    Given the name of an environment return its full prefix path, or None
+    if it cannot be found.
+    """
+    if name == 'root':
+        return conda_api._client().root_prefix
+    for prefix in await get_envs():
+        if conda_api.basename(prefix) == name:
+            return prefix
+    return None
+
+
+async def info(abspath=True):
+    """
+    Return a dictionary with configuration information.
+    The result is cached, see conda_api.set_info_ttl().
+    """
+    return copy.deepcopy(await _cached_info(abspath))
+
+
+async def package_info(package, abspath=True, local=True):
+    """
+    Return a dictionary with package information.
+    """
+    return await package_info_many([package], abspath=abspath, local=local)
+
+
+async def package_info_many(pkgs, abspath=True, local=True):
+    """
+    Return a dictionary with the package information of all `pkgs`,
+    see conda_api.package_info_many.
+    """
+    res = {}
+    missing = []
+    index = conda_api._local_package_index() if local else {}
+    for package in pkgs:
+        records = conda_api._local_package_info(index, package)
+        if records is None:
+            missing.append(package)
+        else:
+            res[package] = records
+    if missing:
+        res.update(await _call_and_parse(['info'] + missing + ['--json'],
+                                         abspath=abspath))
+    return res
+
+
+async def search(regex=None, spec=None, **kwargs):
+    """
+    Search for packages, see conda_api.search.
+    """
+    local_index = kwargs.pop('local_index', False)
+    index_kwargs = dict(kwargs)
+    cmd_list = conda_api._search_args(regex, spec, kwargs)
+    if local_index:
+        if index_kwargs.get('env'):
+            index_kwargs['prefix'] = await get_prefix_envname(
+                index_kwargs.pop('env'))
+        result = conda_api._local_search(regex, spec, index_kwargs)
+        if result is not None:
+            return result
+    return await _call_and_parse(cmd_list, abspath=kwargs.get('abspath', True))
+
+
+async def create(name=None, prefix=None, pkgs=None):
+    """
+    Create an environment either by name or path with a specified set of
+    packages
+    """
+    cmd_list = conda_api._create_args(name, prefix, pkgs)
+    envs_dirs = (await _cached_info())['envs_dirs'] if name else None
+    conda_api._check_env_not_exists(name, prefix, envs_dirs)
+    return conda_api._check_output(cmd_list, *await _call_conda(cmd_list))
+
+
+async def install(name=None, prefix=None, pkgs=None):
+    """
+    Install packages into an environment either by name or path with a
+    specified set of packages
+    """
+    cmd_list = conda_api._install_args(name, prefix, pkgs)
+    return conda_api._check_output(cmd_list, *await _call_conda(cmd_list))
+
+
+async def install_plan(name=None, prefix=None, pkgs=None, **kwargs):
+    """
+    Return the plan of installing packages into an environment, see
+    conda_api.install_plan.
+    """
+    cmd_list = conda_api._install_plan_args(name, prefix, pkgs, kwargs)
+    return await _cached_plan(cmd_list, kwargs.get('abspath', True))
+
+
+async def update(*pkgs, **kwargs):
+    """
+    Update package(s) (in an environment) by name.
+    """
+    cmd_list = conda_api._update_args(pkgs, kwargs)
+    if '--dry-run' in cmd_list:
+        return await _cached_plan(cmd_list, kwargs.get('abspath', True))
+    result = await _call_and_parse(cmd_list,
+                                   abspath=kwargs.get('abspath', True))
+    return conda_api._check_result(cmd_list, result)
+
+
+async def remove(*pkgs, **kwargs):
+    """
+    Remove a package (from an environment) by name.
+    """
+    cmd_list = conda_api._remove_args(pkgs, kwargs)
+    if '--dry-run' in cmd_list:
+        return await _cached_plan(cmd_list, kwargs.get('abspath', True))
+    result = await _call_and_parse(cmd_list,
+                                   abspath=kwargs.get('abspath', True))
+    return conda_api._check_result(cmd_list, result)
+
+
+async def remove_environment(name=None, path=None, **kwargs):
+    """
+    Remove an environment entirely.
+    """
+    return await remove(name=name, path=path, all=True, **kwargs)
+
+
+async def clone_environment(clone, name=None, path=None, **kwargs):
+    """
+    Clone the environment ``clone`` into ``name`` or ``path``.
+    """
+    cmd_list = conda_api._clone_args(clone, name, path, kwargs)
+    if '--dry-run' in cmd_list:
+        return await _cached_plan(cmd_list, kwargs.get('abspath', True))
+    result = await _call_and_parse(cmd_list,
+                                   abspath=kwargs.get('abspath', True))
+    return conda_api._check_result(cmd_list, result)
+
+
+async def process(name=None, prefix=None, cmd=None, args=None,
+                  stdin=None, stdout=None, stderr=None, timeout=None):
+    """
+    Create an asyncio.subprocess.Process for cmd using the specified args
+    but in the conda environment specified by name or prefix.
+    When timeout is given, the process (and its process group) is killed
+    after timeout seconds, see conda_api.process.
+    """
+    conda_api._check_process_args(name, prefix, cmd)
+
+    if not args:
+        args = []
+
+    if name:
+        prefix = await get_prefix_envname(name)
+
+    cmd_list = [cmd]
+    cmd_list.extend(args)
+
+    kwargs = conda_api._group_kwargs() if timeout is not None else {}
+    try:
+        p = await asyncio.create_subprocess_exec(
+            *cmd_list, env=conda_api._process_env(prefix),
+            stdin=stdin, stdout=stdout, stderr=stderr, **kwargs)
+    except OSError:
+        raise Exception("could not invoke %r\n" % cmd_list)
+    if timeout is not None:
+        asyncio.get_running_loop().call_later(
+            timeout, lambda: p.returncode is None and conda_api._kill_group(p))
+    return p
+
+
+async def _config(cmd_list, kwargs):
+    cmd_list.extend(conda_api._setup_config_from_kwargs(kwargs))
+    result = await _call_and_parse(cmd_list,
+                                   abspath=kwargs.get('abspath', True))
+    return conda_api._check_result(cmd_list, result)
+
+
+async def config_path(**kwargs):
+    """
+    Get the path to the config file.
+    """
+    if conda_api.yaml is not None:
+        return conda_api._rc_path(kwargs)
+    return (await _config(['config', '--get'], kwargs))['rc_path']
+
+
+async def config_get(*keys, **kwargs):
+    """
+    Get the values of configuration keys, see conda_api.config_get.
+    """
+    result = conda_api._local_config_get(keys, kwargs)
+    if result is not None:
+        return result
+    return (await _config(['config', '--get'] + list(keys), kwargs))['get']
+
+
+async def config_set(key, value, **kwargs):
+    """
+    Set a key to a (bool) value.
+    """
+    result = await _config(['config', '--set', key, str(value)], kwargs)
+    return result.get('warnings', [])
+
+
+async def config_add(key, value, **kwargs):
+    """
+    Add a value to a key.
+    """
+    result = await _config(['config', '--add', key, value], kwargs)
+    return result.get('warnings', [])
+
+
+async def config_remove(key, value, **kwargs):
+    """
+    Remove a value from a key.
+    """
+    result = await _config(['config', '--remove', key, value], kwargs)
+    return result.get('warnings', [])
+
+
+async def config_delete(key, **kwargs):
+    """
+    Remove a key entirely.
+    """
+    result = await _config(['config', '--remove-key', key], kwargs)
+    return result.get('warnings', [])
+
+
+async def run(command, abspath=True):
+    """
+    Launch the specified app by name or full package name.
+    """
+    cmd_list = ['run', '--json', command]
+    result = await _call_and_parse(cmd_list, abspath=abspath)
+    return conda_api._check_result(cmd_list, result)
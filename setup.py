@@ -20,11 +20,12 @@ setup(
     author_email = "ilan@continuum.io",
     license = "BSD",
     description = "light weight conda interface library",
-    py_modules = ['conda_api'],
+    py_modules = ['conda_api', 'conda_api_aio'],
     classifiers = [
-        "Programming Language :: Python :: 2.6",
-        "Programming Language :: Python :: 2.7",
-        "Programming Language :: Python :: 3.3",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
     ],
     **kwds
 )
@@ -1,6 +1,10 @@
 import os
+import json
+import shutil
 import sys
 import tempfile
+import threading
+import time
 import unittest
 
 import conda_api
@@ -51,12 +55,13 @@ class TestApi(unittest.TestCase):
         except conda_api.CondaError as e:
             self.fail("install fails: %s" % e)
 
-        for pkg in conda_api.linked(self.prefix):
-            info = conda_api.package_info(pkg + '.tar.bz2')
+        fns = [pkg + '.tar.bz2' for pkg in conda_api.linked(self.prefix)]
+        info = conda_api.package_info_many(fns)
+        for fn in fns:
             # info isn't necessarily complete because conda info only checks
             # prefixes in default prefix dirs and there isn't a way to
             # specify a prefix to check yet
-            self.assertIn(pkg + '.tar.bz2', info)
+            self.assertIn(fn, info)
 
         try:
             result = conda_api.update('python', path=self.prefix)
@@ -88,6 +93,29 @@ class TestApi(unittest.TestCase):
         self.assertIsInstance(result['ipython'], list)
         self.assertIsInstance(result['ipython'][0], dict)
 
+    def test_config_transaction(self):
+        # the values written in-process are the ones conda writes
+        values = [('remote_max_retries', '5'),
+                  ('remote_read_timeout_secs', '60.5'),
+                  ('always_yes', 'yes'), ('ssl_verify', 'False'),
+                  ('channel_priority', 'strict')]
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for key, value in values:
+                conda_api.config_set(key, value, file=path)
+            for channel in 'defaults', 'wakari', 'conda-forge', 'wakari':
+                conda_api.config_add('channels', channel, file=path)
+            with conda_api.config_transaction(file=self.config) as t:
+                for key, value in values:
+                    t.set(key, value)
+                for channel in 'defaults', 'wakari', 'conda-forge', 'wakari':
+                    t.add('channels', channel)
+            self.assertEqual(conda_api.config_get(file=self.config),
+                             conda_api.config_get(file=path))
+        finally:
+            os.remove(path)
+
     def test_config(self):
         self.assertIsInstance(conda_api.config_path(), text_type)
         self.assertEqual(conda_api.config_set('use_pip', False, file=self.config), [])
@@ -98,3 +126,1889 @@ class TestApi(unittest.TestCase):
         self.assertEqual(conda_api.config_get('channels', file=self.config).get('channels', []), [])
         self.assertEqual(conda_api.config_delete('use_pip', file=self.config), [])
         self.assertEqual(conda_api.config_get('use_pip', file=self.config), {})
+
+
+# Tests below do not need a conda installation, they run against small
+# stand-in scripts in a fake root prefix.
+
+FAKE_CONDA = '''\
+import os
+import json
+import sys
+root = os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0])))
+result = {'args': sys.argv[1:], 'worker': False}
+if sys.argv[1:] == ['info', '--json']:
+    envs_dir = os.path.join(root, 'envs')
+    envs = sorted(os.listdir(envs_dir)) if os.path.isdir(envs_dir) else []
+    result.update(root_prefix=root, envs_dirs=[envs_dir],
+                  envs=[os.path.join(envs_dir, e) for e in envs])
+sys.stdout.write(json.dumps(result))
+'''
+
+FAKE_WORKER = '''\
+import sys
+import json
+for line in iter(sys.stdin.readline, ''):
+    request = json.loads(line)
+    stdout = json.dumps({'args': request['args'], 'worker': True})
+    sys.stdout.write(json.dumps({'id': request['id'], 'stdout': stdout,
+                                 'stderr': '', 'returncode': 0}) + '\\n')
+    sys.stdout.flush()
+'''
+
+
+def make_fake_root(conda_source=FAKE_CONDA):
+    """
+    Create a fake root prefix, whose bin/python is the current interpreter
+    and bin/conda is the script `conda_source`.
+    """
+    root = tempfile.mkdtemp()
+    os.mkdir(os.path.join(root, 'bin'))
+    os.symlink(sys.executable, os.path.join(root, 'bin', 'python'))
+    with open(os.path.join(root, 'bin', 'conda'), 'w') as fo:
+        fo.write(conda_source)
+    return root
+
+
+class FakeRootTestCase(unittest.TestCase):
+    conda_source = FAKE_CONDA
+
+    def setUp(self):
+        self.old_root_prefix = getattr(conda_api, 'ROOT_PREFIX', None)
+        self.root = make_fake_root(self.conda_source)
+        conda_api.set_root_prefix(self.root)
+
+    def tearDown(self):
+        conda_api.stop_worker()
+        conda_api.set_info_ttl(60.0)
+        conda_api.ROOT_PREFIX = self.old_root_prefix
+        shutil.rmtree(self.root)
+
+    def write_script(self, source):
+        path = os.path.join(self.root, 'script-%d.py' % len(os.listdir(self.root)))
+        with open(path, 'w') as fo:
+            fo.write(source)
+        return path
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestWorker(FakeRootTestCase):
+    def test_routing_and_fallback(self):
+        conda_api.set_info_ttl(0)
+        self.assertFalse(conda_api.info()['worker'])
+        worker = conda_api.start_worker(
+            [sys.executable, '-u', self.write_script(FAKE_WORKER)])
+        self.assertTrue(worker.alive)
+        for i in range(3):
+            self.assertEqual(conda_api.info(), {'args': ['info', '--json'],
+                                                'worker': True})
+
+        # kill the worker, calls transparently fall back to a new process
+        worker._proc.kill()
+        worker._proc.wait()
+        self.assertFalse(conda_api.info()['worker'])
+        self.assertIsNone(conda_api._client().worker)
+
+    def test_no_fallback_after_sent(self):
+        # a worker which dies while handling the request
+        conda_api.start_worker([sys.executable, '-u', self.write_script(
+            'import sys\nsys.stdin.readline()\n')])
+        with conda_api.collect_metrics() as metrics:
+            self.assertRaises(conda_api.CondaWorkerError, conda_api.install,
+                              prefix='/tmp/x', pkgs=['numpy'])
+        # the install was not run again in a new process
+        self.assertEqual([r.error for r in metrics.records],
+                         ['CondaWorkerError'])
+        self.assertIsNone(conda_api._client().worker)
+        self.assertFalse(conda_api.info()['worker'])
+
+    def test_deadline_while_queued(self):
+        # a worker which takes 1.5 seconds for each install
+        script = self.write_script(FAKE_WORKER.replace(
+            '    request = json.loads(line)\n',
+            '    request = json.loads(line)\n'
+            '    if "install" in request["args"]:\n'
+            '        import time; time.sleep(1.5)\n'))
+        worker = conda_api.start_worker([sys.executable, '-u', script])
+        conda_api.set_info_ttl(0)
+        install = threading.Thread(target=conda_api.install,
+                                   kwargs={'prefix': '/tmp/x',
+                                           'pkgs': ['numpy']})
+        install.start()
+        time.sleep(0.2)
+        t0 = time.time()
+        with conda_api.deadline(0.3):
+            self.assertRaises(conda_api.CondaTimeoutError, conda_api.info)
+        self.assertLess(time.time() - t0, 1.0)
+
+        token = conda_api.CancelToken()
+        threading.Timer(0.2, token.cancel).start()
+        with conda_api.deadline(cancel=token):
+            self.assertRaises(conda_api.CondaCancelledError, conda_api.info)
+        install.join()
+        # neither request was sent, and the worker is still serving calls
+        self.assertEqual(worker._counter, 1)
+        self.assertTrue(worker.alive)
+        self.assertTrue(conda_api.info()['worker'])
+
+    def test_start_failure(self):
+        self.assertRaises(conda_api.CondaWorkerError, conda_api.start_worker,
+                          [os.path.join(self.root, 'does-not-exist')])
+
+
+@unittest.skipIf(sys.platform == 'win32' or sys.version_info < (3, 7),
+                 'needs asyncio.run and a posix fake root prefix')
+class TestAsyncio(FakeRootTestCase):
+    def test_concurrent_calls(self):
+        import asyncio
+        import conda_api_aio
+
+        async def main():
+            return await asyncio.gather(
+                conda_api_aio.info(),
+                conda_api_aio.search(spec='ipython', channel='wakari'),
+                conda_api_aio.update('python', prefix='/tmp/x', dry_run=True),
+                conda_api_aio.config_set('use_pip', False, file='rc'))
+
+        info, search, update, config = asyncio.run(main())
+        self.assertEqual(info['args'], ['info', '--json'])
+        self.assertEqual(search['args'], conda_api._search_args(
+            None, 'ipython', {'channel': 'wakari'}))
+        self.assertEqual(update['args'], conda_api._update_args(
+            ('python',), {'prefix': '/tmp/x', 'dry_run': True}))
+        self.assertEqual(config, [])
+
+    def test_argument_errors(self):
+        import asyncio
+        import conda_api_aio
+
+        self.assertRaises(TypeError, asyncio.run,
+                          conda_api_aio.search(regex='test', spec='test'))
+        self.assertRaises(TypeError, asyncio.run,
+                          conda_api_aio.install(prefix=self.root))
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestInfoCache(FakeRootTestCase):
+    def test_hits_and_invalidation(self):
+        stats = conda_api.info_cache_stats()
+        d = conda_api.info()
+        d['envs'].append('modified')
+        self.assertEqual(conda_api.info()['envs'], [])
+        self.assertEqual(conda_api.info()['envs'], [])
+        self.assertEqual(conda_api.info_cache_stats()['misses'],
+                         stats['misses'] + 1)
+        self.assertEqual(conda_api.info_cache_stats()['hits'],
+                         stats['hits'] + 2)
+
+        # a (fake) environment is created, the cache is invalidated
+        os.makedirs(os.path.join(self.root, 'envs', 'foo'))
+        self.assertEqual(conda_api.info()['envs'], [])
+        conda_api.config_set('use_pip', False, file='rc')
+        self.assertEqual(conda_api.info()['envs'],
+                         [os.path.join(self.root, 'envs', 'foo')])
+        self.assertRaises(conda_api.CondaEnvExistsError, conda_api.create,
+                          name='foo', pkgs=['python'])
+
+        os.makedirs(os.path.join(self.root, 'envs', 'bar'))
+        conda_api.refresh()
+        self.assertEqual(len(conda_api.info()['envs']), 2)
+
+    def test_ttl(self):
+        conda_api.set_info_ttl(0)
+        stats = conda_api.info_cache_stats()
+        conda_api.info()
+        conda_api.info()
+        self.assertEqual(conda_api.info_cache_stats()['misses'],
+                         stats['misses'] + 2)
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestDiscoverEnvs(FakeRootTestCase):
+    def setUp(self):
+        FakeRootTestCase.setUp(self)
+        self.old_home = os.environ.get('HOME')
+        os.environ['HOME'] = self.home = tempfile.mkdtemp()
+        for name in 'b', 'a', 'not-an-env':
+            os.makedirs(os.path.join(self.root, 'envs', name))
+        for name in 'b', 'a':
+            os.mkdir(os.path.join(self.root, 'envs', name, 'conda-meta'))
+
+    def tearDown(self):
+        os.environ['HOME'] = self.old_home
+        shutil.rmtree(self.home)
+        FakeRootTestCase.tearDown(self)
+
+    def test_discover(self):
+        envs_dir = os.path.join(self.root, 'envs')
+        elsewhere = os.path.join(self.home, 'elsewhere')
+        os.makedirs(os.path.join(elsewhere, 'conda-meta'))
+        os.mkdir(os.path.join(self.home, '.conda'))
+        with open(os.path.join(self.home, '.conda', 'environments.txt'),
+                  'w') as fo:
+            fo.write('%s\n%s\n/no/such/env\n' % (self.root, elsewhere))
+
+        stats = conda_api.info_cache_stats()
+        self.assertEqual(conda_api.get_envs(),
+                         [os.path.join(envs_dir, 'a'),
+                          os.path.join(envs_dir, 'b'), elsewhere])
+        self.assertEqual(conda_api.get_prefix_envname('b'),
+                         os.path.join(envs_dir, 'b'))
+        self.assertEqual(conda_api.get_prefix_envname('root'), self.root)
+        self.assertEqual(conda_api.info_cache_stats(), stats)
+
+    def test_verify(self):
+        import warnings
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            envs = conda_api.get_envs(verify=True)
+        # the fake conda reports 'not-an-env', which has no conda-meta
+        self.assertEqual(len(w), 1)
+        self.assertEqual(len(envs), 3)
+
+        shutil.rmtree(os.path.join(self.root, 'envs', 'not-an-env'))
+        conda_api.refresh()
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            envs = conda_api.get_envs(verify=True)
+        self.assertEqual(len(w), 0)
+        self.assertEqual(len(envs), 2)
+
+
+def write_meta(prefix, name, version, build, **kwds):
+    """
+    Write a conda-meta record for a fake package into prefix.
+    """
+    meta_dir = os.path.join(prefix, 'conda-meta')
+    if not os.path.isdir(meta_dir):
+        os.makedirs(meta_dir)
+    record = dict(name=name, version=version, build=build, **kwds)
+    fn = '%s-%s-%s.json' % (name, version, build)
+    with open(os.path.join(meta_dir, fn), 'w') as fo:
+        json.dump(record, fo)
+    return record
+
+
+class TestLinkedRecords(unittest.TestCase):
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.prefix)
+
+    def set_old_mtime(self):
+        # pretend conda-meta was last modified a while ago
+        t = time.time() - 60
+        os.utime(os.path.join(self.prefix, 'conda-meta'), (t, t))
+
+    def test_incremental(self):
+        write_meta(self.prefix, 'python', '3.4.1', '0', files=['bin/python'])
+        write_meta(self.prefix, 'zlib', '1.2.8', '0', depends=[])
+        self.set_old_mtime()
+
+        cache = conda_api._meta_cache
+        reads = cache.reads
+        records = conda_api.linked_records(self.prefix)
+        self.assertEqual(set(records), conda_api.linked(self.prefix))
+        self.assertEqual(records['python-3.4.1-0']['files'], ['bin/python'])
+        self.assertEqual(cache.reads, reads + 2)
+
+        # unchanged prefix
+        self.assertEqual(conda_api.linked_records(self.prefix), records)
+        self.assertEqual(cache.reads, reads + 2)
+
+        # one package changes, only its record is read again
+        os.remove(os.path.join(self.prefix, 'conda-meta', 'zlib-1.2.8-0.json'))
+        write_meta(self.prefix, 'zlib', '1.2.8', '1')
+        records = conda_api.linked_records(self.prefix)
+        self.assertEqual(sorted(records), ['python-3.4.1-0', 'zlib-1.2.8-1'])
+        self.assertEqual(cache.reads, reads + 3)
+
+    def test_empty(self):
+        self.assertEqual(conda_api.linked_records(self.prefix), {})
+        self.assertRaises(Exception, conda_api.linked_records,
+                          os.path.join(self.prefix, 'no-such-dir'))
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestPackageInfo(FakeRootTestCase):
+    def test_local_and_fallback(self):
+        env = os.path.join(self.root, 'envs', 'test')
+        write_meta(env, 'python', '3.4.1', '0', files=['bin/python'])
+        info_dir = os.path.join(self.root, 'pkgs', 'zlib-1.2.8-0', 'info')
+        os.makedirs(info_dir)
+        with open(os.path.join(info_dir, 'index.json'), 'w') as fo:
+            json.dump({'name': 'zlib', 'version': '1.2.8', 'build': '0'}, fo)
+
+        res = conda_api.package_info_many(['python-3.4.1-0.tar.bz2',
+                                           'zlib-1.2.8-0', 'numpy'])
+        self.assertEqual(res['python-3.4.1-0.tar.bz2'],
+                         [{'name': 'python', 'version': '3.4.1', 'build': '0',
+                           'fn': 'python-3.4.1-0.tar.bz2'}])
+        self.assertEqual(res['zlib-1.2.8-0'][0]['version'], '1.2.8')
+        # numpy is not available locally, so the fake conda was invoked
+        self.assertEqual(res['args'], ['info', 'numpy', '--json'])
+
+        self.assertEqual(conda_api.package_info('zlib-1.2.8-0.tar.bz2'),
+                         {'zlib-1.2.8-0.tar.bz2': [{
+                             'name': 'zlib', 'version': '1.2.8', 'build': '0',
+                             'fn': 'zlib-1.2.8-0.tar.bz2'}]})
+        self.assertEqual(conda_api.package_info('zlib-1.2.8-0', local=False),
+                         {'args': ['info', 'zlib-1.2.8-0', '--json'],
+                          'worker': False})
+
+    def test_copies(self):
+        env = os.path.join(self.root, 'envs', 'test')
+        write_meta(env, 'six', '1.9.0', 'py34_0', depends=['python'])
+        conda_api.linked_records(env)
+        res = conda_api.package_info('six-1.9.0-py34_0')
+        res['six-1.9.0-py34_0'][0]['depends'].append('numpy')
+        self.assertEqual(conda_api.linked_records(env)['six-1.9.0-py34_0']
+                         ['depends'], ['python'])
+        self.assertEqual(conda_api.package_info('six-1.9.0-py34_0')
+                         ['six-1.9.0-py34_0'][0]['depends'], ['python'])
+
+
+class TestVersionOrder(unittest.TestCase):
+    def test_ordering(self):
+        versions = ['0.4', '0.4.1.rc', '0.4.1', '0.5a1', '0.5b3', '0.5C1',
+                    '0.5', '0.9.6', '0.960923', '1.0', '1.1dev1', '1.1a1',
+                    '1.1.0dev1', '1.1.a1', '1.1.0rc1', '1.1.0', '1.1.0post1',
+                    '1.1post1', '1996.07.12', '1!0.4.1', '1!3.1.1.6',
+                    '2!0.4.1']
+        for a, b in zip(versions, versions[1:]):
+            self.assertTrue(conda_api.VersionOrder(a) < conda_api.VersionOrder(b),
+                            '%s < %s' % (a, b))
+        self.assertEqual(conda_api.VersionOrder('0.4'),
+                         conda_api.VersionOrder('0.4.0'))
+        self.assertEqual(conda_api.VersionOrder('0.4.1.rc'),
+                         conda_api.VersionOrder('0.4.1.RC'))
+
+    def test_post_component(self):
+        # a component starting with 'post' is below any numbered component,
+        # like in conda
+        pairs = [('1.0.post1', '1.0.1'), ('1.0.post', '1.0_1'),
+                 ('1.0.post1', '1.0.1dev'), ('1.0', '1.0.post'),
+                 ('1.0.post1', '1.0post1'), ('1.0_post1', '1.0.1'),
+                 ('1.0.post.1', '1.0.1a')]
+        keys = conda_api.VersionOrder.sort_keys(v for p in pairs for v in p)
+        for a, b in pairs:
+            self.assertTrue(conda_api.VersionOrder(a) < conda_api.VersionOrder(b),
+                            '%s < %s' % (a, b))
+            self.assertTrue(keys[a] < keys[b], '%s < %s' % (a, b))
+
+    def test_match_spec(self):
+        record = {'name': 'numpy', 'version': '1.7.1', 'build': 'py27_0'}
+        for spec in ('numpy', 'numpy 1.7*', 'numpy 1.7.1 py27_0', 'numpy=1.7',
+                     'numpy=1.7.1=py27_0', 'numpy >=1.7,<2', 'numpy 1.6|1.7.1',
+                     'num*'):
+            self.assertTrue(conda_api.MatchSpec(spec).match(record), spec)
+        for spec in ('scipy', 'numpy 1.7', 'numpy=1.8', 'numpy 1.7.1 py33*',
+                     'numpy <1.7.1', 'numpy 1.70*'):
+            self.assertFalse(conda_api.MatchSpec(spec).match(record), spec)
+
+
+def write_repodata(cache_dir, packages, subdir='linux-64',
+                   url='http://repo.example.com/pkgs/free'):
+    """
+    Write a cached repodata file with the given packages (a list of
+    (name, version, build) tuples) into cache_dir.
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    repodata = {'_url': '%s/%s' % (url, subdir), 'info': {'subdir': subdir},
+                'packages': {}}
+    for name, version, build in packages:
+        fn = '%s-%s-%s.tar.bz2' % (name, version, build)
+        repodata['packages'][fn] = {
+            'name': name, 'version': version, 'build': build,
+            'build_number': int(build.rsplit('_', 1)[-1]), 'depends': []}
+    path = os.path.join(cache_dir, '%s.json' % subdir)
+    with open(path, 'w') as fo:
+        json.dump(repodata, fo)
+    return path
+
+
+class TestRepodataIndex(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.path = write_repodata(self.cache_dir, [
+            ('numpy', '1.7.1', 'py27_0'), ('numpy', '1.10.0', 'py27_0'),
+            ('numpy', '1.9.2', 'py27_1'), ('numpy', '1.9.2', 'py27_0'),
+            ('scipy', '0.15.1', 'np19py27_0')])
+        write_repodata(self.cache_dir, [('pip', '7.1.0', 'py27_0')],
+                       subdir='win-64')
+        self.index = conda_api.RepodataIndex([self.cache_dir])
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_search(self):
+        res = self.index.search(spec='numpy >=1.9')
+        self.assertEqual([(r['version'], r['build']) for r in res['numpy']],
+                         [('1.9.2', 'py27_0'), ('1.9.2', 'py27_1'),
+                          ('1.10.0', 'py27_0')])
+        self.assertEqual(res['numpy'][-1]['url'],
+                         'http://repo.example.com/pkgs/free/linux-64/'
+                         'numpy-1.10.0-py27_0.tar.bz2')
+        self.assertEqual(sorted(self.index.search(regex='P')), ['numpy', 'pip',
+                                                                'scipy'])
+        self.assertEqual(sorted(self.index.search(platform='win-64')), ['pip'])
+        self.assertEqual(self.index.search(spec='scipy', canonical=True),
+                         ['scipy-0.15.1-np19py27_0'])
+
+    def test_outdated(self):
+        prefix = tempfile.mkdtemp()
+        try:
+            write_meta(prefix, 'numpy', '1.9.2', 'py27_0')
+            res = self.index.search(outdated=True, prefix=prefix)
+            self.assertEqual([(r['version'], r['build']) for r in res['numpy']],
+                             [('1.9.2', 'py27_1'), ('1.10.0', 'py27_0')])
+        finally:
+            shutil.rmtree(prefix)
+
+    def test_outdated_report(self):
+        prefixes = [os.path.join(self.cache_dir, 'env%d' % i)
+                    for i in range(2)]
+        write_meta(prefixes[0], 'numpy', '1.9.2', 'py27_0',
+                   build_number=0, subdir='linux-64')
+        write_meta(prefixes[0], 'scipy', '0.15.1', 'np19py27_0',
+                   subdir='linux-64')
+        write_meta(prefixes[0], 'pip', '6.0.8', 'py27_0', subdir='linux-64')
+        write_meta(prefixes[0], 'local', '0.1', '0', subdir='linux-64')
+        write_meta(prefixes[1], 'numpy', '1.9.2', 'py27_1',
+                   build_number=1, subdir='win-64')
+        write_meta(prefixes[1], 'pip', '6.0.8', 'py27_0', subdir='win-64')
+        # 1.9.post1 < 1.9.1, in conda's version ordering
+        write_repodata(self.cache_dir, [('six', '1.9.post1', 'py_0'),
+                                        ('six', '1.9.1', 'py_0')],
+                       subdir='noarch')
+        write_meta(prefixes[0], 'six', '1.9.post1', 'py_0', subdir='noarch')
+        write_meta(prefixes[1], 'six', '1.9.1', 'py_0', subdir='noarch')
+        self.assertEqual(conda_api.outdated_report(prefixes, self.index), [
+            (prefixes[0], 'numpy', '1.9.2', 'py27_0', '1.10.0', 'py27_0'),
+            (prefixes[0], 'six', '1.9.post1', 'py_0', '1.9.1', 'py_0'),
+            (prefixes[1], 'pip', '6.0.8', 'py27_0', '7.1.0', 'py27_0')])
+        self.assertEqual(conda_api.outdated_report(prefixes, self.index)[0]
+                         .latest_version, '1.10.0')
+
+    def test_reload(self):
+        self.assertTrue(self.index.reload())
+        self.assertEqual(self.index.loads, 2)
+        self.assertFalse(self.index.reload())
+        self.assertEqual(self.index.loads, 2)
+
+        write_repodata(self.cache_dir, [('numpy', '1.11.0', 'py27_0')])
+        t = time.time() + 10
+        os.utime(self.path, (t, t))
+        self.assertTrue(self.index.reload())
+        self.assertEqual(self.index.loads, 3)
+        self.assertEqual(len(self.index), 2)
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestSearchIndexCache(FakeRootTestCase):
+    def test_local_index(self):
+        # no cached repodata, conda is invoked
+        res = conda_api.search(spec='numpy', local_index=True)
+        self.assertEqual(res['args'], ['search', '--json', '--spec', 'numpy'])
+
+        write_repodata(os.path.join(self.root, 'pkgs', 'cache'),
+                       [('numpy', '1.7.1', 'py27_0')])
+        res = conda_api.search(spec='numpy', local_index=True)
+        self.assertEqual(list(res), ['numpy'])
+        res = conda_api.search(spec='numpy', local_index=True,
+                               channel='wakari')
+        self.assertIn('args', res)
+        # --use-index-cache is passed on to conda
+        res = conda_api.search(spec='numpy', use_index_cache=True)
+        self.assertEqual(res['args'], ['search', '--json', '--spec', 'numpy',
+                                       '--use-index-cache'])
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs asyncio.run')
+    def test_asyncio(self):
+        import asyncio
+        import conda_api_aio
+
+        write_repodata(os.path.join(self.root, 'pkgs', 'cache'),
+                       [('numpy', '1.7.1', 'py27_0')])
+        for kwargs in {'local_index': True}, {'use_index_cache': True}:
+            self.assertEqual(
+                asyncio.run(conda_api_aio.search(spec='numpy', **kwargs)),
+                conda_api.search(spec='numpy', **kwargs))
+
+
+FAKE_SEARCH_CONDA = '''\
+import sys
+import json
+result = {}
+for i in range(50):
+    result['pkg%02d' % i] = [{'name': 'pkg%02d' % i, 'version': '1.%d' % j,
+                              'build_number': j, 'ok': True, 'x': None}
+                             for j in range(i % 4)]
+if '--spec' in sys.argv:
+    result = {'error': 'bad spec'}
+sys.stdout.write(json.dumps(result, indent=2, sort_keys=True))
+'''
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestSearchIter(FakeRootTestCase):
+    conda_source = FAKE_SEARCH_CONDA
+
+    def test_same_as_search(self):
+        expected = conda_api.search()
+        res = {}
+        for name, record in conda_api.search_iter():
+            res.setdefault(name, []).append(record)
+        self.assertEqual(res, dict((k, v) for k, v in expected.items() if v))
+
+    def test_small_chunks(self):
+        p = conda_api.Popen([sys.executable,
+                             os.path.join(self.root, 'bin', 'conda')],
+                            stdout=conda_api.PIPE)
+        reader = conda_api._JSONStreamReader(p.stdout, chunk_size=7)
+        items = list(conda_api._iter_search_result(reader, ['search']))
+        p.wait()
+        p.stdout.close()
+        self.assertEqual(len(items), sum(i % 4 for i in range(50)))
+
+    def test_error(self):
+        self.assertRaises(conda_api.CondaError, list,
+                          conda_api.search_iter(spec='x'))
+
+    def test_close_early(self):
+        it = conda_api.search_iter()
+        self.assertEqual(next(it)[0], 'pkg01')
+        it.close()
+
+
+FAKE_PROGRESS_CONDA = '''\
+import sys
+import json
+import time
+messages = [
+    {'fetch': 'zlib-1.2.8-0', 'finished': False, 'maxval': 1000,
+     'progress': 0},
+    {'fetch': 'zlib-1.2.8-0', 'finished': False, 'maxval': 1000,
+     'progress': 500},
+    {'fetch': 'zlib-1.2.8-0', 'finished': True, 'maxval': 1000,
+     'progress': 1000},
+    {'fetch': 'python-3.4.1-0', 'finished': False, 'maxval': 2000,
+     'progress': 0.25},
+    {'extract': 'zlib-1.2.8-0', 'finished': False, 'maxval': 1,
+     'progress': 0},
+    {'name': 'zlib-1.2.8-0', 'finished': False, 'maxval': 2, 'progress': 1},
+    {'message': 'hello'},
+]
+for msg in messages:
+    sys.stdout.write(json.dumps(msg) + '\\n\\0')
+    sys.stdout.flush()
+    time.sleep(0.01)
+if '--name' in sys.argv:
+    result = {'error': 'no such environment'}
+else:
+    result = {'success': True, 'args': sys.argv[1:]}
+sys.stdout.write(json.dumps(result, indent=2))
+'''
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestProgressEvents(FakeRootTestCase):
+    conda_source = FAKE_PROGRESS_CONDA
+
+    def test_events(self):
+        events = list(conda_api.install_events(prefix='/tmp/env',
+                                               pkgs=['python']))
+        self.assertEqual([e.kind for e in events],
+                         ['fetch'] * 4 + ['extract', 'progress', 'message',
+                                          'result'])
+        self.assertEqual([(e.name, e.done, e.total, e.finished)
+                          for e in events[:4]],
+                         [('zlib-1.2.8-0', 0, 1000, False),
+                          ('zlib-1.2.8-0', 500, 1000, False),
+                          ('zlib-1.2.8-0', 1000, 1000, True),
+                          ('python-3.4.1-0', 500, 2000, False)])
+        self.assertEqual(events[-1].data['args'],
+                         ['install', '--json', '--yes', '--prefix',
+                          '/tmp/env', 'python'])
+
+    def test_consume(self):
+        seen = []
+        result = conda_api.consume_events(
+            conda_api.update_events('python', prefix='/tmp/env'), seen.append)
+        self.assertEqual(len(seen), 7)
+        self.assertTrue(result['success'])
+        self.assertNotIn('--quiet', result['args'])
+
+    def test_error(self):
+        self.assertRaises(conda_api.CondaError, conda_api.consume_events,
+                          conda_api.update_events('python', env='foo'))
+
+
+FAKE_HANGING_CONDA = '''\
+import os
+import sys
+import time
+import subprocess
+child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+with open(os.path.join(os.path.dirname(sys.argv[0]), 'child.pid'), 'w') as fo:
+    fo.write(str(child.pid))
+sys.stderr.write('waiting for lock\\n')
+sys.stderr.flush()
+time.sleep(60)
+'''
+
+FAKE_HANGING_WORKER = '''\
+import sys
+import time
+for line in iter(sys.stdin.readline, ''):
+    time.sleep(60)
+'''
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestDeadline(FakeRootTestCase):
+    conda_source = FAKE_HANGING_CONDA
+
+    def assertChildKilled(self):
+        with open(os.path.join(self.root, 'bin', 'child.pid')) as fi:
+            pid = int(fi.read())
+        for i in range(50):
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                return
+            time.sleep(0.1)
+        self.fail('child process %d still running' % pid)
+
+    def test_timeout(self):
+        t0 = time.time()
+        with conda_api.deadline(0.5):
+            try:
+                conda_api.info()
+            except conda_api.CondaTimeoutError as e:
+                self.assertEqual(e.stderr, b'waiting for lock\n')
+            else:
+                self.fail('CondaTimeoutError not raised')
+        self.assertLess(time.time() - t0, 10)
+        self.assertChildKilled()
+
+        # the deadline has expired before the call was made
+        with conda_api.deadline(0):
+            self.assertRaises(conda_api.CondaTimeoutError, conda_api.info)
+
+    def test_default_timeout(self):
+        conda_api.set_default_timeout(0.5)
+        try:
+            self.assertRaises(conda_api.CondaTimeoutError, conda_api.update,
+                              'python')
+        finally:
+            conda_api.set_default_timeout(None)
+
+    def test_cancel(self):
+        token = conda_api.CancelToken()
+        threading.Timer(0.3, token.cancel).start()
+        with conda_api.deadline(cancel=token):
+            self.assertRaises(conda_api.CondaCancelledError,
+                              conda_api.install, prefix='/tmp/x',
+                              pkgs=['python'])
+        self.assertChildKilled()
+
+    def test_streaming_timeout(self):
+        with conda_api.deadline(0.5):
+            self.assertRaises(conda_api.CondaTimeoutError, list,
+                              conda_api.search_iter())
+
+    def test_worker_timeout(self):
+        conda_api.start_worker(
+            [sys.executable, '-u', self.write_script(FAKE_HANGING_WORKER)])
+        with conda_api.deadline(0.5):
+            self.assertRaises(conda_api.CondaTimeoutError, conda_api.info)
+
+    def test_process_timeout(self):
+        p = conda_api.process(prefix=self.root, cmd=sys.executable,
+                              args=['-c', 'import time; time.sleep(60)'],
+                              timeout=0.3)
+        t0 = time.time()
+        self.assertEqual(p.wait(), -9)
+        self.assertLess(time.time() - t0, 10)
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs asyncio.run')
+    def test_asyncio(self):
+        import asyncio
+        import conda_api_aio
+
+        t0 = time.time()
+        with conda_api.deadline(0.5):
+            try:
+                asyncio.run(conda_api_aio.info())
+            except conda_api.CondaTimeoutError as e:
+                self.assertEqual(e.stderr, b'waiting for lock\n')
+            else:
+                self.fail('CondaTimeoutError not raised')
+        self.assertLess(time.time() - t0, 10)
+        self.assertChildKilled()
+
+        conda_api.set_default_timeout(0.5)
+        try:
+            self.assertRaises(conda_api.CondaTimeoutError, asyncio.run,
+                              conda_api_aio.update('python'))
+        finally:
+            conda_api.set_default_timeout(None)
+
+        token = conda_api.CancelToken()
+        threading.Timer(0.3, token.cancel).start()
+        with conda_api.deadline(cancel=token):
+            self.assertRaises(conda_api.CondaCancelledError, asyncio.run,
+                              conda_api_aio.install(prefix='/tmp/x',
+                                                    pkgs=['python']))
+
+        async def process():
+            p = await conda_api_aio.process(
+                prefix=self.root, cmd=sys.executable,
+                args=['-c', 'import time; time.sleep(60)'], timeout=0.3)
+            return await p.wait()
+
+        t0 = time.time()
+        self.assertEqual(asyncio.run(process()), -9)
+        self.assertLess(time.time() - t0, 10)
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs asyncio.run')
+    def test_asyncio_tasks(self):
+        import asyncio
+        import conda_api_aio
+
+        async def run(func, timeout, delay):
+            await asyncio.sleep(delay)
+            t0 = time.time()
+            with conda_api.deadline(timeout):
+                try:
+                    await func()
+                except conda_api.CondaTimeoutError:
+                    pass
+            return time.time() - t0
+
+        async def main():
+            # the second deadline starts while the first is active
+            return await asyncio.gather(
+                run(conda_api_aio.info, 0.2, 0),
+                run(conda_api_aio.search, 1.0, 0.1))
+
+        short, long = asyncio.run(main())
+        self.assertLess(short, 0.9)
+        self.assertGreaterEqual(long, 0.9)
+
+        # the deadlines of the tasks are gone, and do not apply here
+        self.assertEqual(conda_api._current_scope(), (None, ()))
+        t0 = time.time()
+        with conda_api.deadline(1.0):
+            self.assertRaises(conda_api.CondaTimeoutError, conda_api.info)
+        self.assertGreaterEqual(time.time() - t0, 0.9)
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestMetrics(FakeRootTestCase):
+    def test_collect(self):
+        records = []
+        conda_api.add_hook(records.append)
+        try:
+            with conda_api.collect_metrics() as metrics:
+                conda_api.set_info_ttl(0)
+                for i in range(4):
+                    conda_api.info()
+                conda_api.config_set('use_pip', False, file='rc')
+            conda_api.info()
+        finally:
+            conda_api.remove_hook(records.append)
+
+        self.assertEqual(len(records), 6)
+        self.assertEqual(len(metrics.records), 5)
+        record = metrics.records[0]
+        self.assertEqual(record.argv, ['info', '--json'])
+        self.assertEqual(record.subcommand, 'info')
+        self.assertEqual(record.returncode, 0)
+        self.assertGreater(record.stdout_bytes, 0)
+        self.assertGreaterEqual(record.wall_time, record.spawn_time)
+        self.assertIsNotNone(record.decode_time)
+
+        summary = metrics.summary()
+        self.assertEqual(sorted(summary), ['config', 'info'])
+        self.assertEqual(summary['info']['count'], 4)
+        self.assertEqual(summary['info']['errors'], 0)
+        self.assertLessEqual(summary['info']['p50'], summary['info']['max'])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(conda_api.MetricsAggregator.percentile(values, 50), 50)
+        self.assertEqual(conda_api.MetricsAggregator.percentile(values, 99), 99)
+        self.assertEqual(conda_api.MetricsAggregator.percentile([3], 90), 3)
+
+    def test_failing_hook(self):
+        import warnings
+
+        def hook(record):
+            raise ValueError('oops')
+
+        conda_api.add_hook(hook)
+        try:
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter('always')
+                self.assertEqual(conda_api.config_set('use_pip', False,
+                                                      file='rc'), [])
+        finally:
+            conda_api.remove_hook(hook)
+        self.assertEqual(len(w), 1)
+
+
+FAKE_LOGGING_CONDA = '''\
+import os
+import sys
+import json
+import time
+root = os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0])))
+args = sys.argv[1:]
+prefix = args[args.index('--prefix') + 1] if '--prefix' in args else None
+t0 = time.time()
+time.sleep(float(os.getenv('FAKE_CONDA_DELAY', 0)))
+with open(os.path.join(root, 'log'), 'a') as fo:
+    fo.write(json.dumps([prefix, args, t0, time.time()]) + '\\n')
+if prefix and prefix.endswith('broken'):
+    sys.stdout.write(json.dumps({'error': 'broken environment'}))
+elif 'bad' in args:
+    sys.stdout.write(json.dumps({'error': 'no package named bad'}))
+else:
+    sys.stdout.write(json.dumps({'success': True, 'args': args}))
+'''
+
+
+class LoggingRootTestCase(FakeRootTestCase):
+    # a fake root prefix, whose conda logs its calls, and takes 0.2 seconds
+    conda_source = FAKE_LOGGING_CONDA
+
+    def setUp(self):
+        FakeRootTestCase.setUp(self)
+        os.environ['FAKE_CONDA_DELAY'] = '0.2'
+
+    def tearDown(self):
+        del os.environ['FAKE_CONDA_DELAY']
+        FakeRootTestCase.tearDown(self)
+
+    def read_log(self):
+        with open(os.path.join(self.root, 'log')) as fi:
+            return [json.loads(line) for line in fi]
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestBatch(LoggingRootTestCase):
+    def test_update_many(self):
+        operations = [('/envs/a', ['numpy']), ('/envs/b', ['numpy']),
+                      ('/envs/a', ['scipy']), ('/envs/broken', ['numpy']),
+                      ('/envs/c', ['numpy'])]
+        res = conda_api.update_many(operations, max_workers=4)
+
+        self.assertEqual(sorted(res), ['/envs/a', '/envs/b', '/envs/broken',
+                                       '/envs/c'])
+        self.assertEqual([r.pkgs for r in res['/envs/a']],
+                         [['numpy'], ['scipy']])
+        self.assertTrue(all(r.ok for r in res['/envs/a']))
+        self.assertFalse(res['/envs/broken'][0].ok)
+        self.assertIsInstance(res['/envs/broken'][0].error,
+                              conda_api.CondaError)
+        self.assertTrue(res['/envs/c'][0].result['success'])
+
+        log = self.read_log()
+        a = sorted((start, end) for prefix, args, start, end in log
+                   if prefix == '/envs/a')
+        # the operations on /envs/a were serialized ...
+        self.assertLessEqual(a[0][1], a[1][0])
+        # ... while the operations on different prefixes overlap
+        starts = sorted(start for prefix, args, start, end in log)
+        self.assertLess(starts[3] - starts[0], 0.2)
+
+    def test_remove_many(self):
+        res = conda_api.remove_many([('/envs/a', ['numpy'])], dry_run=True)
+        self.assertEqual(res['/envs/a'][0].result['args'],
+                         ['remove', '--json', '--quiet', '--yes', '--prefix',
+                          '/envs/a', '--dry-run', 'numpy'])
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestMutationScheduler(LoggingRootTestCase):
+    def test_coalesce(self):
+        # hold the first command on /envs/a, until the following requests
+        # are queued
+        started = threading.Event()
+        release = threading.Event()
+        remove = conda_api.remove
+
+        def gated_remove(*pkgs, **kwargs):
+            if not started.is_set():
+                started.set()
+                release.wait(10)
+            return remove(*pkgs, **kwargs)
+
+        conda_api.remove = gated_remove
+        try:
+            scheduler = conda_api.MutationScheduler(window=0.5)
+            futures = [scheduler.remove('/envs/a', ['numpy']),
+                       scheduler.remove('/envs/a', ['scipy']),
+                       scheduler.install('/envs/b', ['python=3.4'])]
+            self.assertTrue(started.wait(10))
+            futures += [scheduler.remove('/envs/a', ['pandas']),
+                        scheduler.remove('/envs/a', ['pandas', 'six']),
+                        scheduler.install('/envs/a', ['python']),
+                        scheduler.remove('/envs/a', ['numpy=1.9'])]
+            release.set()
+            results = [f.result(timeout=10) for f in futures]
+        finally:
+            conda_api.remove = remove
+
+        self.assertEqual(scheduler.requests, 7)
+        self.assertEqual(scheduler.runs, 5)
+        log = sorted(self.read_log(), key=lambda entry: entry[2])
+        self.assertEqual([entry[1][-2:] for entry in log if
+                          entry[0] == '/envs/a'],
+                         [['numpy', 'scipy'], ['pandas', 'six'],
+                          ['/envs/a', 'python'], ['/envs/a', 'numpy=1.9']])
+        self.assertEqual(results[0][:3], ('/envs/a', ['numpy'],
+                                          ['numpy', 'scipy']))
+        self.assertEqual(results[1][:3], ('/envs/a', ['scipy'],
+                                          ['numpy', 'scipy']))
+        self.assertIs(results[0].result, results[1].result)
+        self.assertEqual(results[4].pkgs, ['pandas', 'six'])
+        self.assertEqual(results[5].merged, ['python'])
+
+    def test_error(self):
+        scheduler = conda_api.MutationScheduler(window=0.5)
+        f1 = scheduler.remove('/envs/broken', ['numpy'])
+        f2 = scheduler.remove('/envs/broken', ['scipy'])
+        self.assertRaises(conda_api.CondaError, f1.result, 10)
+        self.assertRaises(conda_api.CondaError, f2.result, 10)
+        self.assertEqual(scheduler.runs, 3)
+
+    def test_partial_error(self):
+        # one bad request does not fail the others merged with it
+        scheduler = conda_api.MutationScheduler(window=0.5)
+        futures = [scheduler.remove('/envs/a', ['numpy']),
+                   scheduler.remove('/envs/a', ['bad']),
+                   scheduler.remove('/envs/a', ['scipy'])]
+        self.assertRaises(conda_api.CondaError, futures[1].result, 10)
+        self.assertEqual(futures[0].result(10).merged, ['numpy'])
+        self.assertEqual(futures[2].result(10).merged, ['scipy'])
+        self.assertEqual(scheduler.runs, 4)
+        self.assertEqual([entry[1][-1] for entry in self.read_log()],
+                         ['scipy', 'numpy', 'bad', 'scipy'])
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestPlanCache(FakeRootTestCase):
+    def setUp(self):
+        FakeRootTestCase.setUp(self)
+        self.prefix = os.path.join(self.root, 'envs', 'test')
+        write_meta(self.prefix, 'python', '3.4.3', '0')
+        self.plans = os.path.join(self.root, 'plans')
+        self.old_cache = conda_api.set_plan_cache(
+            conda_api.PlanCache(self.plans))
+
+    def tearDown(self):
+        conda_api.set_plan_cache(self.old_cache)
+        FakeRootTestCase.tearDown(self)
+
+    def calls(self, func, *args, **kwargs):
+        with conda_api.collect_metrics() as metrics:
+            result = func(*args, **kwargs)
+        return result, len(metrics.records)
+
+    def test_update(self):
+        plan, n = self.calls(conda_api.update, 'numpy', prefix=self.prefix,
+                             dry_run=True)
+        self.assertEqual(n, 1)
+        self.assertIn('--dry-run', plan['args'])
+        self.assertEqual(self.calls(conda_api.update, 'numpy',
+                                    prefix=self.prefix, dry_run=True),
+                         (plan, 0))
+        # other specs, flags or a new process are separate entries
+        self.assertEqual(self.calls(conda_api.update, 'scipy',
+                                    prefix=self.prefix, dry_run=True)[1], 1)
+        self.assertEqual(self.calls(conda_api.remove, 'numpy', path=self.prefix,
+                                    dry_run=True)[1], 1)
+        conda_api.set_plan_cache(conda_api.PlanCache(self.plans))
+        self.assertEqual(self.calls(conda_api.update, 'numpy',
+                                    prefix=self.prefix, dry_run=True),
+                         (plan, 0))
+        # changing the environment invalidates the plans
+        write_meta(self.prefix, 'six', '1.9.0', 'py34_0')
+        self.assertEqual(self.calls(conda_api.update, 'numpy',
+                                    prefix=self.prefix, dry_run=True)[1], 1)
+        # and so does changing the configuration
+        with open(os.path.join(self.root, '.condarc'), 'w') as fo:
+            fo.write('channels:\n  - wakari\n')
+        self.assertEqual(self.calls(conda_api.update, 'numpy',
+                                    prefix=self.prefix, dry_run=True)[1], 1)
+        os.environ['CONDA_CHANNEL_PRIORITY'] = 'strict'
+        try:
+            self.assertEqual(self.calls(conda_api.update, 'numpy',
+                                        prefix=self.prefix, dry_run=True)[1],
+                             1)
+        finally:
+            del os.environ['CONDA_CHANNEL_PRIORITY']
+        self.assertEqual(self.calls(conda_api.update, 'numpy',
+                                    prefix=self.prefix, dry_run=True)[1], 0)
+        # no caching of real updates
+        self.assertEqual(self.calls(conda_api.update, 'numpy',
+                                    prefix=self.prefix)[1], 1)
+        self.assertEqual(self.calls(conda_api.update, 'numpy',
+                                    prefix=self.prefix)[1], 1)
+
+    def test_install_plan_and_clone(self):
+        plan, n = self.calls(conda_api.install_plan, prefix=self.prefix,
+                             pkgs=['numpy'], use_local=True)
+        self.assertEqual(n, 1)
+        self.assertEqual(plan['args'],
+                         ['install', '--json', '--dry-run', '--yes', '--quiet',
+                          '--prefix', self.prefix, '--use-local', 'numpy'])
+        self.assertEqual(self.calls(conda_api.install_plan, prefix=self.prefix,
+                                    pkgs=['numpy'], use_local=True), (plan, 0))
+        for i in range(2):
+            self.assertEqual(self.calls(
+                conda_api.clone_environment, 'test', path='/envs/clone',
+                dry_run=True)[1], 1 - i)
+
+    def test_default(self):
+        # by default, plans are only kept in memory, for a limited time
+        self.assertIsNone(self.old_cache.directory)
+        self.assertEqual(self.old_cache.max_age, 300.0)
+
+    def test_max_age(self):
+        conda_api.set_plan_cache(conda_api.PlanCache(self.plans, max_age=0.5))
+        self.assertEqual(self.calls(conda_api.update, 'numpy',
+                                    prefix=self.prefix, dry_run=True)[1], 1)
+        self.assertEqual(self.calls(conda_api.update, 'numpy',
+                                    prefix=self.prefix, dry_run=True)[1], 0)
+        time.sleep(0.6)
+        self.assertEqual(self.calls(conda_api.update, 'numpy',
+                                    prefix=self.prefix, dry_run=True)[1], 1)
+        # the files expire as well
+        conda_api.set_plan_cache(conda_api.PlanCache(self.plans, max_age=0.5))
+        self.assertEqual(self.calls(conda_api.update, 'numpy',
+                                    prefix=self.prefix, dry_run=True)[1], 0)
+        time.sleep(0.6)
+        conda_api.set_plan_cache(conda_api.PlanCache(self.plans, max_age=0.5))
+        self.assertEqual(self.calls(conda_api.update, 'numpy',
+                                    prefix=self.prefix, dry_run=True)[1], 1)
+
+    def test_limits(self):
+        cache = conda_api.PlanCache(self.plans, max_entries=2)
+        conda_api.set_plan_cache(cache)
+        for pkg in 'numpy', 'scipy', 'pandas':
+            conda_api.update(pkg, prefix=self.prefix, dry_run=True)
+            time.sleep(0.01)
+        self.assertEqual(len(os.listdir(self.plans)), 2)
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertEqual(self.calls(conda_api.update, 'numpy',
+                                    prefix=self.prefix, dry_run=True)[1], 1)
+        self.assertEqual(self.calls(conda_api.update, 'pandas',
+                                    prefix=self.prefix, dry_run=True)[1], 0)
+
+
+@unittest.skipIf(conda_api.yaml is None, 'requires PyYAML')
+class TestConfigFile(FakeRootTestCase):
+    def setUp(self):
+        FakeRootTestCase.setUp(self)
+        self.rc = os.path.join(self.root, 'condarc')
+        with open(self.rc, 'w') as fo:
+            fo.write('channels:\n  - wakari\n  - defaults\nuse_pip: false\n')
+
+    def test_get(self):
+        reads = conda_api._rc_cache.reads
+        with conda_api.collect_metrics() as metrics:
+            self.assertEqual(conda_api.config_path(file=self.rc), self.rc)
+            self.assertEqual(conda_api.config_get('channels', 'use_pip',
+                                                  'always_yes', file=self.rc),
+                             {'channels': ['wakari', 'defaults'],
+                              'use_pip': False})
+            conda_api.config_get(file=self.rc)['channels'].append('x')
+            self.assertEqual(conda_api.config_get('channels', file=self.rc),
+                             {'channels': ['wakari', 'defaults']})
+            self.assertEqual(conda_api.config_get(
+                file=os.path.join(self.root, 'missing')), {})
+        self.assertEqual(metrics.records, [])
+        self.assertEqual(conda_api._rc_cache.reads, reads + 1)
+
+        with open(self.rc, 'a') as fo:
+            fo.write('always_yes: true\n')
+        self.assertEqual(conda_api.config_get('always_yes', file=self.rc),
+                         {'always_yes': True})
+
+    def test_transaction(self):
+        with conda_api.config_transaction(file=self.rc) as t:
+            self.assertEqual(t.set('always_yes', 'yes'), [])
+            self.assertEqual(t.set('use_pip', True), [])
+            self.assertEqual(t.add('channels', 'defaults'),
+                             ["Warning: 'defaults' already in 'channels' "
+                              "list, moving to the top"])
+            self.assertEqual(t.add('channels', 'wakari'),
+                             ["Warning: 'wakari' already in 'channels' "
+                              "list, moving to the top"])
+            self.assertEqual(t.add('channels', 'conda-forge'), [])
+            self.assertEqual(t.remove('channels', 'defaults'), [])
+            self.assertEqual(t.add('create_default_packages', 'pip'), [])
+            self.assertRaises(conda_api.CondaError, t.delete, 'missing')
+            self.assertRaises(conda_api.CondaError,
+                              t.remove, 'channels', 'missing')
+            # nothing is written until the block exits
+            self.assertEqual(conda_api.config_get('always_yes', file=self.rc),
+                             {})
+            # a concurrent change is kept
+            with open(self.rc, 'a') as fo:
+                fo.write('ssl_verify: false\n')
+        self.assertEqual(conda_api.config_get(file=self.rc),
+                         {'channels': ['conda-forge', 'wakari'],
+                          'use_pip': True, 'always_yes': True,
+                          'ssl_verify': False,
+                          'create_default_packages': ['pip']})
+
+        try:
+            with conda_api.config_transaction(file=self.rc) as t:
+                t.delete('use_pip')
+                raise KeyboardInterrupt
+        except KeyboardInterrupt:
+            pass
+        self.assertEqual(conda_api.config_get('use_pip', file=self.rc),
+                         {'use_pip': True})
+        self.assertEqual(sorted(os.listdir(self.root)),
+                         ['bin', 'condarc'])
+
+    def test_values(self):
+        with conda_api.config_transaction(file=self.rc) as t:
+            t.set('remote_max_retries', 5)
+            t.set('remote_read_timeout_secs', '60.5')
+            t.set('always_yes', 'y')
+            t.set('ssl_verify', 'False')
+            t.set('channel_priority', 'strict')
+            t.set('proxy_servers', '[a, b]')
+        self.assertEqual(conda_api.config_get(
+            'remote_max_retries', 'remote_read_timeout_secs', 'always_yes',
+            'ssl_verify', 'channel_priority', 'proxy_servers', file=self.rc),
+            {'remote_max_retries': 5, 'remote_read_timeout_secs': 60.5,
+             'always_yes': True, 'ssl_verify': False,
+             'channel_priority': 'strict', 'proxy_servers': '[a, b]'})
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestProcessEnv(FakeRootTestCase):
+    def setUp(self):
+        FakeRootTestCase.setUp(self)
+        self.prefix = os.path.join(self.root, 'envs', 'test')
+        write_meta(self.prefix, 'gdal', '1.11.2', 'np19py34_1')
+        self.activate_d = os.path.join(self.prefix, 'etc', 'conda',
+                                       'activate.d')
+        os.makedirs(self.activate_d)
+        with open(os.path.join(self.activate_d, 'gdal.sh'), 'w') as fo:
+            fo.write('#!/bin/sh\n'
+                     'export GDAL_DATA=$CONDA_PREFIX/share/gdal\n'
+                     'export GDAL_DRIVER_PATH="${GDAL_DATA}/plugins dir"\n'
+                     "export LITERAL='$HOME'\n"
+                     'export COMPUTED=$(pwd)\n'
+                     'export UNKNOWN=$HOME/x\n')
+        with open(os.path.join(self.prefix, 'conda-meta', 'state'), 'w') as fo:
+            json.dump({'env_vars': {'MY_VAR': 'value'}}, fo)
+
+    def test_activation(self):
+        builds = conda_api._activation_cache.builds
+        env = conda_api._process_env(self.prefix)
+        gdal_data = os.path.join(self.prefix, 'share', 'gdal')
+        self.assertEqual(env['PATH'].split(os.pathsep)[:2],
+                         [self.prefix, os.path.join(self.prefix, 'bin')])
+        self.assertEqual(env['CONDA_PREFIX'], self.prefix)
+        self.assertEqual(env['CONDA_DEFAULT_ENV'], 'test')
+        self.assertEqual(env['GDAL_DATA'], gdal_data)
+        self.assertEqual(env['GDAL_DRIVER_PATH'], gdal_data + '/plugins dir')
+        self.assertEqual(env['LITERAL'], '$HOME')
+        self.assertEqual(env['MY_VAR'], 'value')
+        self.assertNotIn('COMPUTED', env)
+        self.assertNotIn('UNKNOWN', env)
+        for i in range(3):
+            self.assertEqual(conda_api._process_env(self.prefix), env)
+        self.assertEqual(conda_api._activation_cache.builds, builds + 1)
+
+        with open(os.path.join(self.activate_d, 'other.sh'), 'w') as fo:
+            fo.write('export OTHER=1\n')
+        self.assertEqual(conda_api._process_env(self.prefix)['OTHER'], '1')
+        with open(os.path.join(self.prefix, 'conda-meta', 'state'), 'w') as fo:
+            json.dump({'env_vars': {}}, fo)
+        self.assertNotIn('MY_VAR', conda_api._process_env(self.prefix))
+        self.assertEqual(conda_api._activation_cache.builds, builds + 3)
+
+    def test_process_many(self):
+        script = self.write_script(
+            'import os, sys, time\n'
+            'time.sleep(float(sys.argv[1]))\n'
+            'sys.stdout.write(os.environ["MY_VAR"] * int(sys.argv[2]))\n'
+            'sys.stderr.write("err")\n'
+            'sys.exit(int(sys.argv[3]))\n')
+        jobs = [(self.prefix, sys.executable, [script, '0.3', '1', '0']),
+                (self.root, sys.executable, [script, '0', '1', '0']),
+                (self.prefix, sys.executable, [script, '0', '100000', '3']),
+                (self.prefix, sys.executable, [script, '10', '1', '0']),
+                (self.prefix, os.path.join(self.root, 'missing'), None)]
+        t0 = time.time()
+        results = list(conda_api.process_many(jobs, max_workers=2,
+                                              max_output=1000, timeout=1.0))
+        self.assertLess(time.time() - t0, 5)
+        self.assertEqual(sorted(res.index for res in results), list(range(5)))
+        results.sort(key=lambda res: res.index)
+        self.assertEqual([res.returncode for res in results[:3]], [0, 1, 3])
+        self.assertEqual(results[0].stdout, b'value')
+        self.assertEqual(results[0].stderr, b'err')
+        self.assertFalse(results[0].truncated)
+        # the root prefix has no MY_VAR
+        self.assertIn(b'KeyError', results[1].stderr)
+        self.assertEqual(len(results[2].stdout), 1000)
+        self.assertTrue(results[2].truncated)
+        self.assertTrue(results[3].timed_out)
+        self.assertNotEqual(results[3].returncode, 0)
+        self.assertIsInstance(results[4].error, OSError)
+        self.assertIsNone(results[4].returncode)
+
+        self.assertRaises(TypeError, conda_api.process_many,
+                          [(None, sys.executable, [])])
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestFileIndex(FakeRootTestCase):
+    def setUp(self):
+        FakeRootTestCase.setUp(self)
+        self.env1 = os.path.join(self.root, 'envs', 'env1')
+        self.env2 = os.path.join(self.root, 'envs', 'env2')
+        write_meta(self.root, 'python', '3.4.3', '0',
+                   files=['bin/python', 'lib/libpython3.4m.so'])
+        write_meta(self.env1, 'openssl', '1.0.1k', '1',
+                   files=['lib/libssl.so', 'bin/openssl'])
+        write_meta(self.env1, 'python', '2.7.9', '1', files=['bin/python'])
+        write_meta(self.env2, 'openssl', '1.0.2d', '0',
+                   files=['lib/libssl.so', 'bin/openssl'])
+        self.old_home = os.environ.get('HOME')
+        os.environ['HOME'] = os.path.join(self.root, 'home')
+
+    def tearDown(self):
+        os.environ['HOME'] = self.old_home
+        FakeRootTestCase.tearDown(self)
+
+    def test_index(self):
+        index = conda_api.file_index()
+        self.assertEqual(index.path, os.path.join(
+            self.root, 'pkgs', 'cache', 'conda_api_files.sqlite'))
+        self.assertEqual(index.reads, 4)
+        self.assertEqual(index.prefixes(),
+                         sorted([self.root, self.env1, self.env2]))
+        Ref = conda_api.PackageRef
+        self.assertEqual(index.owners(os.path.join(self.env1, 'bin', 'python')),
+                         [Ref(self.env1, 'python', '2.7.9', '1')])
+        self.assertEqual(index.owners(os.path.join(self.env1, 'bin', 'nope')),
+                         [])
+        self.assertEqual(index.owners('lib/libssl.so'),
+                         [Ref(self.env1, 'openssl', '1.0.1k', '1'),
+                          Ref(self.env2, 'openssl', '1.0.2d', '0')])
+        self.assertEqual(index.find('openssl 1.0.1*'),
+                         [Ref(self.env1, 'openssl', '1.0.1k', '1')])
+        self.assertEqual(len(index.find('open*')), 2)
+        self.assertEqual([ref.name for ref in index.packages(self.env1)],
+                         ['openssl', 'python'])
+        self.assertEqual(index.files(self.env1, 'openssl'),
+                         ['bin/openssl', 'lib/libssl.so'])
+
+        # nothing changed, no records are read
+        self.assertEqual(index.update(), 0)
+
+        os.unlink(os.path.join(self.env1, 'conda-meta',
+                               'python-2.7.9-1.json'))
+        write_meta(self.env1, 'python', '3.4.3', '0', files=['bin/python3'])
+        shutil.rmtree(self.env2)
+        # the index is persistent
+        index.close()
+        index = conda_api.FileIndex(index.path)
+        self.assertEqual(index.update(), 1)
+        self.assertEqual(index.prefixes(), sorted([self.root, self.env1]))
+        self.assertEqual(index.owners('bin/python'),
+                         [Ref(self.root, 'python', '3.4.3', '0')])
+        self.assertEqual(index.find('python 3.4*'),
+                         [Ref(self.root, 'python', '3.4.3', '0'),
+                          Ref(self.env1, 'python', '3.4.3', '0')])
+        index.close()
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestDiskUsage(FakeRootTestCase):
+    def write(self, path, size):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fo:
+            fo.write(b'x' * size)
+        return path
+
+    def link(self, src, dst):
+        dst = os.path.join(self.root, dst)
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        os.link(os.path.join(self.root, src), dst)
+
+    def test_disk_usage(self):
+        env = os.path.join(self.root, 'envs', 'test')
+        pkgs = os.path.join(self.root, 'pkgs')
+        self.write('pkgs/zlib-1.2.8-0/lib/libz.so', 1000)
+        self.write('pkgs/zlib-1.2.8-0.tar.bz2', 300)
+        self.write('pkgs/six-1.9.0-py34_0/six.py', 200)
+        write_meta(env, 'zlib', '1.2.8', '0', files=['lib/libz.so'])
+        write_meta(env, 'six', '1.9.0', 'py34_0', files=['six.py'])
+        write_meta(self.root, 'zlib', '1.2.8', '0', files=['lib/libz.so'])
+        self.link('pkgs/zlib-1.2.8-0/lib/libz.so', 'envs/test/lib/libz.so')
+        self.link('pkgs/zlib-1.2.8-0/lib/libz.so', 'lib/libz.so')
+        # a copy, and a file hardlinked twice within the environment
+        self.write('envs/test/six.py', 200)
+        self.write('envs/test/data', 50)
+        self.link('envs/test/data', 'envs/test/data2')
+
+        meta = lambda prefix: sum(
+            os.path.getsize(os.path.join(prefix, 'conda-meta', fn))
+            for fn in os.listdir(os.path.join(prefix, 'conda-meta')))
+        usage = conda_api.disk_usage([self.root, env], [pkgs])
+        self.assertEqual(sorted(usage), sorted([self.root, env, pkgs]))
+        u = usage[env]
+        self.assertEqual((u.apparent, u.unique, u.shared),
+                         (1300 + meta(env), 250 + meta(env), 1000))
+        self.assertEqual(u.files, 4 + len(os.listdir(os.path.join(
+            env, 'conda-meta'))))
+        zlib = u.packages['zlib-1.2.8-0']
+        self.assertEqual((zlib.apparent, zlib.unique, zlib.shared),
+                         (1000, 0, 1000))
+        six = u.packages['six-1.9.0-py34_0']
+        self.assertEqual((six.apparent, six.unique, six.shared),
+                         (200, 200, 0))
+        self.assertEqual(u.packages[None].apparent, 100 + meta(env))
+        # the root prefix does not contain envs and pkgs
+        u = usage[self.root]
+        self.assertEqual((u.apparent, u.unique, u.shared),
+                         (1000 + meta(self.root) + os.path.getsize(
+                             os.path.join(self.root, 'bin', 'conda')),
+                          meta(self.root) + os.path.getsize(
+                              os.path.join(self.root, 'bin', 'conda')),
+                          1000))
+        u = usage[pkgs]
+        self.assertEqual((u.apparent, u.unique, u.shared), (1500, 500, 1000))
+        self.assertEqual(sorted(u.packages),
+                         ['six-1.9.0-py34_0', 'zlib-1.2.8-0',
+                          'zlib-1.2.8-0.tar.bz2'])
+
+        # unchanged environments are not walked again
+        scans = dict((p, conda_api._usage_cache[p][1]) for p in usage)
+        self.write('envs/test/lib/untracked', 10)
+        usage = conda_api.disk_usage([self.root, env], [pkgs])
+        for p in usage:
+            self.assertIs(conda_api._usage_cache[p][1], scans[p])
+        write_meta(env, 'python', '3.4.3', '0')
+        usage = conda_api.disk_usage([self.root, env], [pkgs])
+        self.assertIsNot(conda_api._usage_cache[env][1], scans[env])
+        self.assertEqual(usage[env].packages[None].apparent, 110 + meta(env))
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestWatcher(FakeRootTestCase):
+    def setUp(self):
+        FakeRootTestCase.setUp(self)
+        self.old_home = os.environ.get('HOME')
+        os.environ['HOME'] = os.path.join(self.root, 'home')
+        write_meta(self.root, 'python', '3.4.3', '0')
+
+    def tearDown(self):
+        os.environ['HOME'] = self.old_home
+        FakeRootTestCase.tearDown(self)
+
+    def collect(self, watcher, n):
+        events = []
+        t0 = time.time()
+        while len(events) < n and time.time() - t0 < 5:
+            events.extend(watcher.poll(0.5))
+        self.assertEqual(watcher.poll(0.1), [])
+        return sorted(events)
+
+    def check_watcher(self, use_inotify):
+        Event = conda_api.WatchEvent
+        env = os.path.join(self.root, 'envs', 'test')
+        watcher = conda_api.Watcher(interval=0.05, use_inotify=use_inotify)
+        cache = conda_api._default_client.info_cache
+        try:
+            self.assertEqual(watcher.poll(), [])
+            cache.put(True, {}, cache.generation())
+            write_meta(env, 'python', '2.7.9', '1')
+            write_meta(env, 'six', '1.9.0', 'py27_0')
+            self.assertEqual(self.collect(watcher, 1), [
+                Event(env, ['python-2.7.9-1', 'six-1.9.0-py27_0'], [])])
+            self.assertIsNone(cache.peek(True))
+
+            write_meta(self.root, 'six', '1.9.0', 'py34_0')
+            os.unlink(os.path.join(env, 'conda-meta', 'six-1.9.0-py27_0.json'))
+            self.assertEqual(self.collect(watcher, 2), [
+                Event(self.root, ['six-1.9.0-py34_0'], []),
+                Event(env, [], ['six-1.9.0-py27_0'])])
+
+            shutil.rmtree(env)
+            self.assertEqual(self.collect(watcher, 1), [
+                Event(env, [], ['python-2.7.9-1'])])
+        finally:
+            watcher.close()
+
+    def test_polling(self):
+        self.check_watcher(False)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'requires inotify')
+    def test_inotify(self):
+        self.check_watcher(True)
+
+    def test_fixed_prefixes(self):
+        env = os.path.join(self.root, 'envs', 'test')
+        watcher = conda_api.Watcher([env], interval=0.05)
+        events = []
+        watcher.start(events.append)
+        try:
+            write_meta(env, 'python', '2.7.9', '1')
+            t0 = time.time()
+            while not events and time.time() - t0 < 5:
+                time.sleep(0.05)
+        finally:
+            watcher.close()
+        self.assertEqual(events, [
+            conda_api.WatchEvent(env, ['python-2.7.9-1'], [])])
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestCondaClient(FakeRootTestCase):
+    def setUp(self):
+        FakeRootTestCase.setUp(self)
+        self.roots = [make_fake_root() for i in range(2)]
+        for root in self.roots:
+            write_meta(os.path.join(root, 'envs', 'test'), 'python',
+                       '3.4.3', '0')
+        self.clients = [conda_api.CondaClient(root) for root in self.roots]
+
+    def tearDown(self):
+        for client, root in zip(self.clients, self.roots):
+            client.close()
+            shutil.rmtree(root)
+        FakeRootTestCase.tearDown(self)
+
+    def test_parallel(self):
+        results = {}
+
+        def run(client):
+            with client.collect_metrics() as metrics:
+                for i in range(5):
+                    info = client.info()
+            results[client] = (info['root_prefix'], client.get_envs(),
+                               client.info_cache_stats(), len(metrics.records))
+
+        threads = [threading.Thread(target=run, args=(client,))
+                   for client in self.clients]
+        with conda_api.collect_metrics() as metrics:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        for client, root in zip(self.clients, self.roots):
+            self.assertEqual(client.root_prefix, root)
+            prefix, envs, stats, calls = results[client]
+            self.assertEqual(prefix, root)
+            self.assertEqual(envs[0], os.path.join(root, 'envs', 'test'))
+            self.assertEqual((stats['hits'], stats['misses']), (4, 1))
+            self.assertEqual(calls, 1)
+        # the default client is not affected
+        self.assertEqual(metrics.records, [])
+        self.assertEqual(conda_api.ROOT_PREFIX, self.root)
+        self.assertEqual(conda_api.info()['root_prefix'], self.root)
+
+    def test_worker_and_generators(self):
+        client = self.clients[0]
+        worker = client.start_worker(
+            [sys.executable, '-u', self.write_script(FAKE_WORKER)])
+        self.assertIs(client.worker, worker)
+        self.assertIsNone(conda_api._client().worker)
+        self.assertTrue(client.info()['worker'])
+        self.assertFalse(conda_api.info()['worker'])
+        client.stop_worker()
+        self.assertIsNone(client.worker)
+
+        with client.use():
+            watcher = conda_api.Watcher(interval=0.05, use_inotify=False)
+        try:
+            write_meta(os.path.join(self.roots[0], 'envs', 'test'), 'six',
+                       '1.9.0', 'py34_0')
+            self.assertEqual(watcher.poll(1), [conda_api.WatchEvent(
+                os.path.join(self.roots[0], 'envs', 'test'),
+                ['six-1.9.0-py34_0'], [])])
+        finally:
+            watcher.close()
+
+        jobs = [(os.path.join(self.roots[1], 'envs', 'test'),
+                 sys.executable, ['-c', 'print("ok")'])]
+        results = client.process_many(jobs)
+        self.assertEqual([res.stdout.strip() for res in results], [b'ok'])
+
+
+def make_package(channel_dir, name, version, build, files, depends=()):
+    """
+    Build the noarch package name-version-build.tar.bz2 containing `files`
+    (a dictionary mapping paths to contents) in the channel directory, and
+    return its md5 sum.
+    """
+    import hashlib
+    import io
+    import tarfile
+
+    subdir = os.path.join(channel_dir, 'noarch')
+    if not os.path.isdir(subdir):
+        os.makedirs(subdir)
+    index = dict(name=name, version=version, build=build, build_number=0,
+                 depends=list(depends), subdir='noarch', noarch='generic')
+    members = dict(files)
+    members['info/index.json'] = json.dumps(index)
+    members['info/files'] = ''.join(p + '\n' for p in sorted(files))
+    path = os.path.join(subdir, '%s-%s-%s.tar.bz2' % (name, version, build))
+    with tarfile.open(path, 'w:bz2') as tar:
+        for member, content in sorted(members.items()):
+            data = content.encode('utf-8')
+            info = tarfile.TarInfo(member)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    with open(path, 'rb') as fi:
+        return hashlib.md5(fi.read()).hexdigest()
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestExplicit(FakeRootTestCase):
+    def test_export(self):
+        prefix = os.path.join(self.root, 'envs', 'test')
+        url = 'https://repo.continuum.io/pkgs/free/linux-64/'
+        write_meta(prefix, 'python', '3.4.3', '0', md5='a' * 32,
+                   depends=['openssl 1.0.1*', 'zlib'], subdir='linux-64',
+                   url=url + 'python-3.4.3-0.tar.bz2')
+        write_meta(prefix, 'openssl', '1.0.1k', '1', md5='b' * 32,
+                   subdir='linux-64', channel=url.rstrip('/'))
+        write_meta(prefix, 'zlib', '1.2.8', '0', depends=['openssl'],
+                   subdir='linux-64', url=url + 'zlib-1.2.8-0.tar.bz2')
+        lockfile = os.path.join(self.root, 'lock.txt')
+        text = conda_api.export_explicit(prefix, lockfile)
+        with open(lockfile) as fi:
+            self.assertEqual(fi.read(), text)
+        self.assertEqual(text.splitlines()[2:], [
+            '# platform: linux-64',
+            '@EXPLICIT',
+            url + 'openssl-1.0.1k-1.tar.bz2#' + 'b' * 32,
+            url + 'zlib-1.2.8-0.tar.bz2',
+            url + 'python-3.4.3-0.tar.bz2#' + 'a' * 32])
+        self.assertEqual(conda_api.parse_explicit(text), [
+            (url + 'openssl-1.0.1k-1.tar.bz2', 'b' * 32),
+            (url + 'zlib-1.2.8-0.tar.bz2', None),
+            (url + 'python-3.4.3-0.tar.bz2', 'a' * 32)])
+        self.assertRaises(conda_api.CondaError, conda_api.parse_explicit,
+                          'numpy\n')
+
+    def test_create(self):
+        channel = os.path.join(self.root, 'channel')
+        md5 = make_package(channel, 'six', '1.9.0', '0', {'six.py': ''})
+        url = 'file://%s/noarch/six-1.9.0-0.tar.bz2' % channel
+        lockfile = os.path.join(self.root, 'lock.txt')
+        prefix = os.path.join(self.root, 'envs', 'test')
+        with open(lockfile, 'w') as fo:
+            fo.write('@EXPLICIT\n%s#%s\n' % (url, md5))
+        with conda_api.collect_metrics() as metrics:
+            self.assertEqual(conda_api.create_from_explicit(prefix, lockfile),
+                             [(url, md5)])
+        self.assertEqual(metrics.records[0].argv, [
+            'create', '--yes', '--quiet', '--json', '--prefix', prefix,
+            '--file', lockfile])
+
+        with open(lockfile, 'w') as fo:
+            fo.write('@EXPLICIT\n%s#%s\n' % (url, '0' * 32))
+        with conda_api.collect_metrics() as metrics:
+            self.assertRaises(conda_api.CondaError,
+                              conda_api.create_from_explicit, prefix, lockfile)
+        self.assertEqual(metrics.records, [])
+        os.makedirs(prefix)
+        self.assertRaises(conda_api.CondaEnvExistsError,
+                          conda_api.create_from_explicit, prefix, lockfile)
+
+
+@unittest.skipIf(shutil.which('conda') is None, 'requires conda')
+class TestExplicitEndToEnd(unittest.TestCase):
+    name = 'conda-api-test-pkg'
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.client = conda_api.CondaClient()
+        self.pkgs_dirs = self.client.info()['pkgs_dirs']
+
+    def tearDown(self):
+        self.client.close()
+        shutil.rmtree(self.tmp)
+        for pkgs_dir in self.pkgs_dirs:
+            for fn in os.listdir(pkgs_dir) if os.path.isdir(pkgs_dir) else []:
+                if fn.startswith(self.name):
+                    path = os.path.join(pkgs_dir, fn)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.unlink(path)
+
+    def test_file_channel(self):
+        channel = os.path.join(self.tmp, 'channel')
+        md5 = make_package(channel, self.name, '1.0', '0',
+                           {'share/conda-api-test.txt': 'hello\n'})
+        lockfile = os.path.join(self.tmp, 'lock.txt')
+        with open(lockfile, 'w') as fo:
+            fo.write('@EXPLICIT\nfile://%s/noarch/%s-1.0-0.tar.bz2#%s\n' % (
+                channel, self.name, md5))
+
+        prefixes = [os.path.join(self.tmp, 'env%d' % i) for i in range(2)]
+        self.client.create_from_explicit(prefixes[0], lockfile)
+        with open(os.path.join(prefixes[0], 'share',
+                               'conda-api-test.txt')) as fi:
+            self.assertEqual(fi.read(), 'hello\n')
+        # the exported specification rebuilds the same environment
+        export = os.path.join(self.tmp, 'export.txt')
+        text = self.client.export_explicit(prefixes[0], export)
+        self.assertEqual(conda_api.parse_explicit(text),
+                         conda_api.parse_explicit(open(lockfile).read()))
+        self.client.create_from_explicit(prefixes[1], export)
+        self.assertEqual(sorted(self.client.linked(prefixes[1])),
+                         ['%s-1.0-0' % self.name])
+
+
+FAKE_PLAN_CONDA = '''\
+import os
+import sys
+root = os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0])))
+with open(os.path.join(root, 'plan.json')) as fi:
+    sys.stdout.write(fi.read())
+'''
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestPrefetch(FakeRootTestCase):
+    conda_source = FAKE_PLAN_CONDA
+
+    def setUp(self):
+        FakeRootTestCase.setUp(self)
+        self.old_cache = conda_api.set_plan_cache(
+            conda_api.PlanCache(os.path.join(self.root, 'plans')))
+        self.pkgs_dir = os.path.join(self.root, 'pkgs')
+        channel = os.path.join(self.root, 'channel')
+        self.records = []
+        for name, depends in ('six', []), ('numpy', ['six']):
+            md5 = make_package(channel, name, '1.0', '0',
+                               {'share/%s.txt' % name: name}, depends)
+            fn = '%s-1.0-0.tar.bz2' % name
+            self.records.append(dict(
+                name=name, version='1.0', build='0', fn=fn, md5=md5,
+                url='file://%s/noarch/%s' % (channel, fn),
+                channel='file://%s/noarch' % channel))
+        self.plan = {'success': True, 'actions': {'FETCH': self.records}}
+        with open(os.path.join(self.root, 'plan.json'), 'w') as fo:
+            json.dump(self.plan, fo)
+
+    def tearDown(self):
+        conda_api.set_plan_cache(self.old_cache)
+        FakeRootTestCase.tearDown(self)
+
+    def test_plan(self):
+        res = conda_api.prefetch(self.plan)
+        self.assertEqual(res.fetched, ['numpy-1.0-0', 'six-1.0-0'])
+        self.assertEqual(res.extracted, ['numpy-1.0-0', 'six-1.0-0'])
+        self.assertEqual(res.cached, [])
+        with open(os.path.join(self.pkgs_dir, 'six-1.0-0', 'share',
+                               'six.txt')) as fi:
+            self.assertEqual(fi.read(), 'six')
+        with open(os.path.join(self.pkgs_dir, 'numpy-1.0-0', 'info',
+                               'repodata_record.json')) as fi:
+            record = json.load(fi)
+        self.assertEqual(record['url'], self.records[1]['url'])
+        self.assertEqual(record['depends'], ['six'])
+        self.assertEqual(sorted(conda_api.package_info('six-1.0-0')),
+                         ['six-1.0-0'])
+
+        res = conda_api.prefetch(self.plan)
+        self.assertEqual((res.cached, res.fetched), (
+            ['numpy-1.0-0', 'six-1.0-0'], []))
+
+        # cached tarballs with the right md5 sum are extracted only
+        shutil.rmtree(os.path.join(self.pkgs_dir, 'six-1.0-0'))
+        res = conda_api.prefetch([(r['url'], r['md5']) for r in self.records])
+        self.assertEqual((res.cached, res.fetched, res.extracted), (
+            ['numpy-1.0-0'], [], ['six-1.0-0']))
+
+    def test_specs(self):
+        with conda_api.collect_metrics() as metrics:
+            res = conda_api.prefetch(['numpy'], channels=['file:///channel'])
+        self.assertEqual(res.extracted, ['numpy-1.0-0', 'six-1.0-0'])
+        self.assertEqual(metrics.records[0].argv, [
+            'create', '--json', '--dry-run', '--prefix',
+            os.path.join(self.root, 'envs', '.conda_api_prefetch'),
+            '--override-channels', '--channel', 'file:///channel', 'numpy'])
+
+    def test_md5_mismatch(self):
+        url = self.records[0]['url']
+        self.assertRaises(conda_api.CondaError, conda_api.prefetch,
+                          [url + '#' + '0' * 32, self.records[1]['url']])
+        self.assertEqual(sorted(os.listdir(self.pkgs_dir)), [
+            'numpy-1.0-0', 'numpy-1.0-0.tar.bz2', 'urls.txt'])
+
+    def test_unsafe_members(self):
+        import io
+        import tarfile
+
+        def tarball(name, type=tarfile.REGTYPE, linkname=''):
+            path = os.path.join(self.root, 'bad.tar.bz2')
+            with tarfile.open(path, 'w:bz2') as tar:
+                info = tarfile.TarInfo(name)
+                info.type = type
+                info.linkname = linkname
+                tar.addfile(info, io.BytesIO(b''))
+            return path
+
+        dest = os.path.join(self.root, 'pkgs', 'bad')
+        members = [('../evil',), ('/tmp/evil',), ('a/../../evil',),
+                   ('link', tarfile.SYMTYPE, '../evil'),
+                   ('link', tarfile.SYMTYPE, '/tmp/evil'),
+                   ('link', tarfile.LNKTYPE, '../evil')]
+        tar_filter = getattr(tarfile, 'tar_filter', None)
+        try:
+            for with_filter in True, False:
+                if not with_filter and tar_filter is not None:
+                    del tarfile.tar_filter
+                for member in members:
+                    self.assertRaises(conda_api.CondaError, conda_api._extract,
+                                      tarball(*member), dest)
+                    self.assertFalse(os.path.exists(dest))
+                    self.assertFalse(os.path.lexists(
+                        os.path.join(self.root, 'pkgs', 'evil')))
+                # links within the package are fine
+                self.assertTrue(conda_api._extract(
+                    tarball('link', tarfile.SYMTYPE, 'info/index.json'), dest))
+                self.assertEqual(os.readlink(os.path.join(dest, 'link')),
+                                 'info/index.json')
+                shutil.rmtree(dest)
+        finally:
+            if tar_filter is not None:
+                tarfile.tar_filter = tar_filter
+
+
+FAKE_SLOW_CONDA = '''\
+import os
+import sys
+import json
+import time
+time.sleep(0.5)
+sys.stdout.write(json.dumps({'args': sys.argv[1:], 'pid': os.getpid()}))
+'''
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake root prefix is posix only')
+class TestSingleFlight(FakeRootTestCase):
+    conda_source = FAKE_SLOW_CONDA
+
+    def run_threads(self, funcs):
+        results = [None] * len(funcs)
+
+        def run(i):
+            try:
+                results[i] = funcs[i]()
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in range(len(funcs))]
+        for t in threads:
+            t.start()
+            time.sleep(0.02)
+        for t in threads:
+            t.join()
+        return results
+
+    def test_coalesced(self):
+        search = lambda: conda_api.search(spec='numpy')
+        with conda_api.collect_metrics() as metrics:
+            results = self.run_threads([search] * 6 + [
+                lambda: conda_api.install(prefix='/tmp/x', pkgs=['numpy']),
+                lambda: conda_api.install(prefix='/tmp/x', pkgs=['numpy'])])
+        self.assertEqual(len(set(r['pid'] for r in results[:6])), 1)
+        # each caller gets its own copy of the result
+        results[0]['args'].append('modified')
+        self.assertEqual(results[1]['args'], conda_api._search_args(
+            None, 'numpy', {}))
+        # mutating calls are never coalesced
+        self.assertNotEqual(results[6], results[7])
+        summary = metrics.summary()
+        self.assertEqual(summary['search']['count'], 6)
+        self.assertEqual(summary['search']['coalesced'], 5)
+        self.assertEqual(summary['install']['coalesced'], 0)
+        self.assertEqual(conda_api._client().single_flight.coalesced, 5)
+
+    def test_copies(self):
+        def search_and_modify():
+            res = conda_api.search(spec='numpy')
+            res['args'].append('modified')
+            res.update(('key%d' % i, i) for i in range(10000))
+            return res
+
+        results = self.run_threads([search_and_modify] * 4)
+        self.assertEqual(len(set(r['pid'] for r in results)), 1)
+        for res in results:
+            self.assertEqual(res['args'].count('modified'), 1)
+
+    def test_deadlines(self):
+        token = conda_api.CancelToken()
+
+        def leader():
+            with conda_api.deadline(cancel=token):
+                return conda_api.search(spec='numpy')
+
+        def impatient():
+            with conda_api.deadline(0.1):
+                return conda_api.search(spec='numpy')
+
+        timer = threading.Timer(0.2, token.cancel)
+        timer.start()
+        with conda_api.collect_metrics() as metrics:
+            results = self.run_threads([leader, impatient,
+                                        lambda: conda_api.search(spec='numpy')])
+        timer.join()
+        self.assertIsInstance(results[0], conda_api.CondaCancelledError)
+        self.assertIsInstance(results[1], conda_api.CondaTimeoutError)
+        # the cancellation of the leader does not apply to the follower,
+        # which makes the call again
+        self.assertEqual(results[2]['args'][0], 'search')
+        self.assertEqual(
+            [(r.coalesced, r.error) for r in metrics.records
+             if not r.coalesced or r.error != 'CondaTimeoutError'],
+            [(False, 'CondaCancelledError'), (True, 'CondaCancelledError'),
+             (False, None)])
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs asyncio.run')
+    def test_asyncio(self):
+        import asyncio
+        import conda_api_aio
+
+        async def main():
+            calls = [conda_api_aio.search(spec='numpy') for i in range(5)]
+            calls.append(conda_api_aio.search(spec='scipy'))
+            return await asyncio.gather(*calls)
+
+        with conda_api.collect_metrics() as metrics:
+            results = asyncio.run(main())
+        self.assertEqual(len(set(r['pid'] for r in results[:5])), 1)
+        self.assertNotEqual(results[0]['pid'], results[5]['pid'])
+        self.assertEqual(metrics.summary()['search']['coalesced'], 4)
+        self.assertEqual(conda_api_aio._flights, {})
+        self.assertEqual(len(set(id(r) for r in results)), 6)